@@ -0,0 +1,341 @@
+"""
+Benchmarks of the hot paths: the CRC, framing messages, decoding the DCB, publishing a thermostat's data to mqtt
+and polling cycles of up to 128 thermostats simulated in process (see simulator.py, there is no serial port or broker)
+Results are written as json so runs can be compared, a run can be compared with an earlier one straight away
+e.g. python3 benchmark.py --output before.json, then after a change python3 benchmark.py --compare before.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import timeit
+import main
+from crc16 import CRC16, crc16
+from heatmiserHub import HeatmiserHub
+from heatmiserThermostat import HeatmiserThermostat, FUNC_READ, FUNC_WRITE, HEATMISER
+from homeassistant import DiscoveryConfigs
+from outbox import Outbox
+from simulator import BusSimulator, SimulatedThermostat
+from thermostatPublisher import ThermostatPublisher
+
+# Lengths of the frames the CRC is run on: a write reply, a short DCB and the longest DCB
+CRC_FRAME_LENGTHS = (7, 75, 159)
+# Numbers of thermostats on the network in the polling cycle benchmarks
+POLL_COUNTS = (1, 8, 32, 64, 128)
+# Number of times each benchmark is timed, the best and median times are reported
+REPEAT = 5
+# Version of the results format
+RESULTS_VERSION = 1
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _time(function, repeat: int) -> dict:
+    """
+    Times function, called as many times as take at least 0.2s (timeit's autorange) in each of repeat runs
+    Returns the number of calls in each run and the best and median time of a call in microseconds
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = [elapsed / number * 1e6 for elapsed in timer.repeat(repeat, number)]
+    return {"number": number, "best_us": round(min(times), 3), "median_us": round(statistics.median(times), 3)}
+
+
+def _result(name: str, params: dict, timing: dict, **extra) -> dict:
+    result = {"name": name, "params": params, **timing, **extra}
+    _LOGGER.info(f"{name} {params} {timing['median_us']:.1f}us")
+    return result
+
+
+def _key(result: dict) -> str:
+    """Returns the key which identifies a benchmark in the results of different runs"""
+    params = ",".join(f"{name}={value}" for name, value in sorted(result["params"].items()))
+    return f"{result['name']}[{params}]"
+
+
+class _ReplayHub(object):
+    """Replies to each message with the next of frames in turn, so a thermostat can be read without a bus"""
+
+    def __init__(self, frames: list):
+        self._frames = itertools.cycle(frames)
+
+    def registerThermostat(self, thermostat):
+        pass
+
+    def send_msg(self, message: list, priority: int = None, response_timeout: float = None):
+        return next(self._frames)
+
+
+class _SimulatedPort(object):
+    """The part of a pyserial port used by the hub, replied to straight away by a BusSimulator"""
+
+    def __init__(self, bus: BusSimulator):
+        self._bus = bus
+        self._input = bytearray()
+        self.is_open = True
+        self.timeout = None
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._input)
+
+    def write(self, data: bytes) -> int:
+        for request in self._bus.receive(data):
+            reply, late = self._bus.reply(request)
+            self._input += reply + late
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        data = bytes(self._input[:size])
+        del self._input[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self._input.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+class _SimulatedHub(HeatmiserHub):
+    """A hub whose port is a _SimulatedPort, the bus worker, retries and metrics are those of the real hub"""
+
+    def __init__(self, bus: BusSimulator, name: str):
+        self._bus = bus
+        super().__init__(name, name)
+
+    def _init_serial(self):
+        self._serport = _SimulatedPort(self._bus)
+        return True
+
+
+class _NullResult(object):
+    rc = main.mqtt_client.MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout: float = None):
+        pass
+
+
+class _NullClient(object):
+    """An mqtt client which counts the messages published"""
+
+    def __init__(self):
+        self.published = 0
+        self.connected_flag = True
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.published += 1
+        return _NullResult()
+
+
+def _setup_main(json_state: bool = False):
+    """Sets the globals of main.py which publishing and polling use, as main.py does at startup"""
+    main.args = argparse.Namespace(mqtt_prefix=HEATMISER, homeassistant=True, json_state=json_state,
+        ha_device_discovery=False)
+    main._LOGGER = logging.getLogger("main")
+    main.client = _NullClient()
+    main.outbox = Outbox()
+    main.publishers = {}
+    main.discovery_configs = DiscoveryConfigs(lambda topic, payload: main.publish_base(main.client, topic, payload))
+
+
+def _add_publisher(thermostat: HeatmiserThermostat, json_state: bool = False):
+    main.publishers[thermostat.name] = ThermostatPublisher(lambda topic, payload: main.publish_base(main.client, topic, payload),
+        HEATMISER, thermostat, json_state=json_state)
+
+
+def _frames() -> list:
+    """
+    Returns replies to a read of the whole DCB of each model in each of its timer modes,
+    as a list of (model, timer mode, [frame, the frame with a different version])
+    """
+    frames = []
+    for model, layout in HeatmiserThermostat.LAYOUTS.items():
+        modes = set()
+        for seven_day in (False, True):
+            thermostat = SimulatedThermostat(1, model, seven_day)
+            mode = thermostat.dcb[layout.mode_index] if layout.mode_index is not None else None
+            if mode in modes:
+                continue
+            modes.add(mode)
+            request = bytes(HeatmiserThermostat.assemble_message(1, FUNC_READ, 0, [0]))
+            replies = [list(BusSimulator([thermostat]).reply(request)[0])]
+            thermostat.dcb[layout.field("Version").index] += 1
+            replies.append(list(BusSimulator([thermostat]).reply(request)[0]))
+            frames.append((model, mode, replies))
+    return frames
+
+
+def benchmark_crc(repeat: int) -> list:
+    results = []
+    for length in CRC_FRAME_LENGTHS:
+        message = [n & 0xff for n in range(length)]
+        results.append(_result("crc16.CRC16.run", {"length": length}, _time(lambda: CRC16().run(message), repeat)))
+        results.append(_result("crc16.crc16", {"length": length}, _time(lambda: crc16(message), repeat)))
+    return results
+
+
+def benchmark_assemble_message(repeat: int) -> list:
+    messages = {
+        "read_all": (FUNC_READ, 0, [0]),
+        "read_hot": (FUNC_READ, 32, [0], 10),
+        "write_12": (FUNC_WRITE, 47, [7, 0, 21, 9, 0, 16, 16, 0, 21, 22, 0, 16]),
+    }
+    return [_result("assemble_message", {"message": name}, _time(lambda: HeatmiserThermostat.assemble_message(1, *args), repeat))
+        for name, args in messages.items()]
+
+
+def benchmark_decode(repeat: int) -> list:
+    """
+    Validating and decoding a reply to a read of the whole DCB in _send_message, the frames read alternate
+    so every read has changed, and then accessing none or all of the read properties (as publishing does)
+    """
+    results = []
+    for model, mode, frames in _frames():
+        thermostat = HeatmiserThermostat(1, model, _ReplayHub(frames), "benchmark", dcb_frame=frames[-1])
+
+        def read_all():
+            thermostat._send_message(0, [0])
+            return dict(thermostat.read_properties)
+
+        for access, function in (("none", lambda: thermostat._send_message(0, [0])), ("all", read_all)):
+            results.append(_result("decode_dcb", {"model": model, "timer_mode": mode, "access": access},
+                _time(function, repeat), frame_length=len(frames[0])))
+    return results
+
+
+def benchmark_publish(repeat: int) -> list:
+    """
+    The mqtt publishing in main.py after a thermostat has been read, of everything (after the republish interval)
+    and of nothing (the thermostat's data are unchanged)
+    """
+    results = []
+    model, _, frames = _frames()[0]
+    for json_state in (False, True):
+        _setup_main(json_state)
+        thermostat = HeatmiserThermostat(1, model, _ReplayHub(frames[:1]), "benchmark", dcb_frame=frames[0])
+        _add_publisher(thermostat, json_state)
+        publisher = main.publishers[thermostat.name]
+
+        def publish_all():
+            publisher.invalidate()
+            main.publish_thermostat(thermostat)
+
+        for changed, function in (("all", publish_all), ("none", lambda: main.publish_thermostat(thermostat))):
+            function()
+            published = main.client.published
+            function()
+            messages = main.client.published - published
+            results.append(_result("publish_thermostat", {"json_state": json_state, "changed": changed},
+                _time(function, repeat), messages=messages))
+    return results
+
+
+def benchmark_poll(repeat: int, counts: tuple = POLL_COUNTS) -> list:
+    """
+    Polling cycles in which every thermostat on a network is read and its data published by main.py
+    The thermostats are of each model in turn, answered in process by a BusSimulator without the bus timing
+    """
+    results = []
+    models = list(HeatmiserThermostat.LAYOUTS)
+    for count in counts:
+        _setup_main()
+        simulated = [SimulatedThermostat(n + 1, models[n % len(models)]) for n in range(count)]
+        hub = _SimulatedHub(BusSimulator(simulated), f"benchmark_{count}")
+        try:
+            thermostats = []
+            for thermostat in simulated:
+                thermostats.append(HeatmiserThermostat(thermostat.address, thermostat.model, hub,
+                    f"{hub.name()}_{thermostat.address}"))
+                _add_publisher(thermostats[-1])
+
+            def cycle():
+                for thermostat in thermostats:
+                    main.poll_thermostat(thermostat, hub, None)
+
+            timing = _time(cycle, repeat)
+            results.append(_result("poll_cycle", {"thermostats": count}, timing,
+                per_thermostat_us=round(timing["median_us"] / count, 3)))
+        finally:
+            hub.stop()
+    return results
+
+
+BENCHMARKS = {
+    "crc": benchmark_crc,
+    "assemble": benchmark_assemble_message,
+    "decode": benchmark_decode,
+    "publish": benchmark_publish,
+    "poll": benchmark_poll,
+}
+
+
+def run(names: list, repeat: int = REPEAT) -> dict:
+    """Runs the named benchmarks, returns the results with the details of the platform they were run on"""
+    results = []
+    for name in names:
+        results += BENCHMARKS[name](repeat)
+    return {
+        "version": RESULTS_VERSION,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    """
+    Prints the change in the median time of each benchmark run in both baseline and current
+    Returns False if any is slower by more than threshold percent
+    """
+    baseline_results = {_key(result): result for result in baseline["results"]}
+    ok = True
+    for result in current["results"]:
+        key = _key(result)
+        before = baseline_results.get(key)
+        if before is None:
+            print(f"{key:60} {result['median_us']:12.1f}us (new)")
+            continue
+        change = (result["median_us"] / before["median_us"] - 1) * 100 if before["median_us"] else 0
+        regression = change > threshold
+        ok = ok and not regression
+        print(f"{key:60} {before['median_us']:12.1f}us -> {result['median_us']:12.1f}us {change:+7.1f}%"
+            f"{' REGRESSION' if regression else ''}")
+    return ok
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Benchmarks of the Heatmiser add-on hot paths')
+    parser.add_argument('--benchmarks', '-b', type=str, nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS), metavar='BENCHMARK', help=f"The benchmarks to run (default {' '.join(BENCHMARKS)})")
+    parser.add_argument('--repeat', '-r', type=int, default=REPEAT, help=f"The number of times each benchmark is timed (default {REPEAT})")
+    parser.add_argument('--output', '-o', type=str, help='The file the json results are written to (default stdout)')
+    parser.add_argument('--compare', '-c', type=str, metavar='RESULTS', help='A json results file to compare the results with')
+    parser.add_argument('--threshold', '-t', type=float, default=10, help='The percentage by which a benchmark can be slower than in the compared results before it is reported as a regression, which gives an exit status of 1 (default 10)')
+    parser.add_argument('--loglevel', '-l', type=str, default='info', choices=['debug', 'info', 'warning', 'error'], help='The log level of the benchmarks, the modules benchmarked only log errors (default info)')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)-5s %(message)s', level=logging.ERROR, force=True)
+    _LOGGER.setLevel(args.loglevel.upper())
+
+    results = run(args.benchmarks, args.repeat)
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    elif args.compare is None:
+        print(text)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        return 0 if compare(baseline, results, args.threshold) else 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,38 @@
+"""Module containing the unit of work queued for a HeatmiserHub's bus worker"""
+import itertools
+from concurrent.futures import Future
+
+# Transaction priorities, lower values are sent on the bus first
+PRIORITY_WRITE = 0
+PRIORITY_READ = 10
+PRIORITY_POLL = 20
+# Probes for thermostats added to the network, only sent when the bus is otherwise idle
+PRIORITY_DISCOVERY = 30
+
+
+class BusTransaction(object):
+    """
+    A function to be run by the bus worker thread, which owns the serial port (or tcp connection)
+    Transactions are ordered by priority and then by the order in which they were submitted
+    The result of the function (or any exception raised) is delivered through self.future
+    """
+    _sequence = itertools.count()
+
+    def __init__(self, priority: int, function, *args):
+        self.priority = priority
+        self.sequence = next(self._sequence)
+        self.function = function
+        self.args = args
+        self.future = Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def run(self):
+        """Runs the function and sets the result of the future (unless it has been cancelled)"""
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            self.future.set_result(self.function(*self.args))
+        except Exception as ex:
+            self.future.set_exception(ex)
@@ -0,0 +1,56 @@
+"""Module to decide when the thermostats' clocks on a network are set to the host's time"""
+import logging
+import time
+
+# Drift in seconds of a thermostat's clock from the host's local time above which it is set, 0 never sets it
+CLOCK_SYNC_THRESHOLD = 0
+# Shortest interval in seconds between clock writes on a network, so they are spread over the poll cycles
+CLOCK_WRITE_SPACING = 10
+# Shortest interval in seconds between clock writes to a thermostat, e.g. when the write fails
+CLOCK_RETRY_INTERVAL = 3600
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ClockSync(object):
+    """
+    Measures the drift of each thermostat's clock on a network after it is read and sets the clock
+    when the drift exceeds the threshold, if its firmware supports it (V20 onwards)
+    At most one clock is written every CLOCK_WRITE_SPACING seconds and each thermostat at most every
+    CLOCK_RETRY_INTERVAL seconds, so the writes never crowd out the polling
+    """
+
+    def __init__(self, threshold: int = CLOCK_SYNC_THRESHOLD, spacing: float = CLOCK_WRITE_SPACING,
+            retry_interval: float = CLOCK_RETRY_INTERVAL):
+        self.threshold = threshold
+        self._spacing = spacing
+        self._retry_interval = retry_interval
+        # when the last clock was written (time.monotonic)
+        self._last_write = None
+        # thermostat name -> when its clock was last written (time.monotonic)
+        self._writes = {}
+
+    def check(self, thermostat):
+        """
+        Sets the thermostat's clock if it has drifted more than the threshold and a write is allowed
+        Returns its drift in seconds or None if it has no clock
+        """
+        drift = thermostat.clock_drift()
+        if drift is None or self.threshold <= 0 or abs(drift) <= self.threshold or not thermostat.clock_settable():
+            return drift
+        now = time.monotonic()
+        if self._last_write is not None and now - self._last_write < self._spacing:
+            return drift
+        last_write = self._writes.get(thermostat.name)
+        if last_write is not None and now - last_write < self._retry_interval:
+            return drift
+        self._last_write = now
+        self._writes[thermostat.name] = now
+        _LOGGER.info(f"Setting the clock of thermostat '{thermostat.name}' which has drifted {drift}s")
+        if thermostat.sync_clock():
+            drift = thermostat.clock_drift()
+        return drift
+
+    def forget(self, thermostat):
+        """Forgets a thermostat which has been removed"""
+        self._writes.pop(thermostat.name, None)
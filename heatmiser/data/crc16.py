@@ -1,50 +1,81 @@
 #
 # Believe this is known as CCITT (0xFFFF)
-# This is the CRC function converted directly from the Heatmiser C code
-# provided in their API
+# This was originally converted directly from the Heatmiser C code provided in their API
+# which processes a nibble at a time using two 16 entry tables.
+# It is now table driven, a byte at a time, which gives identical results
+
+from functools import lru_cache
 
 BYTEMASK = 0xff
+CRC_INIT = 0xffff
+CRC_POLYNOMIAL = 0x1021
+# Number of received frames whose verification result is remembered
+VERIFY_CACHE_SIZE = 128
+
+
+def _build_table():
+    """Returns the 256 entry lookup table for the CCITT polynomial"""
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ CRC_POLYNOMIAL
+            else:
+                crc = crc << 1
+        table.append(crc & 0xffff)
+    return tuple(table)
+
+
+CRC_TABLE = _build_table()
+
+
+def crc16(buf, crc: int = CRC_INIT) -> int:
+    """
+    Returns the 16 bit CRC of buf which can be bytes, bytearray, memoryview or a list of ints
+    The frame carries this as two bytes, low 8 bits first
+    """
+    table = CRC_TABLE
+    for value in buf:
+        crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ value]
+    return crc
+
+
+@lru_cache(maxsize=VERIFY_CACHE_SIZE)
+def _verify(frame: bytes) -> bool:
+    """Checks the CRC of a frame held as bytes, results are cached as repeated frames are common"""
+    if len(frame) < 2:
+        return False
+    return crc16(memoryview(frame)[:-2]) == frame[-2] | (frame[-1] << 8)
+
+
+def crc16_verify(frame) -> bool:
+    """
+    Returns True if the last two bytes of frame (low 8 bits first) are the CRC of the rest of the frame
+    frame can be bytes, bytearray, memoryview or a list of ints
+    """
+    return _verify(bytes(frame))
 
 
 class CRC16:
-    """This is the CRC hashing mechanism used by the V3 protocol."""
-    LookupHigh = [
-        0x00, 0x10, 0x20, 0x30, 0x40, 0x50, 0x60, 0x70,
-        0x81, 0x91, 0xa1, 0xb1, 0xc1, 0xd1, 0xe1, 0xf1
-    ]
-    LookupLow = [
-        0x00, 0x21, 0x42, 0x63, 0x84, 0xa5, 0xc6, 0xe7,
-        0x08, 0x29, 0x4a, 0x6b, 0x8c, 0xad, 0xce, 0xef
-    ]
+    """
+    This is the CRC hashing mechanism used by the V3 protocol.
+    Retained for compatibility, crc16() and crc16_verify() are faster
+    """
 
     def __init__(self):
         self.high = BYTEMASK
         self.low = BYTEMASK
 
-    def extract_bits(self, val):
-        """Extras the 4 bits, XORS the message data, and does table lookups."""
-        # Step one, extract the Most significant 4 bits of the CRC register
-        thisval = self.high >> 4
-        # XOR in the Message Data into the extracted bits
-        thisval = thisval ^ val
-        # Shift the CRC Register left 4 bits
-        self.high = (self.high << 4) | (self.low >> 4)
-        self.high = self.high & BYTEMASK    # force char
-        self.low = self.low << 4
-        self.low = self.low & BYTEMASK      # force char
-        # Do the table lookups and XOR the result into the CRC tables
-        self.high = self.high ^ self.LookupHigh[thisval]
-        self.high = self.high & BYTEMASK    # force char
-        self.low = self.low ^ self.LookupLow[thisval]
-        self.low = self.low & BYTEMASK      # force char
-
     def update(self, val):
-        """Updates the CRC value using bitwise operations."""
-        self.extract_bits(val >> 4)    # High nibble first
-        self.extract_bits(val & 0x0f)   # Low nibble
+        """Updates the CRC value with a single byte"""
+        crc = crc16((val,), (self.high << 8) | self.low)
+        self.high = crc >> 8
+        self.low = crc & BYTEMASK
 
     def run(self, message):
         """Calculates a CRC"""
-        for value in message:
-            self.update(value)
+        crc = crc16(message, (self.high << 8) | self.low)
+        self.high = crc >> 8
+        self.low = crc & BYTEMASK
         return [self.low, self.high]
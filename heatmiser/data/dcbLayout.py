@@ -0,0 +1,335 @@
+"""
+Declarative description of a thermostat's device control block (DCB)
+Each model has a DcbLayout made up of DcbFields which is compiled once into struct based decoders
+The same fields provide the write properties so reads and writes share one definition
+"""
+import collections.abc
+import struct
+from writepropertydata import WritePropertyData
+
+# How the raw value of a field is presented as a read property
+FIELD_INT = "int"           # the value (after any mask)
+FIELD_STR = "str"           # the value as a string
+FIELD_ENUM = "enum"         # text from the field's options
+FIELD_TEMP = "temp"         # tenths of a degree as a string, 0xFFFF is "not connected"
+FIELD_DAY = "day"           # day of the week 1-7
+FIELD_TIME = "time"         # 2 bytes hour and minute as HH:MM
+FIELD_CLOCK = "clock"       # 3 bytes hour, minute and second as HH:MM:SS
+
+WEEKDAYS = {1:"Mon", 2:"Tue", 3:"Wed", 4:"Thu", 5:"Fri", 6:"Sat", 7:"Sun"}
+PERIODS = ["Wake", "Leave", "Return", "Sleep"]
+NOT_CONNECTED = 0xffff
+# Marks a read property which hasn't been decoded yet
+_UNDECODED = object()
+# Write group of the current day and time, which are written together
+GROUP_CLOCK = "clock"
+
+
+class DcbField(object):
+    """
+    Describes one property held in the DCB
+    name: the read property name
+    index: position of the first byte within the DCB as it is read
+    width: number of bytes, values of 2 bytes are read high byte first
+    address: the unique address of the field used when writing (defaults to index)
+    kind: one of the FIELD_ constants, defaults to FIELD_ENUM if options are supplied else FIELD_INT
+    options: dict of raw value to text
+    mask: applied to the raw value before it is decoded
+    write: name of the write property or None if the field is read only
+    min, max: limits of a written value
+    write_options: dict of text to raw value when writing, defaults to the inverse of options
+    group: fields with the same group and contiguous addresses can be written in a single message
+        (a day of a program or the clock), other fields are written one at a time
+    schedule: the day of the program (schedule) the field is part of, whose fields come in pairs of
+        a time and a temperature or an on and an off time, or None
+    """
+
+    def __init__(self, name: str, index: int, width: int = 1, address: int = None, kind: str = None, options: dict = None,
+            mask: int = None, write: str = None, min=None, max=None, write_options: dict = None, group: str = None,
+            schedule: str = None):
+        self.name = name
+        self.index = index
+        self.width = width
+        self.address = index if address is None else address
+        self.kind = kind if kind is not None else (FIELD_ENUM if options is not None else FIELD_INT)
+        self.options = options
+        self.mask = mask
+        self.write = write
+        self.min = min
+        self.max = max
+        self.group = group
+        self.schedule = schedule
+        # the value read back is the value written so a write of the current value can be skipped
+        self.readback = mask is None and write_options is None
+        if write_options is None and options is not None:
+            write_options = {text: value for value, text in options.items()}
+        self.write_options = write_options
+        self.format = self._format()
+        self.convert = self._converter()
+
+    def _format(self) -> str:
+        """Returns the struct format of the field's raw value(s)"""
+        if self.kind in [FIELD_TIME, FIELD_CLOCK]:
+            return "B" * self.width
+        return {1: "B", 2: "H"}[self.width]
+
+    def _converter(self):
+        """Returns a function (values, i) which decodes the field from position i of an unpacked tuple"""
+        mask = self.mask
+        options = self.options
+        if self.kind == FIELD_TIME:
+            return lambda values, i: f"{values[i]:02d}:{values[i + 1]:02d}"
+        if self.kind == FIELD_CLOCK:
+            return lambda values, i: f"{values[i]:02d}:{values[i + 1]:02d}:{values[i + 2]:02d}"
+        if self.kind == FIELD_DAY:
+            return lambda values, i: WEEKDAYS.get(values[i], "unknown")
+        if self.kind == FIELD_TEMP:
+            return lambda values, i: str(values[i] / 10) if values[i] != NOT_CONNECTED else "not connected"
+        if self.kind == FIELD_ENUM:
+            def enum(values, i):
+                value = values[i] if mask is None else values[i] & mask
+                text = options.get(value)
+                return text if text is not None else f"unknown ({value})"
+            return enum
+        if self.kind == FIELD_STR:
+            return lambda values, i: str(values[i])
+        if mask is not None:
+            return lambda values, i: values[i] & mask
+        return lambda values, i: values[i]
+
+    def write_property(self) -> WritePropertyData:
+        """Returns the write property for this field"""
+        return WritePropertyData(self.name, self.address, min=self.min, max=self.max, options=self.write_options,
+            twobyte=(self.width == 2))
+
+
+class _DcbDecoder(object):
+    """A set of fields compiled into a single struct which decodes them in one pass"""
+
+    def __init__(self, fields: list):
+        slots = {}
+        layout = []
+        for field in sorted(fields, key=lambda field: field.index):
+            slot = (field.index, field.width, field.format)
+            if slot not in slots:
+                if layout and field.index < layout[-1][0] + layout[-1][1]:
+                    raise ValueError(f"DCB field '{field.name}' at {field.index} overlaps another field")
+                slots[slot] = None
+                layout.append(slot)
+        fmt = ">"
+        position = 0
+        end = 0
+        for slot in layout:
+            index, width, slot_format = slot
+            fmt += "x" * (index - end) + slot_format
+            slots[slot] = position
+            position += len(slot_format)
+            end = index + width
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        # read property name -> (converter, position of the field's first value in the unpacked tuple)
+        self.fields = {field.name: (field.convert, slots[(field.index, field.width, field.format)]) for field in fields}
+        # schedule day -> names of its fields in order, the other read property names
+        # and the (start, end) indexes of the parts of the DCB holding the schedule and the other properties
+        self.schedule = {}
+        self.schedule_names = frozenset(field.name for field in fields if field.schedule is not None)
+        self.other_names = [field.name for field in fields if field.schedule is None]
+        self.schedule_ranges = []
+        for field in sorted(fields, key=lambda field: field.index):
+            if field.schedule is None:
+                continue
+            self.schedule.setdefault(field.schedule, []).append(field.name)
+            if self.schedule_ranges and self.schedule_ranges[-1][1] == field.index:
+                self.schedule_ranges[-1] = (self.schedule_ranges[-1][0], field.index + field.width)
+            else:
+                self.schedule_ranges.append((field.index, field.index + field.width))
+        self.other_ranges = []
+        start = 0
+        for schedule_start, schedule_end in self.schedule_ranges + [(max((field.index + field.width for field in fields), default=0), None)]:
+            if schedule_start > start:
+                self.other_ranges.append((start, schedule_start))
+            start = schedule_end
+
+    def decode(self, buf, offset: int) -> "DcbProperties":
+        """Returns the read properties of the DCB starting at offset in buf, which are decoded as they are accessed"""
+        return DcbProperties(self, buf, offset)
+
+
+class DcbProperties(collections.abc.Mapping):
+    """
+    The read properties of a DCB, a read only mapping of property name to value backed by the frame it was read in
+    The frame is unpacked when a property is first accessed and each property is decoded (formatted) when it is
+    first accessed and then remembered, a new frame gets a new DcbProperties so nothing is ever invalidated
+    """
+
+    def __init__(self, decoder: _DcbDecoder, buf: bytes, offset: int):
+        """buf: the frame, which must not change (bytes or a memoryview of bytes)"""
+        self._decoder = decoder
+        self._buf = buf
+        self._offset = offset
+        self._values = None
+        self._decoded = {}
+
+    def _unpack(self) -> tuple:
+        if self._values is None:
+            self._values = self._decoder.struct.unpack_from(self._buf, self._offset)
+        return self._values
+
+    def _decode_all(self) -> dict:
+        """Decodes every property not yet decoded, returns them all"""
+        decoded = self._decoded
+        if len(decoded) < len(self._decoder.fields):
+            values = self._unpack()
+            for name, (convert, i) in self._decoder.fields.items():
+                if name not in decoded:
+                    decoded[name] = convert(values, i)
+        return decoded
+
+    def __getitem__(self, name: str):
+        value = self._decoded.get(name, _UNDECODED)
+        if value is _UNDECODED:
+            convert, i = self._decoder.fields[name]
+            value = convert(self._unpack(), i)
+            self._decoded[name] = value
+        return value
+
+    def __contains__(self, name) -> bool:
+        return name in self._decoder.fields
+
+    def __iter__(self):
+        return iter(self._decoder.fields)
+
+    def __len__(self) -> int:
+        return len(self._decoder.fields)
+
+    def keys(self):
+        return self._decoder.fields.keys()
+
+    def items(self):
+        return self._decode_all().items()
+
+    def values(self):
+        return self._decode_all().values()
+
+    def __repr__(self) -> str:
+        return repr(self._decode_all())
+
+    def schedule_days(self) -> dict:
+        """Returns the names of the schedule's properties as a dict of day to a list of them in order"""
+        return self._decoder.schedule
+
+    def schedule_names(self) -> frozenset:
+        """Returns the names of the properties which are part of the schedule (program)"""
+        return self._decoder.schedule_names
+
+    def other_items(self) -> list:
+        """Returns the properties which aren't part of the schedule as a list of (name, value)"""
+        return [(name, self[name]) for name in self._decoder.other_names]
+
+    def other_fingerprint(self) -> bytes:
+        """Returns the raw bytes of the properties which aren't part of the schedule, which only change when they do"""
+        buf = self._buf
+        offset = self._offset
+        return b"".join(buf[offset + start:offset + end] for start, end in self._decoder.other_ranges)
+
+    def schedule_fingerprint(self) -> bytes:
+        """Returns the raw bytes of the schedule, which only change when the schedule does, empty if there is none"""
+        buf = self._buf
+        offset = self._offset
+        return b"".join(buf[offset + start:offset + end] for start, end in self._decoder.schedule_ranges)
+
+    def schedule(self) -> dict:
+        """
+        Returns the schedule as a dict of day (e.g. Weekday, Mon or Mon Hot Water) to a list of its periods,
+        each [time, temperature] or [on time, off time]
+        """
+        return {day: [[self[names[n]], self[names[n + 1]]] for n in range(0, len(names), 2)]
+            for day, names in self._decoder.schedule.items()}
+
+
+# The read properties of a thermostat which hasn't been read
+NO_PROPERTIES = DcbProperties(_DcbDecoder([]), b"", 0)
+
+
+class DcbLayout(object):
+    """
+    The DCB layout of a thermostat model
+    fields: the fields always present
+    mode_index: index of the program mode (timer mode) byte or None
+    modes: dict of program mode value to the extra fields present in that mode (e.g. the 7 day program)
+    hot_fields: names of the first and last fields of the frequently changing part of the DCB
+        which can be read on its own, their unique addresses must be contiguous
+    """
+
+    def __init__(self, fields: list, mode_index: int = None, modes: dict = None, hot_fields: tuple = None):
+        self.fields = fields
+        self.mode_index = mode_index
+        self.modes = modes if modes is not None else {}
+        self._decoders = {mode: _DcbDecoder(fields + extra) for mode, extra in self.modes.items()}
+        self._decoders[None] = _DcbDecoder(fields)
+        self._by_name = {field.name: field for field in fields}
+        for extra in self.modes.values():
+            self._by_name.update({field.name: field for field in extra})
+        # (unique address, index, length) of the partial read of the hot fields
+        self.hot_read = None
+        if hot_fields is not None:
+            first = self._by_name[hot_fields[0]]
+            last = self._by_name[hot_fields[1]]
+            length = last.index + last.width - first.index
+            if last.address + last.width - first.address != length:
+                raise ValueError(f"DCB hot fields '{first.name}' to '{last.name}' do not have contiguous addresses")
+            self.hot_read = (first.address, first.index, length)
+
+    def field(self, name: str) -> DcbField:
+        """Returns the field called name or None"""
+        return self._by_name.get(name)
+
+    def decode(self, buf, offset: int, length: int) -> dict:
+        """
+        Decodes the DCB of length bytes starting at offset in buf, which must not change
+        Returns the read properties as a DcbProperties (a read only mapping) or None if the DCB is too short for the layout
+        """
+        mode = None
+        if self.mode_index is not None and self.mode_index < length:
+            mode = buf[offset + self.mode_index]
+        decoder = self._decoders.get(mode, self._decoders[None])
+        if length < decoder.size:
+            return None
+        return decoder.decode(buf, offset)
+
+    def write_properties(self) -> dict:
+        """Returns a dict of WritePropertyData for all the writeable fields"""
+        return {field.write: field.write_property() for field in self._by_name.values() if field.write is not None}
+
+
+def time_temp_fields(name: str, index: int, address: int) -> list:
+    """Returns the fields of a day's comfort levels, 4 periods of hour, minute and temperature (12 bytes)"""
+    fields = []
+    for period in PERIODS:
+        fields.append(DcbField(f"{name} {period} Time", index, 2, address, kind=FIELD_TIME, group=name, schedule=name))
+        fields.append(DcbField(f"{name} {period} Temp", index + 2, address=address + 2, group=name, schedule=name))
+        index += 3
+        address += 3
+    return fields
+
+
+def time_on_off_fields(name: str, index: int, address: int) -> list:
+    """Returns the fields of a day's timer, 4 periods of on and off hour and minute (16 bytes)"""
+    fields = []
+    for time_slot in range(1, 5):
+        fields.append(DcbField(f"{name} Time{time_slot} On", index, 2, address, kind=FIELD_TIME, group=name, schedule=name))
+        fields.append(DcbField(f"{name} Time{time_slot} Off", index + 2, 2, address + 2, kind=FIELD_TIME, group=name,
+            schedule=name))
+        index += 4
+        address += 4
+    return fields
+
+
+def seven_day_fields(field_function, index: int, address: int, size: int, suffix: str = "") -> list:
+    """Returns the fields of a 7 day program, one block of size bytes per day starting on Monday"""
+    fields = []
+    for day in WEEKDAYS.values():
+        fields += field_function(f"{day}{suffix}", index, address)
+        index += size
+        address += size
+    return fields
@@ -0,0 +1,154 @@
+"""Module to find the thermostats on a network and remember them between restarts"""
+import json
+import logging
+import queue
+import threading
+from heatmiserThermostat import HeatmiserThermostat
+from busTransaction import PRIORITY_DISCOVERY
+
+# Where the thermostats found on each network are remembered, /data is persistent storage for an add-on
+DISCOVERY_CACHE = "/data/discovery.json"
+# Time in seconds the bus must have been idle before a background probe is sent
+IDLE_TIME = 1
+# Minimum time in seconds between background probes once every unknown address has been probed once
+REDISCOVERY_INTERVAL = 5
+# Time in seconds after which a thermostat which has stopped replying is removed
+RETIRE_TIME = 24 * 60 * 60
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class DiscoveryCache(object):
+    """
+    The thermostats found on each network, saved as json
+    {network name: {address: model}}
+    Shared by the networks, which update it from their own threads
+    """
+
+    def __init__(self, path: str = DISCOVERY_CACHE):
+        self._path = path
+        self._networks = {}
+        self._lock = threading.Lock()
+        if not path:
+            return
+        try:
+            with open(path) as file:
+                self._networks = json.load(file)
+        except FileNotFoundError:
+            _LOGGER.info(f"No discovery cache at {path}, all addresses will be scanned")
+        except (OSError, ValueError) as ex:
+            _LOGGER.error(f"Unable to load discovery cache {path}: {ex}")
+
+    def thermostats(self, network: str) -> dict:
+        """Returns a dict of address to model of the thermostats last known on network"""
+        return {int(address): model for address, model in self._networks.get(network, {}).items()}
+
+    def update(self, network: str, thermostats: dict):
+        """Saves the thermostats (a dict of address to model) on network if they have changed"""
+        network_thermostats = {str(address): model for address, model in sorted(thermostats.items())}
+        with self._lock:
+            if self._networks.get(network) == network_thermostats:
+                return
+            self._networks[network] = network_thermostats
+            if not self._path:
+                return
+            try:
+                with open(self._path, "w") as file:
+                    json.dump(self._networks, file, indent=2)
+            except OSError as ex:
+                _LOGGER.error(f"Unable to save discovery cache {self._path}: {ex}")
+
+
+def scan(hub, addresses) -> dict:
+    """
+    Probes each address on the hub's network
+    Returns a dict of address to the result of HeatmiserThermostat.probe() for the thermostats found
+    """
+    found = {}
+    for address in addresses:
+        _LOGGER.info(f"Scanning {hub.name()} address {address}")
+        model, frame = HeatmiserThermostat.probe(hub, address)
+        if model is not False:
+            _LOGGER.info(f"Found {model} at address {address}")
+            found[address] = (model, frame)
+    return found
+
+
+class BackgroundDiscovery(object):
+    """
+    Repeatedly probes the addresses without a known thermostat on a thread, one address each time the bus is idle,
+    so thermostats added to the network are found without delaying the polling of the known thermostats
+    The first pass over the addresses is made as quickly as the idle bus allows, later passes are rate limited
+    Each thermostat found is queued as (address, model, frame) for the main loop to collect with found()
+    """
+
+    def __init__(self, hub, addresses, known):
+        """
+        addresses: the addresses which may have a thermostat
+        known: the addresses of the thermostats already known, which are not probed
+        """
+        self._hub = hub
+        self._addresses = list(addresses)
+        self._known = set(known)
+        self._lock = threading.Lock()
+        self._found = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"discovery-{hub.name()}", daemon=True)
+
+    def start(self):
+        """Starts probing"""
+        self._thread.start()
+
+    def stop(self):
+        """Stops probing once the probe in progress is complete (or abandoned by the hub stopping)"""
+        self._stopped.set()
+
+    def forget(self, address: int):
+        """Removes address from the known addresses so it is probed again (the thermostat has been retired)"""
+        with self._lock:
+            self._known.discard(address)
+
+    def _unknown(self, address: int) -> bool:
+        with self._lock:
+            return address not in self._known
+
+    def _wait_for_idle_bus(self, interval: float) -> bool:
+        """Waits at least interval seconds and until the bus is idle, returns False if stopped"""
+        if self._stopped.wait(interval):
+            return False
+        while self._hub.idle_time() < IDLE_TIME:
+            if self._stopped.wait(IDLE_TIME / 4):
+                return False
+        return True
+
+    def _run(self):
+        """Discovery thread, probes each unknown address in turn until stopped"""
+        interval = 0
+        while not self._stopped.is_set():
+            for address in self._addresses:
+                if not self._unknown(address):
+                    continue
+                if not self._wait_for_idle_bus(interval):
+                    return
+                # the address may have become known while waiting
+                if not self._unknown(address):
+                    continue
+                model, frame = HeatmiserThermostat.probe(self._hub, address, priority=PRIORITY_DISCOVERY)
+                if model is not False:
+                    _LOGGER.info(f"Found {model} at address {address} on {self._hub.name()}")
+                    with self._lock:
+                        self._known.add(address)
+                    self._found.put((address, model, frame))
+            if interval == 0:
+                _LOGGER.info(f"Background scan of {self._hub.name()} complete, rescanning every {REDISCOVERY_INTERVAL}s per address")
+            interval = REDISCOVERY_INTERVAL
+            # don't spin when every address is known
+            if self._stopped.wait(REDISCOVERY_INTERVAL):
+                return
+
+    def found(self) -> list:
+        """Returns the thermostats found since the last call as a list of (address, model, frame)"""
+        found = []
+        while not self._found.empty():
+            found.append(self._found.get_nowait())
+        return found
@@ -1,18 +1,57 @@
 """This module contains all the requirements to communicate with a serial port or tcp connection
 on which Heatmiser thermostats reside"""
 import serial
-import time
 import logging
-from heatmiserThermostat import HeatmiserThermostat
+import queue
+import threading
+import time
+from heatmiserThermostat import HeatmiserThermostat, FUNC_READ, RW_MASTER_ADDRESS
+from busTransaction import BusTransaction, PRIORITY_POLL, PRIORITY_WRITE, PRIORITY_DISCOVERY
+from crc16 import crc16_verify
+from metrics import METRICS
+
+BAUD_RATE = 4800
+# 1 start bit, 8 data bits and 1 stop bit per byte
+BYTE_TIME = 10 / BAUD_RATE
+# Maximum time allowed for a thermostat to start replying
+RESPONSE_TIMEOUT = 3
+# Timeout used when probing addresses for thermostats until replies have been timed
+PROBE_TIMEOUT = 0.5
+# The learned probe timeout is PROBE_TIMEOUT_FACTOR times the slowest reply seen, but at least PROBE_TIMEOUT_MIN
+PROBE_TIMEOUT_MIN = 0.1
+PROBE_TIMEOUT_FACTOR = 3
+# Once a reply has started the bytes arrive back to back, the time allowed on top of their transmission time
+# for usb adapter latency, so a reply cut short (e.g. by a thermostat losing power) is given up on straight away
+INTER_BYTE_TIMEOUT = 20 * BYTE_TIME
+# Destination address and 2 byte frame length
+HEADER_LENGTH = 3
+# A write reply is 7 bytes, the longest reply is a PRTHW in 7 day mode (293 byte DCB + 11)
+MIN_FRAME_LENGTH = 7
+MAX_FRAME_LENGTH = 304
+# Quiet time allowed after a bad frame for any late bytes to arrive before they are discarded
+INTER_FRAME_GAP = 50 * BYTE_TIME
+# Number of times a message is resent after a corrupt reply
+FRAME_RETRIES = 2
+# Number of consecutive failed transactions after which the port is closed and reopened
+REOPEN_FAILURES = 10
 
 logging.basicConfig(level=logging.ERROR)
 _LOGGER = logging.getLogger(__name__)
 
+_TRANSACTION_TIME = METRICS.histogram("heatmiser_transaction_seconds",
+    "Time from sending a message to receiving its valid reply, including any resends", ("network", "thermostat", "function"))
+# error is crc (bad CRC), short (incomplete frame), stale (a valid reply to another message) or no_reply
+# (a thermostat, not a probed address, didn't reply)
+_FRAME_ERRORS = METRICS.counter("heatmiser_frame_errors_total", "Corrupt or missing replies", ("network", "error"))
+_REOPENS = METRICS.counter("heatmiser_reopens_total", "Times the serial port or tcp connection was closed to be reopened", ("network",))
+
 class HeatmiserHub(object):
     """
     Represents the Heatmiser UH1 RS485 controller (hub) that holds the serial (or tcp)
     connection
     Stores all registered HeatmiserThermostats on the network
+    The serial port is owned by a single worker thread which runs transactions from a priority queue
+    so writes requested by users are sent before background polling
     """
 
     def __init__(self, device_or_ipaddress, name: str):
@@ -24,8 +63,70 @@ class HeatmiserHub(object):
         self._name = name
         self.thermostats = {}
         self._serport = None
+        self._failures = 0
+        # slowest time seen between sending a message and receiving the start of its reply
+        self._reply_time = 0
+        # when the bus was last used for anything other than discovery and whether it is in use now
+        self._last_used = time.monotonic()
+        self._in_use = False
         self._init_serial()
-        self._busy = False
+        self._queue = queue.PriorityQueue()
+        self._stopped = False
+        self._worker = threading.Thread(target=self._run, name=f"bus-{name}", daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        """Bus worker thread, runs queued transactions one at a time until stopped"""
+        while True:
+            transaction = self._queue.get()
+            if transaction.function is None:
+                break
+            if transaction.priority < PRIORITY_DISCOVERY:
+                self._in_use = True
+                transaction.run()
+                self._in_use = False
+                self._last_used = time.monotonic()
+            else:
+                transaction.run()
+        _LOGGER.debug(f"Bus worker for {self._device_or_ipaddress} stopped")
+
+    def submit(self, function, *args, priority: int = PRIORITY_POLL):
+        """
+        Queues function(*args) to be run by the bus worker thread
+        Returns a Future which will hold the result of the function
+        """
+        transaction = BusTransaction(priority, function, *args)
+        if self._stopped:
+            transaction.future.set_result(False)
+        else:
+            self._queue.put(transaction)
+        return transaction.future
+
+    def idle_time(self) -> float:
+        """
+        Returns the time in seconds since the bus was last used for anything other than discovery
+        or 0 if it is in use or transactions are waiting
+        """
+        if self._in_use or not self._queue.empty():
+            return 0
+        return time.monotonic() - self._last_used
+
+    def stop(self):
+        """
+        Stops the bus worker thread once the transaction in progress is complete and closes the port
+        Any transactions still queued return False
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        # the stop request jumps ahead of everything else in the queue
+        self._queue.put(BusTransaction(PRIORITY_WRITE - 1, None))
+        self._worker.join()
+        while not self._queue.empty():
+            transaction = self._queue.get_nowait()
+            if transaction.future.set_running_or_notify_cancel():
+                transaction.future.set_result(False)
+        self._close()
     
     def _init_serial(self):
         """
@@ -50,7 +151,7 @@ class HeatmiserHub(object):
             self._serport.bytesize = serial.EIGHTBITS
             self._serport.parity = serial.PARITY_NONE
             self._serport.stopbits = serial.STOPBITS_ONE
-            self._serport.timeout = 3
+            self._serport.timeout = RESPONSE_TIMEOUT
             self._serport.open()
             _LOGGER.info(f"Serial device {self._device_or_ipaddress} opened")
             return True
@@ -60,11 +161,96 @@ class HeatmiserHub(object):
             self._serport = None
             return False
 
-    def send_msg(self, message : list):
+    def send_msg(self, message : list, priority: int = PRIORITY_POLL, response_timeout: float = RESPONSE_TIMEOUT):
         """
         Sends a message to the thermostat and returns the data as a list of bytes
+        The message is queued for the bus worker and this call blocks until the transaction is complete
         Attempts to reopen the serial port if it is not open
         If there are any errors or no reply an empty list is returned
+        response_timeout: time allowed for the thermostat to start replying, see probe_timeout()
+        Returns the response as a List, empty list if no response or False if error
+        """
+        return self.submit(self._transact, message, response_timeout, priority=priority).result()
+
+    def probe_timeout(self) -> float:
+        """
+        Returns the response timeout to use when probing an address which may not have a thermostat
+        Learned from the slowest reply seen so an empty address costs a fraction of RESPONSE_TIMEOUT
+        """
+        if self._reply_time == 0:
+            return PROBE_TIMEOUT
+        return min(RESPONSE_TIMEOUT, max(PROBE_TIMEOUT_MIN, PROBE_TIMEOUT_FACTOR * self._reply_time))
+
+    def _transact(self, message : list, response_timeout: float = RESPONSE_TIMEOUT):
+        """
+        Sends message and reads the reply, only to be called from the bus worker
+        A corrupt reply (too short or a bad CRC) is discarded and the message resent, up to FRAME_RETRIES times
+        A valid reply to another message (a late reply to an earlier one) is skipped and the next frame read as
+        the reply is most likely following it
+        The port is only closed (and reopened by the next transaction) after REOPEN_FAILURES consecutive
+        failed transactions
+        A probe (a response_timeout shorter than RESPONSE_TIMEOUT) of an empty address is not a failure
+        Returns the response as a List, empty list if no valid response or False if error
+        """
+        start = time.monotonic()
+        for attempt in range(FRAME_RETRIES + 1):
+            datalist = self._exchange(message, response_timeout)
+            if datalist and len(datalist) >= MIN_FRAME_LENGTH and crc16_verify(datalist) and not self._is_reply(message, datalist):
+                _FRAME_ERRORS.inc(self._name, "stale")
+                _LOGGER.warning(f"Skipping a reply from {datalist[3]} on {self._device_or_ipaddress} which is not for this message")
+                datalist = self._receive(response_timeout)
+            if datalist is False:
+                return False
+            if len(datalist) == 0:
+                # no reply, resending is unlikely to help
+                break
+            if len(datalist) >= MIN_FRAME_LENGTH and crc16_verify(datalist) and self._is_reply(message, datalist):
+                self._failures = 0
+                if response_timeout >= RESPONSE_TIMEOUT:
+                    # probes are not timed, they would add a series for each address probed
+                    _TRANSACTION_TIME.observe(time.monotonic() - start, self._name, self._thermostat_label(message[0]),
+                        "read" if message[3] == FUNC_READ else "write")
+                return datalist
+            if len(datalist) < MIN_FRAME_LENGTH or not crc16_verify(datalist):
+                _FRAME_ERRORS.inc(self._name, "short" if len(datalist) < MIN_FRAME_LENGTH else "crc")
+                _LOGGER.warning(f"Corrupt reply from {self._device_or_ipaddress} ({len(datalist)} bytes), resynchronising (attempt {attempt + 1})")
+            else:
+                _FRAME_ERRORS.inc(self._name, "stale")
+                _LOGGER.warning(f"Another stale reply from {datalist[3]} on {self._device_or_ipaddress}, resynchronising (attempt {attempt + 1})")
+            self._resync()
+        if len(datalist) == 0 and response_timeout < RESPONSE_TIMEOUT:
+            return datalist
+        if len(datalist) == 0:
+            _FRAME_ERRORS.inc(self._name, "no_reply")
+        self._failures += 1
+        if self._failures >= REOPEN_FAILURES:
+            _LOGGER.error(f"{self._failures} consecutive failed transactions on {self._device_or_ipaddress}, reopening")
+            _REOPENS.inc(self._name)
+            self._failures = 0
+            self._close()
+        return []
+
+    @staticmethod
+    def _is_reply(message: list, datalist: list) -> bool:
+        """Returns True if the valid frame datalist is the reply to message, from its address for its function and start"""
+        if datalist[3] != message[0] or datalist[4] != message[3]:
+            return False
+        return message[3] != FUNC_READ or (len(datalist) > 6 and datalist[5:7] == message[4:6])
+
+    def _thermostat_label(self, address: int) -> str:
+        """Returns the name of the thermostat at address for labelling metrics, or its address if it isn't registered"""
+        thermostat = self.thermostats.get(address)
+        return thermostat.name if thermostat is not None else str(address)
+
+    def _resync(self):
+        """Waits for the bus to go quiet and then discards anything received"""
+        if self._serport is not None and self._serport.is_open:
+            time.sleep(INTER_FRAME_GAP)
+            self._serport.reset_input_buffer()
+
+    def _exchange(self, message : list, response_timeout: float = RESPONSE_TIMEOUT):
+        """
+        Writes message to the serial port and reads the reply
         Returns the response as a List, empty list if no response or False if error
         """
         datalist = []
@@ -77,44 +263,47 @@ class HeatmiserHub(object):
             if self._serport.is_open:
                 # All should be good to communicate via the serial port
                 try:
-                    sleep_count = 0
-                    while self._busy:
-                        _LOGGER.debug(f"Sleeping {sleep_count}...")
-                        time.sleep(0.5)
-                        sleep_count +=1
+                    stale = self._serport.in_waiting
+                    if stale:
+                        # late bytes from a previous reply would corrupt this one
+                        _LOGGER.warning(f"Discarding {stale} stale bytes from {self._device_or_ipaddress}")
+                        self._serport.reset_input_buffer()
                     _LOGGER.debug(f"Sending {message}")
                     serial_message = bytes(message)
-                    self._busy = True
                     self._serport.write(serial_message)  # Write a string
 
                 except serial.SerialException as se:
                     _LOGGER.error(f"Error writing to {self._device_or_ipaddress}: {se}")
                     self._serport.close()
                     self._serport = None
-                    self._busy = False
                     return datalist
 
                 except serial.SerialTimeoutException:
                     _LOGGER.error(f"Timeout writing to {self._device_or_ipaddress}")
-                    self._busy = False
                     return datalist
                 
                 # write went well so
                 # now wait for reply
-                try:
-                    # NB max return is 75 in 5/2 mode or 159 in 7day mode
-                    _LOGGER.debug(f"Reading serial port {self._device_or_ipaddress}")
-                    byteread = self._serport.read(159)
-                    datalist = list(byteread)
-
-                except serial.SerialException as se:
-                    _LOGGER.error(f"Unable to read serial port {self._device_or_ipaddress}: {se}")
-                    self._serport.close()
-                    self._serport = None
-                self._busy = False
+                return self._receive(response_timeout)
             else:
                 _LOGGER.debug(f"Serial port {self._device_or_ipaddress} has been created but is not open, resetting...")
                 self._serport = None
+        return datalist
+
+    def _receive(self, response_timeout: float = RESPONSE_TIMEOUT) -> list:
+        """
+        Reads the next reply from the serial port
+        Returns the response as a List, empty list if no response
+        """
+        datalist = []
+        try:
+            _LOGGER.debug(f"Reading serial port {self._device_or_ipaddress}")
+            datalist = self._read_frame(response_timeout)
+
+        except serial.SerialException as se:
+            _LOGGER.error(f"Unable to read serial port {self._device_or_ipaddress}: {se}")
+            self._serport.close()
+            self._serport = None
 
         if len(datalist) < 1:
             _LOGGER.debug(f"No response from {self._device_or_ipaddress}")
@@ -122,12 +311,69 @@ class HeatmiserHub(object):
             _LOGGER.debug(f"Received from {self._device_or_ipaddress}: {datalist}")
         return datalist
 
+    def _read_frame(self, response_timeout: float = RESPONSE_TIMEOUT) -> list:
+        """
+        Reads a single reply frame from the serial port
+        The first byte is awaited for up to response_timeout and any bytes before the master address, which starts
+        every reply, are skipped (late bytes of an earlier reply), then the rest of the header to obtain the frame length
+        (bytes 1 and 2, low byte first) and then exactly the rest of the frame is read so there is no wait for a timeout
+        Once the reply has started each read only waits as long as its bytes take to arrive, pyserial's
+        inter_byte_timeout can't be used as it is ignored by tcp connections and by serial ports on posix
+        Returns the frame as a list, which will be short if the reply was incomplete
+        """
+        start = time.monotonic()
+        header = self._read(1, response_timeout)
+        if len(header) == 0:
+            return []
+        skipped = bytearray()
+        while header[0] != RW_MASTER_ADDRESS:
+            skipped += header
+            # the reply may still be to come after the late bytes
+            header = self._read(1, max(start + response_timeout - time.monotonic(), BYTE_TIME + INTER_BYTE_TIMEOUT))
+            if len(header) == 0 or len(skipped) >= MAX_FRAME_LENGTH:
+                _LOGGER.warning(f"No reply in {len(skipped)} bytes received from {self._device_or_ipaddress}")
+                return list(skipped)
+        if len(skipped) > 0:
+            _LOGGER.warning(f"Skipped {len(skipped)} bytes before the reply from {self._device_or_ipaddress}")
+        self._reply_time = max(self._reply_time, time.monotonic() - start)
+        header += self._read(HEADER_LENGTH - 1)
+        if len(header) < HEADER_LENGTH:
+            return list(header)
+        frame_length = (header[2] << 8) | header[1]
+        if frame_length < MIN_FRAME_LENGTH or frame_length > MAX_FRAME_LENGTH:
+            _LOGGER.error(f"Invalid frame length {frame_length} received from {self._device_or_ipaddress}, discarding input")
+            self._serport.reset_input_buffer()
+            return list(header)
+        body = self._read(frame_length - HEADER_LENGTH)
+        return list(header + body)
+
+    def _read(self, size: int, timeout: float = None) -> bytes:
+        """
+        Reads up to size bytes from the serial port, waiting at most timeout seconds
+        or by default as long as the bytes take to arrive at the baud rate
+        """
+        if timeout is None:
+            timeout = size * BYTE_TIME + INTER_BYTE_TIMEOUT
+        if self._serport.timeout != timeout:
+            self._serport.timeout = timeout
+        return self._serport.read(size)
+
     def name(self) -> str:
         """Returns the name of the hub"""
         return self._name
 
     def disconnect(self):
-        """disconnects from the serial port or tcp connection"""
+        """
+        disconnects from the serial port or tcp connection
+        The port is closed by the bus worker so that it is never closed part way through a transaction
+        """
+        if threading.current_thread() is self._worker or self._stopped:
+            self._close()
+        else:
+            self.submit(self._close, priority=PRIORITY_WRITE).result()
+
+    def _close(self):
+        """Closes the serial port or tcp connection"""
         if self._serport is not None:
             self._serport.close()
             self._serport = None
@@ -135,7 +381,7 @@ class HeatmiserHub(object):
 
     def __del__(self):
         """Destructor"""
-        self.disconnect()
+        self._close()
         
     def registerThermostat(self, thermostat):
         """
@@ -152,5 +398,11 @@ class HeatmiserHub(object):
         except Exception as e:
             raise Exception(f"Unable to register thermostat as is it not a Heatmiser Object: {e}")
 
+    def unregisterThermostat(self, thermostat):
+        """Removes a registered thermostat from the hub"""
+        self.thermostats.pop(thermostat.address, None)
+        for function in ("read", "write"):
+            _TRANSACTION_TIME.remove(self._name, thermostat.name, function)
+
     def listThermostats(self):
         return self.thermostats
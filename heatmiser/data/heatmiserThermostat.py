@@ -1,13 +1,36 @@
 import logging
+import re
+import threading
+import time
 from writepropertydata import WritePropertyData
+from dcbLayout import DcbLayout, DcbField, NO_PROPERTIES, WEEKDAYS, FIELD_TIME, FIELD_STR, FIELD_TEMP, FIELD_DAY, FIELD_CLOCK, GROUP_CLOCK, \
+    time_temp_fields, time_on_off_fields, seven_day_fields
 from utils import check_param
-from crc16 import CRC16, BYTEMASK
+from crc16 import crc16, crc16_verify, BYTEMASK
+from busTransaction import PRIORITY_POLL, PRIORITY_READ, PRIORITY_WRITE
 
 HMV3_ID = 3
 FUNC_READ = 0
 FUNC_WRITE = 1
 RW_LENGTH_ALL = 0xffff
 RW_MASTER_ADDRESS = 0x81
+# Number of reads of only the fast changing part of the DCB between reads of the whole DCB
+FULL_READ_INTERVAL = 10
+# Number of consecutive failed reads after which a thermostat is treated as offline
+OFFLINE_FAILURES = 3
+# Interval in seconds between reads of an offline thermostat, doubled after each further failure up to the maximum
+OFFLINE_RETRY_INTERVAL = 60
+OFFLINE_RETRY_INTERVAL_MAX = 960
+# Maximum age in seconds of the last read (or write) of a value for it to be trusted to skip writing it again
+UNCHANGED_MAX_AGE = 60
+# Limits of a schedule's temperatures and the time of an unused period
+SCHEDULE_MIN_TEMP = 5
+SCHEDULE_MAX_TEMP = 35
+UNUSED_TIME = "24:00"
+# Seconds in a week, the thermostats' clocks only have the day of the week
+WEEK = 7 * 24 * 3600
+# Lowest firmware version whose clock can be set, V19 does not support it
+MIN_CLOCK_VERSION = 20
 DCB_OFFSET = 9
 HEATMISER = 'heatmiser'
 
@@ -23,7 +46,7 @@ class HeatmiserThermostat(object):
     Allows changing of writeable properties
     """
 
-    WEEKDAYS = {1:"Mon", 2:"Tue", 3:"Wed", 4:"Thu", 5:"Fri", 6:"Sat", 7:"Sun"}
+    WEEKDAYS = WEEKDAYS
     PRT = "PRT"
     PRT_E = "PRT-E"
     DT = "DT"
@@ -32,12 +55,128 @@ class HeatmiserThermostat(object):
     TM1 = "TM1"
     HC_EN = "HC-EN"
     MODELS = {0: DT, 1: DT_E, 2: PRT, 3: PRT_E, 4: PRTHW, 5: TM1, 7: HC_EN}
-    read_properties = {}
-    write_properties = {}
 
-
-    def __init__(self, address: int, model: str, hub, name: str = ""):
+    # DCB layouts from the V3 protocol (docs/heatmiser_v3_protocol_3.9.pdf)
+    # DcbField(name, index in the DCB as read, width, unique address used to write it, ...)
+    _VENDOR_FIELDS = [
+        DcbField("Vendor", 2, options={0: "Heatmiser", 1: "OEM"}),
+        DcbField("Version", 3, mask=0x7F),
+    ]
+    # DT, DT-E, PRT, PRT-E and PRTHW share the first 36 bytes of their DCB
+    _THERMOSTAT_FIELDS = _VENDOR_FIELDS + [
+        DcbField("Floor limiting", 3, mask=0x80, options={0: "Off", 0x80: "On"}), # bit 7
+        DcbField("Type", 4, options=MODELS),
+        DcbField("Units", 5, options={0: "°C", 1: "°F"}),
+        DcbField("Differential", 6),
+        DcbField("Frost Protection", 7, options={0: "Not active", 1: "Active"}),
+        DcbField("Calibration Offset", 8, 2),
+        DcbField("Bus Address", 11, kind=FIELD_STR),
+        DcbField("Sensor Type", 13, options={0: "Built in", 1: "Remote", 2: "Floor", 3: "Built in + Floor", 4: "Remote + Floor"}),
+        DcbField("Optimum Start", 14),
+        DcbField("Rate of Change", 15),
+        DcbField("Timer Mode", 16, options={0: "wk-day/wk-end", 1: "7 day"}),
+        DcbField("Frost Protect Temp", 17, write="frost_protect_temp", min=7, max=17),
+        DcbField("Room Target Temp", 18, write="room_target_temp", min=5, max=35),
+        DcbField("Floor Max Temp", 19, write="floor_max_temp", min=20, max=45),
+        DcbField("Floor Max limit", 20, options={0: "disabled", 1: "enabled"}),
+        DcbField("Display State", 21, options={0: "off", 1: "on"}, write="display_state"),
+        DcbField("Key", 22, options={0: "unlocked", 1: "locked"}, write="key"),
+        DcbField("Run Mode", 23, options={0: "heating", 1: "frost protect"}, write="run_mode"),
+        # Holiday Hours max, 2385 is 99 (+4) hours. Thermostat seems to add 4 hours...
+        DcbField("Holiday Hours", 24, 2, write="holiday_hours", min=0, max=2385),
+        # Temp Hold Minutes max, 5970 is 99:30
+        DcbField("Temp Hold Minutes", 26, 2, 32, write="temp_hold_minutes", min=0, max=5970),
+        DcbField("Remote Sensor Temp", 28, 2, 34, kind=FIELD_TEMP),
+        DcbField("Floor Sensor Temp", 30, 2, 36, kind=FIELD_TEMP),
+        DcbField("Built-in Sensor Temp", 32, 2, 38, kind=FIELD_TEMP),
+        DcbField("Error", 34, address=40, options={0: "none", 0xE0: "built-in sensor", 0xE1: "floor sensor", 0xE2: "remote sensor"}),
+        DcbField("Heating State", 35, address=41, options={0: "no heat", 1: "heat"}),
+    ]
+    _PRT_FIELDS = _THERMOSTAT_FIELDS + [
+        DcbField("Current Day", 36, address=43, kind=FIELD_DAY, group=GROUP_CLOCK),
+        DcbField("Current Time", 37, 3, 44, kind=FIELD_CLOCK, group=GROUP_CLOCK),
+    ] + time_temp_fields("Weekday", 40, 47) + time_temp_fields("Weekend", 52, 59)
+    # PRTHW only has a built in sensor
+    _PRTHW_FIELDS = [field if field.name != "Sensor Type" else DcbField("Sensor Type", 13, options={0: "Built in"})
+        for field in _THERMOSTAT_FIELDS] + [
+        DcbField("Hot Water State", 36, address=42, options={0: "off", 1: "on"},
+            write="hot_water_state", write_options={"program": 0, "on": 1, "off": 2}),
+        DcbField("Current Day", 37, address=43, kind=FIELD_DAY, group=GROUP_CLOCK),
+        DcbField("Current Time", 38, 3, 44, kind=FIELD_CLOCK, group=GROUP_CLOCK),
+    ] + time_temp_fields("Weekday", 41, 47) + time_temp_fields("Weekend", 53, 59) \
+        + time_on_off_fields("Weekday Hot Water", 65, 71) + time_on_off_fields("Weekend Hot Water", 81, 87)
+    _TM1_FIELDS = _VENDOR_FIELDS + [
+        DcbField("Type", 4, options=MODELS),
+        DcbField("Bus Address", 5, address=11, kind=FIELD_STR),
+        DcbField("Timer Mode", 6, address=16, options={0: "wk-day/wk-end", 1: "7 day", 2: "countdown"}),
+        DcbField("Display State", 8, address=21, options={0: "off", 1: "on"}, write="display_state"),
+        DcbField("Key", 9, address=22, options={0: "unlocked", 1: "locked"}, write="key"),
+        DcbField("Holiday Hours", 10, 2, 24, write="holiday_hours", min=0, max=2385),
+        DcbField("Countdown Minutes", 12, 2, 26, write="countdown_minutes", min=0, max=1800),
+        DcbField("Timer State", 14, address=42, options={0: "off", 1: "on"},
+            write="timer_state", write_options={"program": 0, "on": 1, "off": 2}),
+        DcbField("Current Day", 15, address=43, kind=FIELD_DAY, group=GROUP_CLOCK),
+        DcbField("Current Time", 16, 3, 44, kind=FIELD_CLOCK, group=GROUP_CLOCK),
+    ]
+    _TM1_TIMER_FIELDS = time_on_off_fields("Weekday", 19, 71) + time_on_off_fields("Weekend", 35, 87)
+    _HC_EN_FIELDS = _VENDOR_FIELDS + [
+        DcbField("Type", 4, options=MODELS),
+        DcbField("Units", 5, options={0: "°C", 1: "°F"}),
+        DcbField("Bus Address", 6, address=11, kind=FIELD_STR),
+        DcbField("Humidity Sensor Address", 7, kind=FIELD_STR),
+        DcbField("Sensor Type", 9, address=13, options={0: "Built in", 1: "Remote", 2: "Floor", 3: "Built in + Floor", 4: "Remote + Floor"}),
+        DcbField("Optimum Start", 10, address=14),
+        DcbField("Frost Protection", 11, address=7, options={0: "Not active", 1: "Active"}),
+        DcbField("Timer Mode", 12, address=16, options={0: "wk-day/wk-end", 1: "7 day"}),
+        DcbField("Cooling", 13, address=29, options={0: "disabled", 1: "enabled"}),
+        DcbField("Dew Point Differential", 14),
+        DcbField("Dew Point Time Limit", 15),
+        DcbField("Calibration Offset", 16, 2, 8),
+        DcbField("Holiday Hours", 18, 2, 24, write="holiday_hours", min=0, max=2385),
+        DcbField("Output Delay", 20, address=10),
+        DcbField("Differential", 21, address=6),
+        DcbField("Floor Max Temp", 22),
+        DcbField("Floor Min Temp", 23),
+        DcbField("Cooling Target Temp", 24, address=27),
+        DcbField("Frost Protect Temp", 25, address=17, write="frost_protect_temp", min=7, max=17),
+        DcbField("Rate of Change", 26, address=15),
+        DcbField("Display State", 27, address=21, options={0: "off", 1: "on"}, write="display_state"),
+        DcbField("Run Mode", 28, address=23, options={0: "heating", 1: "frost protect", 2: "cooling"}, write="run_mode"),
+        DcbField("Key", 29, address=22, options={0: "unlocked", 1: "locked"}, write="key"),
+        DcbField("Temp Hold Minutes", 30, 2, 32, write="temp_hold_minutes", min=0, max=5970),
+        # the built in or remote air sensor, whichever is selected
+        DcbField("Built-in Sensor Temp", 32, 2, 38, kind=FIELD_TEMP),
+        DcbField("Floor Sensor Temp", 34, 2, 36, kind=FIELD_TEMP),
+        DcbField("Humidity", 36, address=30),
+        DcbField("Dew Point Temp", 37, address=28),
+        DcbField("Heating State", 38, address=41, mask=0x01, options={0: "no heat", 1: "heat"}),
+        DcbField("Cooling State", 38, address=41, mask=0x10, options={0: "no cool", 0x10: "cool"}),
+        DcbField("Room Target Temp", 39, address=18, write="room_target_temp", min=5, max=35),
+        DcbField("Error", 40, options={0: "none", 0xE0: "built-in sensor", 0xE1: "floor sensor", 0xE2: "remote sensor"}),
+        DcbField("Current Day", 41, address=43, kind=FIELD_DAY, group=GROUP_CLOCK),
+        DcbField("Current Time", 42, 3, 44, kind=FIELD_CLOCK, group=GROUP_CLOCK),
+    ] + time_temp_fields("Weekday", 45, 47) + time_temp_fields("Weekend", 57, 59)
+    # The hot fields are read between full reads, partial reads must not span a gap in the unique addresses
+    # so the clock is only included where it follows on (PRTHW, TM1). HC-EN has to be read in full
+    _HOT_FIELDS = ("Temp Hold Minutes", "Heating State")
+    LAYOUTS = {
+        DT: DcbLayout(_THERMOSTAT_FIELDS, hot_fields=_HOT_FIELDS),
+        DT_E: DcbLayout(_THERMOSTAT_FIELDS, hot_fields=_HOT_FIELDS),
+        PRT: DcbLayout(_PRT_FIELDS, 16, {1: seven_day_fields(time_temp_fields, 64, 103, 12)}, _HOT_FIELDS),
+        PRT_E: DcbLayout(_PRT_FIELDS, 16, {1: seven_day_fields(time_temp_fields, 64, 103, 12)}, _HOT_FIELDS),
+        PRTHW: DcbLayout(_PRTHW_FIELDS, 16, {1: seven_day_fields(time_temp_fields, 97, 103, 12)
+            + seven_day_fields(time_on_off_fields, 181, 187, 16, " Hot Water")}, ("Temp Hold Minutes", "Current Time")),
+        TM1: DcbLayout(_TM1_FIELDS, 6, {0: _TM1_TIMER_FIELDS,
+            1: _TM1_TIMER_FIELDS + seven_day_fields(time_on_off_fields, 51, 187, 16), 2: []}, ("Timer State", "Current Time")),
+        HC_EN: DcbLayout(_HC_EN_FIELDS, 12, {1: seven_day_fields(time_temp_fields, 69, 103, 12)}),
+    }
+
+
+    def __init__(self, address: int, model: str, hub, name: str = "", full_read_interval: int = FULL_READ_INTERVAL,
+            dcb_frame: list = None):
         """
+        full_read_interval: number of reads of the fast changing part of the DCB between reads of the whole DCB
+        dcb_frame: a reply to a read of the whole DCB, as returned by probe(), which saves reading the thermostat again
         Raises an Exception if the thermostat can't be registered
         """
         _LOGGER.info(f"Creating thermostat '{name}' ({model}) at address {address}...")
@@ -45,27 +184,37 @@ class HeatmiserThermostat(object):
         self.model = model
         self._hub = hub
         self.name = name
-
-        self._dcb_frame = []
+        self._layout = self.LAYOUTS[model]
+        self.read_properties = NO_PROPERTIES
+        self.write_properties = self._layout.write_properties()
+        self.full_read_interval = full_read_interval
+        self._partial_reads = 0
+        # consecutive failed reads, when an offline thermostat is next read and when it was last read (time.monotonic)
+        self._failures = 0
+        self._retry_time = 0
+        self._read_time = time.monotonic()
+        # when the fast changing (hot) part and the whole of the DCB were last read
+        # and when the clock in the last frame was read or written (time.monotonic)
+        self._hot_read_time = 0
+        self._full_read_time = 0
+        self._clock_time = 0
+        # DCB index -> when its byte was last written or read back by a partial read (time.monotonic)
+        self._confirmed_times = {}
+        self._clock = self._layout.field("Current Day")
+        # (address, index, length) of the blocks written since they were last read back
+        self._written = []
+        # the poll loop and the mqtt command worker both read and write the thermostat
+        self._lock = threading.RLock()
+
+        # the last frame read (bytes) with any writes since applied, and the frame read_properties were decoded from
+        self._dcb_frame = b""
+        self._decoded_frame = b""
         hub.registerThermostat(self)
         # Creation and registration successful so read the thermostat's DCB
-        self.read_properties["Model"] = model
-        self.read_thermostat()
-        if model in [self.PRT, self.PRT_E, self.DT, self.DT_E, self.PRTHW]:
-            self.write_properties["frost_protect_temp"] = WritePropertyData("Frost Protect Temp", 17, 7, 17)
-            self.write_properties["room_target_temp"] = WritePropertyData("Room Target Temp", 18, 5, 35)
-            self.write_properties["floor_max_temp"] = WritePropertyData("Floor Max Temp", 19, 20, 45)
-            self.write_properties["display_state"] = WritePropertyData("Display State", 21, options={"off": 0,"on": 1})
-            self.write_properties["key"] = WritePropertyData("Key", 22, options={"unlocked": 0,"locked": 1})
-            self.write_properties["run_mode"] = WritePropertyData("Run Mode", 23, options={"heating": 0, "frost protect": 1})
-            # Holiday Hours max, 2385 is 99 (+4) hours. Thermostat seems to add 4 hours...
-            self.write_properties["holiday_hours"] = WritePropertyData("Holiday Hours", dcb_offset=24, min=0, max=2385, twobyte=True)
-            # Temp Hold Minutes max, 5970 is 99:30
-            self.write_properties["temp_hold_minutes"] = WritePropertyData("Temp Hold Minutes", dcb_offset=26, min=0, max=5970, twobyte=True)
-            # offset = self._dateTime_offset(model)
-            # if offset is not None:
-            #     self.write_properties["Current Day"] = WritePropertyData("Current Day", offset, options=self.WEEKDAYS)
-            #     self.write_properties["Current Time"] = WritePropertyData("Current Time", offset + 1, isTime=True)
+        if dcb_frame is not None and self._load_frame(dcb_frame):
+            self._hot_read_time = self._full_read_time = self._clock_time = time.monotonic()
+        else:
+            self.read_thermostat()
 
     # def _check_param(self, module :str , function : str, param_name : str, param_type : type, param):
     #     if type(param) != param_type:
@@ -75,39 +224,53 @@ class HeatmiserThermostat(object):
     def getThermostatType(hub, address: int) -> str:
         """Returns the thermostat type (PRT-N etc) by interrogating the network at address 'address'
         or False if there is no thermostat at the address"""
+        return HeatmiserThermostat.probe(hub, address)[0]
+
+    @staticmethod
+    def probe(hub, address: int, response_timeout: float = None, priority: int = PRIORITY_POLL) -> tuple:
+        """
+        Reads the whole DCB of the thermostat at address 'address'
+        response_timeout: time to wait for a reply, defaults to the hub's probe timeout
+        Returns a tuple of the thermostat type (PRT-N etc) and the reply, which can be passed to the constructor
+        as dcb_frame, or (False, None) if there is no thermostat at the address
+        """
         msg = HeatmiserThermostat.assemble_message(address, FUNC_READ, 0, [0])
-        packet = hub.send_msg(msg)
+        if response_timeout is None:
+            response_timeout = hub.probe_timeout()
+        packet = hub.send_msg(msg, priority, response_timeout)
         if packet is False:
-            return False
+            return False, None
         if len(packet) < 1:
             _LOGGER.debug(f"Thermostat at address {address} reply error: no reply")
-            return False
-        elif len(packet) < 7:
-            _LOGGER.error(f"Thermostat at address {address} reply error: message too short needed >=7 bytes, received {len(packet)} bytes")
-            return False
-        checksum = packet[len(packet) - 2:]
-        rxmsg = packet[:len(packet) - 2]
-        crc = CRC16()   # Initialises the CRC
-        expectedchecksum = crc.run(rxmsg)
-        if expectedchecksum != checksum:
+            return False, None
+        elif len(packet) < DCB_OFFSET + 7:
+            _LOGGER.error(f"Thermostat at address {address} reply error: message too short needed >={DCB_OFFSET + 7} bytes, received {len(packet)} bytes")
+            return False, None
+        if not crc16_verify(packet):
             # This typically happens when the thermostat loses power while connected to the RS485 bus
             _LOGGER.error("Thermostat reply error: CRC is incorrect")
-            return False
+            return False, None
+        if packet[3] != address:
+            _LOGGER.error(f"Thermostat at address {address} reply error: reply came from address {packet[3]}")
+            return False, None
 
         # Response passes checksum so check the contents
-        return HeatmiserThermostat._decode_byte(packet[4 + DCB_OFFSET], HeatmiserThermostat.MODELS)
+        return HeatmiserThermostat._decode_byte(packet[4 + DCB_OFFSET], HeatmiserThermostat.MODELS), packet
 
     @staticmethod
-    def assemble_message(address: int, function, start: int, payload : list) -> list:
-        """Forms a message payload, including CRC. Returns a list"""
+    def assemble_message(address: int, function, start: int, payload : list, read_length: int = RW_LENGTH_ALL) -> list:
+        """
+        Forms a message payload, including CRC. Returns a list
+        Reads are of read_length bytes from start, the whole DCB by default
+        """
         check_param("payload", list, payload)
 
         start_low = (start & BYTEMASK)
         start_high = (start >> 8) & BYTEMASK
         if function == FUNC_READ:
             payload_length = 0
-            length_low = (RW_LENGTH_ALL & BYTEMASK)
-            length_high = (RW_LENGTH_ALL >> 8) & BYTEMASK
+            length_low = (read_length & BYTEMASK)
+            length_high = (read_length >> 8) & BYTEMASK
         else:
             payload_length = len(payload)
             length_low = (payload_length & BYTEMASK)
@@ -125,16 +288,20 @@ class HeatmiserThermostat(object):
         if function == FUNC_WRITE:
             msg = msg + payload
 #            type(msg) #What did this do?
-        crc = CRC16()
-        msg = msg + crc.run(msg)
+        crc = crc16(msg)
+        msg = msg + [crc & BYTEMASK, crc >> 8]
         return msg
 
-    def _send_message(self, dcb_address: int, command_data : list, read_thermostat: bool = True):
+    def _send_message(self, dcb_address: int, command_data : list, read_thermostat: bool = True, read_index: int = None,
+            read_length: int = RW_LENGTH_ALL, priority: int = None):
         """
         Composes a message for the thermostat, sends it via the hub, validates its response
         Returns the thermostat data as a list if the response is valid
         dcb_address: the offset into the dcb to which command_data relates
         command_data: list of bytes to send
+        read_index, read_length: for a partial read, the index in the DCB and number of bytes at dcb_address
+            which are merged into the last full read
+        priority: the bus priority of the message, by default writes are sent ahead of reads
         Returns True if successful
         Returns False if either no response was received or the response was invalid
         """
@@ -143,31 +310,27 @@ class HeatmiserThermostat(object):
         # Write commands respond with a CRC only (7 bytes in total)
         read_write_command = FUNC_READ if read_thermostat else FUNC_WRITE
 
-        if read_thermostat:
-            self.read_properties = {}
+        partial_read = read_thermostat and read_length != RW_LENGTH_ALL
 
-        msg = HeatmiserThermostat.assemble_message(self.address, read_write_command, dcb_address, command_data)
-        packet = self._hub.send_msg(msg)
+        msg = HeatmiserThermostat.assemble_message(self.address, read_write_command, dcb_address, command_data, read_length)
+        # writes are normally user requests so they are sent ahead of any queued polling
+        if priority is None:
+            priority = PRIORITY_POLL if read_thermostat else PRIORITY_WRITE
+        packet = self._hub.send_msg(msg, priority)
         if packet is False:
             # hub unable to open serial port/tcp connection
             return False
+        # the hub has already resynchronised the bus and retried after any corrupt reply
         if len(packet) < 1:
-            _LOGGER.error(f"Thermostat '{self.name}' no reply, attempting to reinitialise comms")
-            self._hub.disconnect()
+            _LOGGER.error(f"Thermostat '{self.name}' no reply")
             return False
         elif len(packet) < 7:
-            _LOGGER.error(f"Thermostat '{self.name}' reply error, message too short, needed >=7 bytes, received {len(packet)} bytes, attempting to reinitialise comms")
-            self._hub.disconnect()
+            _LOGGER.error(f"Thermostat '{self.name}' reply error, message too short, needed >=7 bytes, received {len(packet)} bytes")
             return False
         
-        checksum = packet[len(packet) - 2:]
-        rxmsg = packet[:len(packet) - 2]
-        crc = CRC16()   # Initialises the CRC
-        expectedchecksum = crc.run(rxmsg)
-        if expectedchecksum != checksum:
+        if not crc16_verify(packet):
             # This typically happens when the thermostat loses power while connected to the RS485 bus
-            _LOGGER.error(f"Thermostat '{self.name}' reply error: CRC is incorrect, attempting to reinitialise comms")
-            self._hub.disconnect()
+            _LOGGER.error(f"Thermostat '{self.name}' reply error: CRC is incorrect")
             return False
 
         # Response passes checksum so check the contents
@@ -204,112 +367,57 @@ class HeatmiserThermostat(object):
             _LOGGER.error(f"Thermostat reply error: response indicated {frame_len} bytes but {len(packet)} were received")
             return False
         
-        if func_code == FUNC_READ:
+        if partial_read:
+            reply_length = (packet[8] << 8) | packet[7]
+            if reply_length != read_length or frame_len != read_length + 11:
+                _LOGGER.error(f"Thermostat reply error: request was for {read_length} bytes but {reply_length} were received")
+                return False
+        elif func_code == FUNC_READ:
             reported_model = packet[13]
-            if self.MODELS[reported_model] != self.model:
-                _LOGGER.error(f"Thermostat registered as {self.model} but thermostat is {self.MODELS[reported_model]}")
+            if self.MODELS.get(reported_model) != self.model:
+                _LOGGER.error(f"Thermostat registered as {self.model} but thermostat is {self._decode_byte(reported_model, self.MODELS)}")
                 return False
         # All checks passed
         if read_thermostat:
-            self._dcb_frame = packet
-            self.read_properties["Vendor"] = HeatmiserThermostat._decode_byte(packet[2 + DCB_OFFSET], { 0: "Heatmiser", 1: "OEM"})
-            self.read_properties["Version"] = packet[3 + DCB_OFFSET] & 0x7F
-            self.read_properties["Floor limiting"] = HeatmiserThermostat._decode_byte(packet[3 + DCB_OFFSET] & 0x80, { 0: "Off", 0x80: "On"}) # bit 7
-            self.read_properties["Type"] = HeatmiserThermostat._decode_byte(packet[4 + DCB_OFFSET], self.MODELS)
-            # device specific from here on
-            
-            if self.model == self.TM1:
-                # TODO
-                pass
+            if partial_read:
+                # merge the fresh bytes into the last full read
+                start = DCB_OFFSET + read_index
+                packet = self._dcb_frame[:start] + bytes(packet[DCB_OFFSET:DCB_OFFSET + read_length]) + self._dcb_frame[start + read_length:]
+            if not self._load_frame(packet):
+                return False
+            hot_read = self._layout.hot_read
+            if not partial_read:
+                self._hot_read_time = self._full_read_time = time.monotonic()
+            elif hot_read is not None and (read_index, read_length) == hot_read[1:]:
+                self._hot_read_time = time.monotonic()
             else:
-                self.read_properties["Units"] = HeatmiserThermostat._decode_byte(packet[5 + DCB_OFFSET], { 0: "°C", 1: "°F"})
-                if self.model in [self.HC_EN]:
-                    # TODO
-                    pass
-                else:
-                    #DT DT-E PRT PRT-E PRTHW
-                    self.read_properties["Differential"] = packet[6 + DCB_OFFSET]
-                    self.read_properties["Frost Protection"] = HeatmiserThermostat._decode_byte(packet[7 + DCB_OFFSET], {0: "Not active", 1: "Active"})
-                    self.read_properties["Calibration Offset"] = (packet[8 + DCB_OFFSET] << 8) | packet[9 + DCB_OFFSET]
-                    self.read_properties["Bus Address"] = str(packet[11 + DCB_OFFSET])
-                    sensors = {0: "Built in"}
-                    if self.model != "PRTHW": #DT DT-E PRT PRT-E
-                        sensors = sensors | {1: "Remote", 2: "Floor", 3: "Built in + Floor", 4: "Remote + Floor"}
-                    self.read_properties["Sensor Type"] = HeatmiserThermostat._decode_byte(packet[13 + DCB_OFFSET], sensors)
-                    self.read_properties["Optimum Start"] = packet[14 + DCB_OFFSET]
-                    self.read_properties["Rate of Change"] = packet[15 + DCB_OFFSET]
-                    self.read_properties["Timer Mode"] = HeatmiserThermostat._decode_byte(packet[16 + DCB_OFFSET], { 0: "wk-day/wk-end", 1: "7 day"})
-                    self.read_properties["Frost Protect Temp"] = packet[17 + DCB_OFFSET]
-                    self.read_properties["Room Target Temp"] = packet[18 + DCB_OFFSET]
-                    self.read_properties["Floor Max Temp"] = packet[19 + DCB_OFFSET]
-                    self.read_properties["Floor Max limit"] = HeatmiserThermostat._decode_byte(packet[20 + DCB_OFFSET], { 0: "disabled", 1: "enabled"})
-                    self.read_properties["Display State"] = HeatmiserThermostat._decode_byte(packet[21 + DCB_OFFSET], { 0: "off", 1: "on"})
-                    self.read_properties["Key"] = HeatmiserThermostat._decode_byte(packet[22 + DCB_OFFSET], { 0: "unlocked", 1: "locked"})
-                    self.read_properties["Run Mode"] = HeatmiserThermostat._decode_byte(packet[23 + DCB_OFFSET], { 0: "heating", 1: "frost protect"})
-                    self.read_properties["Holiday Hours"] = packet[25 + DCB_OFFSET] + (packet[24 + DCB_OFFSET] << 8)
-                    self.read_properties["Temp Hold Minutes"] = packet[27 + DCB_OFFSET] + (packet[26 + DCB_OFFSET] << 8)
-                    self.read_properties["Remote Sensor Temp"] = (str(packet[29 + DCB_OFFSET] / 10) if packet[29 + DCB_OFFSET] != 0xff else "not connected")
-                    self.read_properties["Floor Sensor Temp"] = (str(packet[31 + DCB_OFFSET] / 10) if packet[31 + DCB_OFFSET] != 0xff else "not connected")
-                    self.read_properties["Built-in Sensor Temp"] = (str(packet[33 + DCB_OFFSET] / 10) if packet[33 + DCB_OFFSET] != 0xff else "not connected")
-                    self.read_properties["Error"] = HeatmiserThermostat._decode_byte(packet[34 + DCB_OFFSET], {0: "none", 0xE0: "built-in sensor", 0xE1: "floor sensor", 0xE2: "remote sensor"})
-                    self.read_properties["Heating State"] = HeatmiserThermostat._decode_byte(packet[35 + DCB_OFFSET], {0: "no heat", 1: "heat"})
-                    offset = self._dateTime_offset(self.model)
-                    if offset is not None:
-                        if packet[offset] in self.WEEKDAYS:
-                            self.read_properties["Current Day"] = self.WEEKDAYS[packet[offset]]
-                        else:
-                            self.read_properties["Current Day"] = "unknown"
-                        self.read_properties["Current Time"] = f"{packet[offset + 1]:02d}:{packet[offset + 2]:02d}:{packet[offset + 3]:02d}"
-                    
-                    weekdayWeekendOffset = self._weekdayWeekendOffset(self.model)
-                    if weekdayWeekendOffset is not None:
-                        self._addTimeTempProperties("Weekday", packet, weekdayWeekendOffset)
-                        self._addTimeTempProperties("Weekend", packet, weekdayWeekendOffset + 12)
-                    if self.model in [self.PRT, self.PRT_E] and self.read_properties["Timer Mode"] == "7 day":
-                        offset = 64 + DCB_OFFSET
-                        for dow in self.WEEKDAYS:
-                            offset = self._addTimeTempProperties(self.WEEKDAYS[dow], packet, offset)
-                    # TODO PRTHW & HC-EN
-                
-            _LOGGER.debug(self.read_properties)
+                self._confirm(read_index, read_length)
+            if self._clock is not None and (not partial_read or read_index <= self._clock.index < read_index + read_length):
+                self._clock_time = time.monotonic()
         else:
             # decode response from a write command contains no data
             pass
         return True
-    
-    def _dateTime_offset(self, model):
-        """Returns the byte offset within the dcb of the date and time data
-        or None if the thermostat does not support date/time"""
-        offsets = {self.PRT: 36, self.PRT_E: 36, self.PRTHW: 37, self.TM1:15}
-        if model in offsets:
-            return offsets[model] + DCB_OFFSET
-        else:
-            return None
-
-    def _weekdayWeekendOffset(self, model : str):
-        """Returns the byte offset within the dcb of the weekday/weekend data
-        or None if the thermostat does not support weekday/weekend"""
-        offsets = {self.PRT: 40, self.PRT_E: 40, self.PRTHW: 41, self.HC_EN: 45}#, self.TM1: 19}
-        if model in offsets:
-            return offsets[model] + DCB_OFFSET
-        else:
-            return None
 
-    def _addTimeOnOffProperties(self, name : str, packet : list, offset : int):
-        item = offset
-        for time_slot in range(1, 4):
-            self.read_properties[f"{name} Time{time_slot} On"] = f"{packet[item]:02d}:{packet[item + 1]:02d}"
-            self.read_properties[f"{name} Time{time_slot} Off"] = f"{packet[item + 2]:02d}:{packet[item + 3]:02d}"
-            item +=4
-
-    def _addTimeTempProperties(self, name : str, packet : list, offset : int):
-        item = offset
-        periods = ["Wake", "Leave", "Return", "Sleep"]
-        for period in periods:
-            self.read_properties[f"{name} {period} Time"] = f"{packet[item]:02d}:{packet[item + 1]:02d}"
-            self.read_properties[f"{name} {period} Temp"] = packet[item + 2]
-            item +=3
-        return item
+    def _load_frame(self, packet: list) -> bool:
+        """
+        Decodes the read properties from a reply to a read of the whole DCB
+        The properties are decoded as they are accessed, those of an unchanged frame are kept with what has been decoded
+        Returns False if the DCB is too short for the thermostat's model
+        """
+        frame = bytes(packet)
+        if frame == self._decoded_frame:
+            self._dcb_frame = frame
+            return True
+        # the DCB follows the header and is followed by the CRC
+        read_properties = self._layout.decode(frame, DCB_OFFSET, len(frame) - DCB_OFFSET - 2)
+        if read_properties is None:
+            _LOGGER.error(f"Thermostat '{self.name}' reply error: DCB of {len(frame) - DCB_OFFSET - 2} bytes is too short for a {self.model}")
+            return False
+        self._dcb_frame = self._decoded_frame = frame
+        self.read_properties = read_properties
+        _LOGGER.debug(self.read_properties)
+        return True
 
     def connected(self) -> bool:
         """
@@ -317,6 +425,38 @@ class HeatmiserThermostat(object):
         """
         return len(self._dcb_frame) > 0
 
+    def online(self) -> bool:
+        """
+        Returns False if the thermostat has failed to reply to OFFLINE_FAILURES consecutive reads
+        """
+        return self._failures < OFFLINE_FAILURES
+
+    def read_due(self) -> bool:
+        """
+        Returns True if the thermostat should be read
+        An online thermostat is always due, an offline one only when its retry interval has elapsed
+        so an unpowered thermostat doesn't hold up the network waiting for replies
+        """
+        return self.online() or time.monotonic() >= self._retry_time
+
+    def offline_time(self) -> float:
+        """Returns the time in seconds since an offline thermostat was last read successfully, 0 if online"""
+        return 0 if self.online() else time.monotonic() - self._read_time
+
+    def _record_read(self, ok: bool):
+        """Tracks consecutive failed reads, backing off the reads of an offline thermostat exponentially"""
+        if ok:
+            if not self.online():
+                _LOGGER.info(f"Thermostat '{self.name}' is back online")
+            self._failures = 0
+            self._read_time = time.monotonic()
+            return
+        self._failures += 1
+        if not self.online():
+            retry_interval = min(OFFLINE_RETRY_INTERVAL << min(self._failures - OFFLINE_FAILURES, 16), OFFLINE_RETRY_INTERVAL_MAX)
+            self._retry_time = time.monotonic() + retry_interval
+            _LOGGER.info(f"Thermostat '{self.name}' is offline after {self._failures} failed reads, retrying in {retry_interval}s")
+
     @staticmethod
     def _decode_byte(byte, options):
         """Returns a string from a set of options depending on the value of byte
@@ -326,16 +466,75 @@ class HeatmiserThermostat(object):
         else:
             return f"unknown ({byte})"
 
-    def read_thermostat(self):
+    def read_thermostat(self, full: bool = None):
         """
         Reads the data from the thermostat
+        Normally only the fast changing (hot) part of the DCB is read, the whole DCB is read
+        every full_read_interval reads or if full is True
         Returns True if the read was successful
         """
-        _LOGGER.debug(f"Reading thermostat '{self.name}' ({self.model}) at address {self.address}")
+        with self._lock:
+            return self._read_thermostat(full)
+
+    def _read_thermostat(self, full: bool = None):
+        hot_read = self._layout.hot_read
+        if full is None:
+            full = hot_read is None or not self.connected() or self._partial_reads >= self.full_read_interval
         try:
-            return self._send_message(0, [0], True)
+            if full or hot_read is None:
+                _LOGGER.debug(f"Reading thermostat '{self.name}' ({self.model}) at address {self.address}")
+                self._partial_reads = 0
+                ok = self._send_message(0, [0], True)
+            else:
+                address, index, length = hot_read
+                _LOGGER.debug(f"Reading {length} bytes from {address} of thermostat '{self.name}' ({self.model}) at address {self.address}")
+                self._partial_reads += 1
+                ok = self._send_message(address, [0], True, index, length)
+            if not ok:
+                # start again with a full read
+                self._partial_reads = self.full_read_interval
+            self._record_read(ok)
+            return ok
         except Exception as ex:
             _LOGGER.error(f"read_thermostat error: {ex}")
+            self._record_read(False)
+            return False
+
+    def writes_pending(self) -> bool:
+        """Returns True if anything has been written to the thermostat since it was last read back by confirm_writes"""
+        with self._lock:
+            return len(self._written) > 0
+
+    def confirm_writes(self) -> bool:
+        """
+        Reads back the blocks written since the last call and the fast changing (hot) part of the DCB
+        ahead of any polling, so the state confirmed by the thermostat can be published straight after a write
+        Thermostats without a hot part are read in full
+        Returns True if the reads were successful
+        """
+        with self._lock:
+            written, self._written = self._written, []
+            if not self.connected():
+                return False
+            hot_read = self._layout.hot_read
+            try:
+                if hot_read is None:
+                    ok = self._send_message(0, [0], True, priority=PRIORITY_READ)
+                else:
+                    ok = True
+                    hot_address, hot_index, hot_length = hot_read
+                    for address, index, length in written:
+                        # the hot read covers it
+                        if hot_index <= index and index + length <= hot_index + hot_length:
+                            continue
+                        _LOGGER.debug(f"Reading back {length} bytes from {address} of thermostat '{self.name}'")
+                        ok = self._send_message(address, [0], True, index, length, PRIORITY_READ) and ok
+                    ok = self._send_message(hot_address, [0], True, hot_index, hot_length, PRIORITY_READ) and ok
+            except Exception as ex:
+                _LOGGER.error(f"confirm_writes error: {ex}")
+                ok = False
+            self._record_read(ok)
+            return ok
 
     def update_thermostat(self, property : WritePropertyData, value):
         """
@@ -343,10 +542,194 @@ class HeatmiserThermostat(object):
         Returns True if the update was successful
         Returns False if "value" is invalid or the "property" does not exist
         """
-        check_param("property", WritePropertyData, property)
-        if (str(value)) == '':
-            # discard without error
-            return True
+        return self.update_thermostat_properties([(property, value)])
+
+    def update_thermostat_properties(self, updates: list) -> bool:
+        """
+        Updates several properties, updates is a list of (WritePropertyData, value)
+        The last value of a property in the list is the one written
+        Values the thermostat already has (as of a recent read) are not written
+        Properties in the same write group with contiguous addresses are written in a single message
+        Returns True if all the updates were successful
+        """
+        check_param("updates", list, updates)
+        with self._lock:
+            return self._update_thermostat_properties(updates)
+
+    def _update_thermostat_properties(self, updates: list) -> bool:
+        ok = True
+        writes = {}
+        for property, value in updates:
+            check_param("property", WritePropertyData, property)
+            if (str(value)) == '':
+                # discard without error
+                continue
+            data = self._encode(property, value)
+            if data is None:
+                ok = False
+            elif self._unchanged(property, data):
+                _LOGGER.debug(f"Thermostat '{self.name}' already has '{property.name}' = {value}, not written")
+                writes.pop(property.dcb_offset, None)
+            else:
+                writes[property.dcb_offset] = (property, value, data)
+
+        # merge the writes into blocks of contiguous addresses in the same group
+        blocks = []
+        for address in sorted(writes):
+            property, value, data = writes[address]
+            field = self._layout.field(property.name)
+            group = field.group if field is not None else None
+            if blocks and group is not None and blocks[-1]["group"] == group and blocks[-1]["end"] == address:
+                block = blocks[-1]
+            else:
+                block = {"address": address, "group": group, "data": [], "writes": []}
+                blocks.append(block)
+            block["data"] += data
+            block["end"] = address + len(data)
+            block["writes"].append((property, value, data))
+
+        model = self.read_property("Type")
+        for block in blocks:
+            description = ", ".join(f"'{property.name}' ({value} as {data})" for property, value, data in block["writes"])
+            if self._send_message(block["address"], block["data"], False):
+                _LOGGER.info(f"Sent {description} to thermostat '{self.name}' ({model}) at address {self.address}")
+                for property, value, data in block["writes"]:
+                    self._store(property, data)
+                field = self._layout.field(block["writes"][0][0].name)
+                if field is not None:
+                    self._written.append((block["address"], field.index, len(block["data"])))
+            else:
+                _LOGGER.error(f"Error sending {description} to thermostat '{self.name}' ({model}) at address {self.address}")
+                ok = False
+        if len(blocks) > 0 and self.connected():
+            # decode what has been written
+            self._load_frame(self._dcb_frame)
+        return ok
+
+    def update_schedule(self, schedule: dict) -> bool:
+        """
+        Writes days of the schedule (program), a dict of day to its periods as published on the schedule topic
+        e.g. {"Mon": [["07:00", 21], ["09:00", 16], ["16:00", 21], ["22:00", 16]]}, a timer's periods are [on, off]
+        and "24:00" is an unused period
+        Only the days of the thermostat's timer mode can be written (Weekday and Weekend, and Mon to Sun in 7 day mode)
+        The whole schedule is checked before anything is written, then each day is written in a single message
+        unless it is what the thermostat had when it was last read
+        Returns True if the schedule was valid and written
+        """
+        check_param("schedule", dict, schedule)
+        with self._lock:
+            return self._update_schedule(schedule)
+
+    def _update_schedule(self, schedule: dict) -> bool:
+        if not self.connected():
+            _LOGGER.error(f"Unable to write the schedule of thermostat '{self.name}', it has not been read")
+            return False
+        days = self.read_properties.schedule_days()
+        blocks = []
+        for day, periods in schedule.items():
+            names = days.get(day)
+            if names is None:
+                _LOGGER.error(f"Thermostat '{self.name}' has no schedule day '{day}', it has {', '.join(days) or 'none'}")
+                return False
+            data = self._schedule_data(day, names, periods)
+            if data is None:
+                return False
+            blocks.append((day, self._layout.field(names[0]), data))
+
+        ok = True
+        written = False
+        for day, field, data in blocks:
+            start = DCB_OFFSET + field.index
+            if self._dcb_frame[start:start + len(data)] == bytes(data):
+                _LOGGER.debug(f"Thermostat '{self.name}' already has the schedule for {day}, not written")
+                continue
+            if self._send_message(field.address, data, False):
+                _LOGGER.info(f"Sent the schedule for {day} ({schedule[day]}) to thermostat '{self.name}' at address {self.address}")
+                self._dcb_frame = self._dcb_frame[:start] + bytes(data) + self._dcb_frame[start + len(data):]
+                self._written.append((field.address, field.index, len(data)))
+                written = True
+            else:
+                _LOGGER.error(f"Error sending the schedule for {day} to thermostat '{self.name}' at address {self.address}")
+                ok = False
+        if written:
+            # decode what has been written
+            self._load_frame(self._dcb_frame)
+        return ok
+
+    def _schedule_data(self, day: str, names: list, periods) -> list:
+        """
+        Returns the bytes to write for a day of the schedule, whose fields are called names, from its periods
+        Returns None if periods is invalid
+        """
+        if not isinstance(periods, (list, tuple)) or len(periods) * 2 != len(names) \
+                or any(not isinstance(period, (list, tuple)) or len(period) != 2 for period in periods):
+            _LOGGER.error(f"Error in the schedule for {day}, it needs {len(names) // 2} periods of [time, temperature] or [on, off], received {periods}")
+            return None
+        data = []
+        for n, value in enumerate(value for period in periods for value in period):
+            field = self._layout.field(names[n])
+            if field.kind == FIELD_TIME:
+                match = re.fullmatch(r"(\d{1,2}):(\d{2})", str(value))
+                if match is None or not (int(match[1]) < 24 and int(match[2]) < 60 or value == UNUSED_TIME):
+                    _LOGGER.error(f"Error in the schedule for {day}, '{field.name}' needs a time from 00:00 to 23:59 or {UNUSED_TIME} (unused), received {value}")
+                    return None
+                data += [int(match[1]), int(match[2])]
+            else:
+                # the temperature of an unused period isn't checked
+                unused = data[-2:] == [24, 0]
+                try:
+                    temperature = int(value)
+                except (TypeError, ValueError):
+                    temperature = None
+                if temperature is None or not (SCHEDULE_MIN_TEMP <= temperature <= SCHEDULE_MAX_TEMP or unused and 0 <= temperature <= BYTEMASK):
+                    _LOGGER.error(f"Error in the schedule for {day}, '{field.name}' needs a temperature from {SCHEDULE_MIN_TEMP} to {SCHEDULE_MAX_TEMP}, received {value}")
+                    return None
+                data.append(temperature)
+        return data
+
+    def _frame_bytes(self, property: WritePropertyData, data: list):
+        """
+        Returns the DCB field written by property, the index of its first byte in the last read frame
+        and data in the order it is read (2 byte values are read high byte first but written low byte first)
+        or (None, None, None) if the field is not in the last read frame
+        """
+        field = self._layout.field(property.name)
+        if field is None or field.width != len(data) or DCB_OFFSET + field.index + field.width > len(self._dcb_frame) - 2:
+            return None, None, None
+        if field.format == "H":
+            data = data[::-1]
+        return field, DCB_OFFSET + field.index, data
+
+    def _unchanged(self, property: WritePropertyData, data: list) -> bool:
+        """Returns True if the thermostat already has data (as written by property) as of a recent read or write"""
+        field, start, data = self._frame_bytes(property, data)
+        if field is None or not field.readback:
+            return False
+        hot_read = self._layout.hot_read
+        hot = hot_read is not None and hot_read[1] <= field.index < hot_read[1] + hot_read[2]
+        read_time = max(self._hot_read_time if hot else self._full_read_time, self._confirmed_times.get(field.index, 0))
+        if time.monotonic() - read_time > UNCHANGED_MAX_AGE:
+            return False
+        return self._dcb_frame[start:start + len(data)] == bytes(data)
+
+    def _store(self, property: WritePropertyData, data: list):
+        """Stores data written by property in the last read frame"""
+        field, start, data = self._frame_bytes(property, data)
+        if field is not None and field.readback:
+            self._dcb_frame = self._dcb_frame[:start] + bytes(data) + self._dcb_frame[start + len(data):]
+            self._confirm(field.index, len(data))
+
+    def _confirm(self, index: int, length: int):
+        """Records that the thermostat has the length bytes of the DCB from index in the last read frame"""
+        now = time.monotonic()
+        for n in range(index, index + length):
+            self._confirmed_times[n] = now
+
+    def _encode(self, property : WritePropertyData, value):
+        """
+        Returns the bytes to write for the property's value
+        Returns None if "value" is invalid
+        """
         data = None
         if property.options is not None:
             if value in property.options:
@@ -368,16 +751,7 @@ class HeatmiserThermostat(object):
                 data = [value & 0xFF, (value >> 8) & 0xFF]
             else:
                 data = [value]
-        if data is not None:
-            model = self.read_property("Type")
-            if self._send_message(property.dcb_offset, data, False):
-                _LOGGER.info(f"Sent '{property.name}' ({value} as {data}) to thermostat '{self.name}' ({model}) at address {self.address}")
-            else:
-                _LOGGER.error(f"Error sending '{property.name}' ({value} as {data}) to thermostat '{self.name}' ({model}) at address {self.address}")
-                return False
-            return True
-        else:
-            return False
+        return data
 
     def _dcb_item(self, index):
         """returns the value in the dcb at index 'index' or None if 'index' is out of range
@@ -408,55 +782,71 @@ class HeatmiserThermostat(object):
 
 
 # Write functions
-    def set_thermostat_time(self, day_of_week, hour, minute, second):
+    def clock_drift(self):
         """
-        NOT TESTED as it is unclear whether the day of week and time of day have to be sent separately or together
-        TODO
+        Returns the number of seconds the thermostat's clock was ahead of the host's local time (behind if negative)
+        when it was last read, or None if the thermostat has no clock or it hasn't been read
         """
-        if self.connected() is not True:
-            _LOGGER.error(f"Unable to set thermostat {self.address} time to {day_of_week} {hour}:{minute}:{second} as the thermostat is not connected")
-            return False
-        version = self._dcb_item(3) & 0x7F
-        if version <= 19:
-            # This needs more data. All I know is that V19 does not support this
-            _LOGGER.error(f"Unable to set thermostat {self.address} time to {day_of_week} {hour}:{minute}:{second} as the thermostat as the thermostat version {version} is too low")
-            return False
-
-        thermostat_type = self.read_property("Type")
-        all_ok = True
-        if thermostat_type in [self.DT, self.DT_E]:
-            _LOGGER.error(f"Unable to set thermostat {self.address} time as {self.MODELS[thermostat_type]} ({thermostat_type}) does not support it")
+        if self._clock is None or self._clock_time == 0:
+            return None
+        start = DCB_OFFSET + self._clock.index
+        if start + 4 > len(self._dcb_frame) - 2:
+            return None
+        day, hour, minute, second = self._dcb_frame[start:start + 4]
+        if day not in WEEKDAYS:
+            return None
+        clock = ((day - 1) * 24 + hour) * 3600 + minute * 60 + second
+        host = time.localtime(time.time() - (time.monotonic() - self._clock_time))
+        host_clock = (host.tm_wday * 24 + host.tm_hour) * 3600 + host.tm_min * 60 + host.tm_sec
+        # the nearest way round the week
+        return (clock - host_clock + WEEK // 2) % WEEK - WEEK // 2
+
+    def clock_settable(self) -> bool:
+        """Returns True if the thermostat has a clock and its firmware supports setting it"""
+        version = self.read_property("Version")
+        return self._clock is not None and version is not None and version >= MIN_CLOCK_VERSION
+
+    def sync_clock(self, priority: int = PRIORITY_POLL) -> bool:
+        """Sets the thermostat's clock to the host's local time, returns True if successful"""
+        now = time.localtime()
+        return self.set_thermostat_time(WEEKDAYS[now.tm_wday + 1], now.tm_hour, now.tm_min, now.tm_sec, priority)
+
+    def set_thermostat_time(self, day_of_week, hour, minute, second, priority: int = PRIORITY_WRITE) -> bool:
+        """
+        Sets the thermostat's clock, day_of_week is the day's name (e.g. Mon or monday)
+        The day and time are written together in a single message (unique addresses 43 to 46)
+        Returns True if successful
+        """
+        if self._clock is None:
+            _LOGGER.error(f"Unable to set thermostat '{self.name}' time as a {self.model} does not have a clock")
             return False
-        elif thermostat_type in [self.PRT, self.PRT_E]:
-            dcb_offset = 36
-        elif thermostat_type == self.PRTHW:
-            dcb_offset = 37
-        elif thermostat_type == self.TM1:
-            dcb_offset = 15
-        else:
-            _LOGGER.error(f"Unable to set thermostat {self.address} time as the model number ({thermostat_type}) is not recognised")
+        version = self.read_property("Version")
+        if version is not None and version < MIN_CLOCK_VERSION:
+            _LOGGER.error(f"Unable to set thermostat '{self.name}' time as its version {version} is too low, V19 does not support it")
             return False
-        day_of_week = day_of_week[0:3].title()
-        try:
-            week_day_no = next(week_day_no for week_day_no, value in self.WEEKDAYS.items() if value == day_of_week)
-        except Exception as ex:
-            _LOGGER.error(f"Unable to set thermostat {self.address} time as day of week ({day_of_week}) is not recognised")
+        day_of_week = str(day_of_week)[0:3].title()
+        week_day_no = next((number for number, day in WEEKDAYS.items() if day == day_of_week), None)
+        if week_day_no is None:
+            _LOGGER.error(f"Unable to set thermostat '{self.name}' time as day of week ({day_of_week}) is not recognised")
             return False
-
         hour = max(0, min(23, int(hour)))
         minute = max(0, min(59, int(minute)))
         second = max(0, min(59, int(second)))
         payload = [week_day_no, hour, minute, second]
-
-        msg = f"et thermostat {self.address} time to {day_of_week} (day {week_day_no}) {hour:02d}:{minute:02d}:{second:02d} at dcb[{dcb_offset}]"
-        if self._send_message(dcb_offset, payload, False):
-        #msgToSend = HeatmiserThermostat.assemble_message(self.address, FUNC_WRITE, dcb_offset, payload)
-        #if self._hub.send_msg(msgToSend):
-            _LOGGER.debug("S" + msg)
-        else:
-            _LOGGER.error(f"Unable to s{msg} using {payload}")
-        all_ok = False
-        return all_ok
+        description = f"thermostat '{self.name}' time to {day_of_week} {hour:02d}:{minute:02d}:{second:02d}"
+        with self._lock:
+            if not self.connected():
+                _LOGGER.error(f"Unable to set {description} as the thermostat is not connected")
+                return False
+            if not self._send_message(self._clock.address, payload, False, priority=priority):
+                _LOGGER.error(f"Unable to set {description}")
+                return False
+            _LOGGER.info(f"Set {description}")
+            start = DCB_OFFSET + self._clock.index
+            self._dcb_frame = self._dcb_frame[:start] + bytes(payload) + self._dcb_frame[start + len(payload):]
+            self._clock_time = time.monotonic()
+            self._load_frame(self._dcb_frame)
+            return True
 
     # def _set_limited_int_value(self, dcb_index, value, min_value, max_value, name):
     #     """
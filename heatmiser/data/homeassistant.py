@@ -1,12 +1,41 @@
 """Module of functions to provide json payloads for Home Assistant's auto-discovery"""
+import hashlib
 import json
+import threading
 
 HOMEASSISTANT = "homeassistant"
 CLIMATEDISCOVERYBASE = f"{HOMEASSISTANT}/climate"
 SENSORDISCOVERYBASE = f"{HOMEASSISTANT}/sensor"
+SWITCHDISCOVERYBASE = f"{HOMEASSISTANT}/switch"
+DEVICEDISCOVERYBASE = f"{HOMEASSISTANT}/device"
+ORIGIN = "heatmiser"
 
-def ha_climate_config(name: str, address: int, units: str, maunfacturer: str, model: str, version: str):
-    """Returns a json string representing the mqtt payload for Home Assistant's auto-discovery for a Climate entity"""
+# Value templates which derive the climate and sensor states from a thermostat's json state document
+MODE_TEMPLATE = "{{ 'heat' if value_json.run_mode == 'heating' else 'off' }}"
+TARGET_TEMP_TEMPLATE = "{{ value_json.room_target_temp }}"
+# None (unknown) while the sensor is "not connected"
+CURRENT_TEMP_TEMPLATE = ("{% set temp = value_json['built-in_sensor_temp'] %}"
+    "{{ temp | float | int if temp | is_number else None }}")
+PRESET_TEMPLATE = ("{% if value_json.holiday_hours > 0 %}holiday 1d{% elif value_json.temp_hold_minutes > 0 %}hold 1h"
+    "{% else %}none{% endif %}")
+TIMER_STATE_TEMPLATE = "{{ value_json.timer_state }}"
+
+def _device(name: str, maunfacturer: str, model: str, version: str) -> dict:
+    """
+    Returns the device which a thermostat's entities belong to
+    It is identified by the thermostat's name (<network>_<address>) as the same address can be used on several networks
+    """
+    return {
+        'identifiers': [f"heatmiser_{name}"],
+        'manufacturer': maunfacturer,
+        'model': model,
+        'name': "Heatmiser",
+        'suggested_area': "Heating",
+        'sw_version': version
+    }
+
+def _climate(name: str, address: int, units: str, state_topic: str = None) -> dict:
+    """Returns the configuration of a Climate entity without its device"""
     topic = f"{CLIMATEDISCOVERYBASE}/{name}"
     payload = {
         'name' : name,
@@ -27,20 +56,24 @@ def ha_climate_config(name: str, address: int, units: str, maunfacturer: str, mo
         "preset_mode_state_topic": f"{topic}/presetState",
         "uniq_id": f"heatmiser_{name}_{address}",
         'unit_of_meas': units,
-        'device' : {
-            'identifiers': address,
-            'manufacturer': maunfacturer,
-            'model': model,
-            'name': "Heatmiser",
-            'suggested_area': "Heating",
-            'sw_version': version
-        },
         'exp_aft': 600
     }
-    return json.dumps(payload)
+    if state_topic is not None:
+        payload.update({
+            "mode_stat_t": state_topic,
+            "mode_stat_tpl": MODE_TEMPLATE,
+            "temp_stat_t": state_topic,
+            "temp_stat_tpl": TARGET_TEMP_TEMPLATE,
+            "curr_temp_t": state_topic,
+            "curr_temp_tpl": CURRENT_TEMP_TEMPLATE,
+            "preset_mode_state_topic": state_topic,
+            "preset_mode_value_template": PRESET_TEMPLATE,
+            "json_attr_t": state_topic,
+        })
+    return payload
 
-def ha_sensor_config(name: str, sensor_name: str, address: int, units: str, maunfacturer: str, model: str, version: str):
-    """Returns a json string representing the mqtt payload for Home Assistant's auto-discovery for a Sensor entity"""
+def _sensor(name: str, sensor_name: str, address: int, units: str, state_topic: str = None) -> dict:
+    """Returns the configuration of a Sensor entity without its device"""
     sensor_name_snake = sensor_name.replace(' ', '_').lower()
     topic = f"{SENSORDISCOVERYBASE}/{name}_{sensor_name.replace(' ', '_')}"
     payload = {
@@ -50,16 +83,158 @@ def ha_sensor_config(name: str, sensor_name: str, address: int, units: str, maun
         "avty_t": f"{topic}/available",
         "pl_avail": "online",
         "pl_not_avail": "offline",
-        'device': {
-            'identifiers': address,
-            'manufacturer': maunfacturer,
-            'model': model,
-            'name': "Heatmiser",
-            'suggested_area': "Heating",
-            'sw_version': version
-        },
         'device_class': 'temperature',
         'unit_of_meas': units,
         'exp_aft': 600
     }
+    if state_topic is not None:
+        payload['state_topic'] = state_topic
+        payload['val_tpl'] = CURRENT_TEMP_TEMPLATE
+    return payload
+
+def _timer(name: str, address: int, property_topic: str, state_topic: str = None) -> dict:
+    """
+    Returns the configuration of the Switch entity of a timer (TM1) without its device
+    property_topic: the topic of its Timer State, to whose ../set topic the switch's commands are published
+    """
+    topic = f"{SWITCHDISCOVERYBASE}/{name}"
+    payload = {
+        'name': name,
+        "uniq_id": f"heatmiser_{name}_{address}_timer",
+        "stat_t": property_topic,
+        "cmd_t": f"{property_topic}/set",
+        "pl_on": "on",
+        "pl_off": "off",
+        "stat_on": "on",
+        "stat_off": "off",
+        "avty_t": f"{topic}/available",
+        "pl_avail": "online",
+        "pl_not_avail": "offline",
+    }
+    if state_topic is not None:
+        payload["stat_t"] = state_topic
+        payload["val_tpl"] = TIMER_STATE_TEMPLATE
+    return payload
+
+def ha_climate_config(name: str, address: int, units: str, maunfacturer: str, model: str, version: str,
+        state_topic: str = None):
+    """
+    Returns a json string representing the mqtt payload for Home Assistant's auto-discovery for a Climate entity
+    state_topic: the thermostat's json state document, from which the states and attributes are read if given
+    """
+    payload = _climate(name, address, units, state_topic)
+    payload['device'] = _device(name, maunfacturer, model, version)
+    return json.dumps(payload)
+
+def ha_sensor_config(name: str, sensor_name: str, address: int, units: str, maunfacturer: str, model: str, version: str,
+        state_topic: str = None):
+    """
+    Returns a json string representing the mqtt payload for Home Assistant's auto-discovery for a Sensor entity
+    state_topic: the thermostat's json state document, from which the state is read if given
+    """
+    payload = _sensor(name, sensor_name, address, units, state_topic)
+    payload['device'] = _device(name, maunfacturer, model, version)
+    return json.dumps(payload)
+
+def ha_device_config(name: str, sensor_name: str, address: int, units: str, maunfacturer: str, model: str, version: str,
+        state_topic: str = None):
+    """
+    Returns a json string representing the mqtt payload for Home Assistant's device based auto-discovery
+    of a thermostat's Climate and Sensor entities together
+    state_topic: the thermostat's json state document, from which the states are read if given
+    """
+    climate = _climate(name, address, units, state_topic)
+    sensor = _sensor(name, sensor_name, address, units, state_topic)
+    payload = {
+        'device': _device(name, maunfacturer, model, version),
+        'origin': {'name': ORIGIN},
+        'components': {
+            climate["uniq_id"]: {'platform': "climate", **climate},
+            sensor["uniq_id"]: {'platform': "sensor", **sensor},
+        }
+    }
+    return json.dumps(payload)
+
+def ha_timer_config(name: str, address: int, property_topic: str, maunfacturer: str, model: str, version: str,
+        state_topic: str = None):
+    """
+    Returns a json string representing the mqtt payload for Home Assistant's auto-discovery for the Switch entity
+    of a timer (TM1), which has no temperatures
+    state_topic: the timer's json state document, from which the state is read if given
+    """
+    payload = _timer(name, address, property_topic, state_topic)
+    payload['device'] = _device(name, maunfacturer, model, version)
+    return json.dumps(payload)
+
+def ha_timer_device_config(name: str, address: int, property_topic: str, maunfacturer: str, model: str, version: str,
+        state_topic: str = None):
+    """
+    Returns a json string representing the mqtt payload for Home Assistant's device based auto-discovery
+    of a timer's (TM1) Switch entity
+    state_topic: the timer's json state document, from which the state is read if given
+    """
+    timer = _timer(name, address, property_topic, state_topic)
+    payload = {
+        'device': _device(name, maunfacturer, model, version),
+        'origin': {'name': ORIGIN},
+        'components': {
+            timer["uniq_id"]: {'platform': "switch", **timer},
+        }
+    }
     return json.dumps(payload)
+
+
+class DiscoveryConfigs(object):
+    """
+    The discovery configurations published for each thermostat
+    A configuration is only published again when its content (hash) changes or after forget_published()
+    (Home Assistant has restarted), so reads and thermostats coming back online don't republish them
+    """
+
+    def __init__(self, publish):
+        """publish: function(topic, payload) which returns True if the payload was published"""
+        self._publish = publish
+        # thermostat name -> (the data the configurations were built from, [(topic, payload)])
+        self._configs = {}
+        # topic -> hash of the payload last published
+        self._published = {}
+        # the pollers of each network and the mqtt thread publish
+        self._lock = threading.Lock()
+
+    def configs(self, name: str, key: tuple, build) -> list:
+        """
+        Returns the thermostat's configurations as a list of (topic, payload),
+        which are built with build() only if key (the data they are built from) has changed
+        """
+        with self._lock:
+            cached = self._configs.get(name)
+            if cached is None or cached[0] != key:
+                cached = (key, build())
+                self._configs[name] = cached
+            return cached[1]
+
+    def publish(self, topic: str, payload: str) -> bool:
+        """Publishes payload on topic unless it is what was last published there, returns False if publishing failed"""
+        digest = hashlib.sha1(payload.encode("utf-8")).digest()
+        with self._lock:
+            if self._published.get(topic) == digest:
+                return True
+        if not self._publish(topic, payload):
+            return False
+        with self._lock:
+            self._published[topic] = digest
+        return True
+
+    def forget_published(self):
+        """Forgets what has been published so every configuration is published again"""
+        with self._lock:
+            self._published.clear()
+
+    def remove(self, name: str, topics: list):
+        """Removes the thermostat's configurations on topics from Home Assistant, an empty configuration removes an entity"""
+        with self._lock:
+            self._configs.pop(name, None)
+        for topic in topics:
+            self._publish(topic, "")
+            with self._lock:
+                self._published.pop(topic, None)
@@ -7,6 +7,7 @@ All thermostat data are published to mqtt
 Home assistant compatible including discovery of thermostats as climate devices
 """
 
+import json
 import logging
 from paho.mqtt import client as mqtt_client
 from datetime import datetime, timedelta
@@ -14,10 +15,20 @@ import random
 import time
 import argparse
 import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from homeassistant import HOMEASSISTANT, CLIMATEDISCOVERYBASE, SENSORDISCOVERYBASE, ha_climate_config, ha_sensor_config
-from heatmiserThermostat import HeatmiserThermostat, HEATMISER
+from homeassistant import HOMEASSISTANT, CLIMATEDISCOVERYBASE, SENSORDISCOVERYBASE, SWITCHDISCOVERYBASE, DEVICEDISCOVERYBASE, \
+    ha_climate_config, ha_sensor_config, ha_device_config, ha_timer_config, ha_timer_device_config, DiscoveryConfigs
+from heatmiserThermostat import HeatmiserThermostat, HEATMISER, FULL_READ_INTERVAL
 from heatmiserHub import HeatmiserHub
+from thermostatPublisher import ThermostatPublisher, REPUBLISH_INTERVAL, STATE_TOPIC, SCHEDULE_TOPIC
+from scheduler import PollScheduler, FAST_FACTOR, SLOW_FACTOR, MAX_SLOW_INTERVAL, BUS_BUDGET
+from clockSync import ClockSync, CLOCK_SYNC_THRESHOLD
+from discovery import DiscoveryCache, BackgroundDiscovery, scan, DISCOVERY_CACHE, RETIRE_TIME
+from outbox import Outbox, OUTBOX_SIZE
+from metrics import METRICS, MetricsServer, METRICS_PORT, CYCLE_BUCKETS
 from utils import GracefulKiller
 
 __author__ = "Mike Ford"
@@ -39,11 +50,16 @@ MQTT_CONNECT_CODES = {
     6:"unused"
     }
 
+# Commands received within this many seconds of each other are coalesced into as few writes as possible
+COMMAND_WINDOW = 0.25
+
 # mqtt event handlers-------------------------------
 def mqtt_on_message(client, userdata, message):
     """
     Event handler for the mqtt client subscription
     Receives messages from topics to which we are subscribed
+    This runs on the mqtt network thread so commands are only parsed here and queued
+    for command_worker, the bus transactions they need can take several seconds
     """
     try:
         value = message.payload.decode('utf-8')
@@ -51,7 +67,8 @@ def mqtt_on_message(client, userdata, message):
         if args.homeassistant and message.topic == f"{HOMEASSISTANT}/status":
             if value == "online":
                 # home assistant has just gone online and needs discovery configurations publishing
-                for name in thermostats:
+                discovery_configs.forget_published()
+                for name in list(thermostats):
                     thermostat = thermostats[name]
                     if thermostat.connected():
                         publish_config(thermostat)
@@ -68,8 +85,18 @@ def mqtt_on_message(client, userdata, message):
                         thermostat = thermostats[thermo_name]
                         property = topic_items[sub_topic_count - 2]
                         if property in thermostat.write_properties:
-                            write_prop = thermostat.write_properties[property]
-                            thermostat.update_thermostat(write_prop, value)
+                            command_queue.put((execute_property_command, thermostat, property, value))
+                        elif property == SCHEDULE_TOPIC:
+                            try:
+                                schedule = json.loads(value)
+                            except ValueError:
+                                schedule = None
+                            if isinstance(schedule, dict):
+                                # a command per day so days sent in separate messages are all written
+                                for day, periods in schedule.items():
+                                    command_queue.put((execute_schedule_command, thermostat, day, periods))
+                            else:
+                                _LOGGER.error(f"Received invalid mqtt message {message.topic}: The schedule needs to be a json object of days")
                         else:
                             _LOGGER.error(f"Received invalid mqtt message {message.topic}: Unable to find property {property}")
                     else:
@@ -82,33 +109,8 @@ def mqtt_on_message(client, userdata, message):
                 if thermo_name in thermostats:
                     thermostat = thermostats[thermo_name]
                     cmd = topic_items[3]
-                    if cmd == "thermostatModeCmd":
-                        # home assistant 'heat' 'off' corresponds to heatmiser 'heat' 'frost protect'
-                        if "run_mode" in thermostat.write_properties:
-                            if value in ["heat", "off"]:
-                                if thermostat.update_thermostat(thermostat.write_properties["run_mode"], "heating" if value == "heat" else "frost protect"):
-                                    publish_base(client, f"{CLIMATEDISCOVERYBASE}/{thermo_name}/mode", value)
-                            else:
-                                _LOGGER.error(f"Home assistant mode command needs to be either 'heat' or 'off', received {value}")
-                        else:
-                            _LOGGER.error(f"Thermostat {thermo_name} does not have a 'run_mode' property")
-                    elif cmd == "targetTempCmd":
-                        # TODO check limits and validity of value
-                        if thermostat.update_thermostat(thermostat.write_properties["room_target_temp"], value):
-                            publish_base(client, f"{CLIMATEDISCOVERYBASE}/{thermo_name}/target_temp", value)
-                    elif cmd == "presetCmd":
-                        if value == "hold 1h":
-                            thermostat.update_thermostat(thermostat.write_properties["holiday_hours"], 0)
-                            if thermostat.update_thermostat(thermostat.write_properties["temp_hold_minutes"], 60):
-                                publish_base(client, f"{CLIMATEDISCOVERYBASE}/{thermo_name}/presetState", cmd)
-                        elif value == "holiday 1d":
-                            thermostat.update_thermostat(thermostat.write_properties["temp_hold_minutes"], 0)
-                            if thermostat.update_thermostat(thermostat.write_properties["holiday_hours"], 24):
-                                publish_base(client, f"{CLIMATEDISCOVERYBASE}/{thermo_name}/presetState", cmd)
-                        elif value == "none":
-                            thermostat.update_thermostat(thermostat.write_properties["temp_hold_minutes"], 0)
-                            thermostat.update_thermostat(thermostat.write_properties["holiday_hours"], 0)
-                            publish_base(client, f"{CLIMATEDISCOVERYBASE}/{thermo_name}/presetState", cmd)
+                    if cmd in ["thermostatModeCmd", "targetTempCmd", "presetCmd"]:
+                        command_queue.put((execute_climate_command, thermostat, cmd, value))
                     else:
                         _LOGGER.error(f"Received invalid mqtt message {message.topic}: Not recognised")
                 else:
@@ -125,40 +127,211 @@ def mqtt_on_connect(client, userdata, flags, rc):
     """
     Event handler for the mqtt client. Raised when a connection is established
     If successful sets a flag in the client to indicated we are connected
+    and publishes the messages held in the outbox while disconnected
     """
     if rc == 0:
         _LOGGER.info("Connected to MQTT Broker!")
         client.connected_flag = True
+        flush_outbox(client)
     else:
         _LOGGER.error(f"Failed to connect to MQTT broker, {MQTT_CONNECT_CODES[rc]} ({rc})")
+
+def mqtt_on_disconnect(client, userdata, rc):
+    """
+    Event handler for the mqtt client. Raised when the connection is lost (the client reconnects by itself)
+    Until it reconnects messages are held in the outbox
+    """
+    client.connected_flag = False
+    if rc != 0:
+        _LOGGER.warning(f"Disconnected from MQTT broker ({rc}), holding messages until reconnected")
 # end mqtt event handlers----------------
 
+# mqtt commands-------------
+def execute_property_command(thermostat: HeatmiserThermostat, property: str, value: str):
+    """Writes value to the thermostat's writeable property (from topic ../<property>/set)"""
+    thermostat.update_thermostat_properties(property_writes(thermostat, property, value))
+
+def property_writes(thermostat: HeatmiserThermostat, property: str, value: str) -> list:
+    """Returns the write of a property command as a list of (WritePropertyData, value)"""
+    return [(thermostat.write_properties[property], value)]
+
+def execute_schedule_command(thermostat: HeatmiserThermostat, day: str, periods: list):
+    """Writes a day of the thermostat's schedule (from topic ../schedule/set)"""
+    execute_schedule_commands(thermostat, {day: periods})
+
+def execute_schedule_commands(thermostat: HeatmiserThermostat, schedule: dict):
+    """Writes days of the thermostat's schedule together, schedule is a dict of day to its periods"""
+    thermostat.update_schedule(schedule)
+
+def execute_climate_command(thermostat: HeatmiserThermostat, cmd: str, value: str):
+    """
+    Applies a home assistant climate command to the thermostat
+    The resulting state is published once the thermostat has been read back
+    """
+    thermostat.update_thermostat_properties(climate_writes(thermostat, cmd, value))
+
+def climate_writes(thermostat: HeatmiserThermostat, cmd: str, value: str) -> list:
+    """Returns the writes of a home assistant climate command as a list of (WritePropertyData, value)"""
+    thermo_name = thermostat.name
+    if cmd == "thermostatModeCmd":
+        # home assistant 'heat' 'off' corresponds to heatmiser 'heat' 'frost protect'
+        if "run_mode" in thermostat.write_properties:
+            if value in ["heat", "off"]:
+                return [(thermostat.write_properties["run_mode"], "heating" if value == "heat" else "frost protect")]
+            _LOGGER.error(f"Home assistant mode command needs to be either 'heat' or 'off', received {value}")
+        else:
+            _LOGGER.error(f"Thermostat {thermo_name} does not have a 'run_mode' property")
+    elif cmd == "targetTempCmd":
+        # TODO check limits and validity of value
+        return [(thermostat.write_properties["room_target_temp"], value)]
+    elif cmd == "presetCmd":
+        holiday_hours = thermostat.write_properties["holiday_hours"]
+        temp_hold_minutes = thermostat.write_properties["temp_hold_minutes"]
+        if value == "hold 1h":
+            return [(holiday_hours, 0), (temp_hold_minutes, 60)]
+        elif value == "holiday 1d":
+            return [(temp_hold_minutes, 0), (holiday_hours, 24)]
+        elif value == "none":
+            return [(temp_hold_minutes, 0), (holiday_hours, 0)]
+    return []
+
+# the function returning the property writes of each kind of command, so they can be coalesced together
+COMMAND_WRITES = {execute_property_command: property_writes, execute_climate_command: climate_writes}
+
+def execute_writes(thermostat: HeatmiserThermostat, writes: dict):
+    """Writes the thermostat's properties together, writes is an ordered dict of dcb address to (WritePropertyData, value)"""
+    thermostat.update_thermostat_properties(list(writes.values()))
+
+def command_worker():
+    """
+    Thread which applies the commands queued by mqtt_on_message, in the order they were received
+    Commands received within COMMAND_WINDOW of each other are coalesced, only the last value written to each field
+    of a thermostat is applied (e.g. while a slider is dragged), whether by a property or a home assistant command,
+    and each thermostat's property and schedule writes are sent together
+    Each thermostat written is then read back straight away and its confirmed state published,
+    those whose commands were all values they already had are not
+    Stops when None is queued
+    """
+    running = True
+    while running:
+        command = command_queue.get()
+        if command is None:
+            break
+        commands = []
+        window_end = time.monotonic() + COMMAND_WINDOW
+        while command is not None:
+            commands.append(command)
+            try:
+                command = command_queue.get(timeout=max(0, window_end - time.monotonic()))
+            except queue.Empty:
+                break
+        else:
+            running = False
+
+        # thermostat name -> (thermostat, dcb address -> (WritePropertyData, value)) in the order written
+        property_writes_by_thermostat = {}
+        schedule_commands = {}
+        for execute, thermostat, cmd, value in commands:
+            if execute in COMMAND_WRITES:
+                writes = property_writes_by_thermostat.setdefault(thermostat.name, (thermostat, {}))[1]
+                try:
+                    new_writes = COMMAND_WRITES[execute](thermostat, cmd, value)
+                except Exception as ex:
+                    _LOGGER.error(f"Unable to apply {cmd} = {value} to thermostat '{thermostat.name}': {ex}")
+                    continue
+                for property, property_value in new_writes:
+                    # the last write to a field wins and takes its place in the order
+                    writes.pop(property.dcb_offset, None)
+                    writes[property.dcb_offset] = (property, property_value)
+            elif execute is execute_schedule_command:
+                schedule_commands.setdefault(thermostat.name, (thermostat, {}))[1][cmd] = value
+            else:
+                apply_command(execute, thermostat, cmd, value)
+        for thermostat, writes in property_writes_by_thermostat.values():
+            if len(writes) > 0:
+                apply_command(execute_writes, thermostat, writes)
+        for thermostat, schedule in schedule_commands.values():
+            apply_command(execute_schedule_commands, thermostat, schedule)
+        for thermostat in {thermostat.name: thermostat for _, thermostat, _, _ in commands}.values():
+            if thermostat.writes_pending():
+                confirm_writes(thermostat)
+    _LOGGER.debug("Command worker stopped")
+
+def confirm_writes(thermostat: HeatmiserThermostat):
+    """Reads back what has been written to the thermostat and publishes its state, so home assistant sees it within a second"""
+    if thermostats.get(thermostat.name) is not thermostat:
+        # retired while the command was queued
+        return
+    try:
+        if thermostat.confirm_writes():
+            publish_thermostat(thermostat)
+    except Exception as ex:
+        _LOGGER.error(f"Error reading back thermostat {thermostat.name}: {ex}")
+
+def apply_command(execute, thermostat: HeatmiserThermostat, *args):
+    """Calls execute(thermostat, *args) logging any error"""
+    try:
+        execute(thermostat, *args)
+    except Exception as ex:
+        _LOGGER.error(f"Unable to apply {' = '.join(str(arg) for arg in args)} to thermostat '{thermostat.name}': {ex}")
+# end mqtt commands-------------
+
 # mqtt publishing-------------
-def publish_base(client : mqtt_client, topic : str, payload : str):
+def publish_base(client : mqtt_client, topic : str, payload : str, retain : bool = False, from_outbox : bool = False):
     """
     Publishes to the mqtt broker on topic with payload
     Returns True or False depending on publishing success
+    A message which can't be published because the broker isn't connected or too many are queued is held in
+    the outbox, replacing any held on the same topic, and published when the broker is next connected
+    While the outbox is being flushed messages are held in it too, so they are published after those held before
+    from_outbox: the message is being flushed from the outbox, it is neither held nor held again if publishing fails
     """
-    result = client.publish(topic, payload)
+    if not from_outbox and outbox.hold(topic, payload, retain):
+        return True
+    result = client.publish(topic, payload, retain=retain)
     if result.rc == mqtt_client.MQTT_ERR_SUCCESS:
         try:
             result.wait_for_publish(timeout=0)
             return True
         except ValueError:
             _LOGGER.error(f"Failed to publish topic {topic} with {payload}, queue full")
+            if not from_outbox:
+                outbox.put(topic, payload, retain)
         except RuntimeError as re:
             _LOGGER.error(f"Failed to publish topic {topic} with {payload}, error: {re}")
         # except Exception as ex:
         #     _LOGGER.error(f"Failed to publish {value} on topic {topic}, unexpected error: {ex}")
 
     elif result.rc == mqtt_client.MQTT_ERR_NO_CONN:
-        _LOGGER.error(f"Failed to publish {topic} with {payload}, not connected to mqtt broker")
+        _LOGGER.debug(f"Holding {topic} with {payload}, not connected to mqtt broker")
+        if not from_outbox:
+            outbox.put(topic, payload, retain)
     elif result.rc == mqtt_client.MQTT_ERR_QUEUE_SIZE:
         _LOGGER.error(f"Failed to publish {topic} with {payload}, too many queued")
+        if not from_outbox:
+            outbox.put(topic, payload, retain)
     else:
         _LOGGER.error(f"Failed to publish {topic} with {payload}, unknown return code {result}")
+    _PUBLISH_FAILURES.inc()
     return False
 
+def flush_outbox(client : mqtt_client):
+    """
+    Publishes the messages held in the outbox while disconnected, including those published by the pollers
+    and command worker while it is being flushed, until it is empty
+    If publishing fails the messages not published stay held until the broker is next connected
+    """
+    outbox.start_flush()
+    messages = outbox.take_flush()
+    if len(messages) > 0:
+        _LOGGER.info(f"Publishing {len(messages)} messages held while disconnected ({outbox.coalesced} coalesced and {outbox.dropped} dropped so far)")
+    while len(messages) > 0:
+        for n, (topic, payload, retain) in enumerate(messages):
+            if not publish_base(client, topic, payload, retain, from_outbox=True):
+                outbox.stop_flush(messages[n:])
+                return
+        messages = outbox.take_flush()
+
 def publish(client : mqtt_client, prefix :str, name : str, parameter : str, value : str):
     """
     Publishes to the mqtt broker using a specific topic format prefix/name/parameter
@@ -167,26 +340,286 @@ def publish(client : mqtt_client, prefix :str, name : str, parameter : str, valu
     topic = f"{prefix}/{name}/{parameter}"
     return publish_base(client, topic, value)
 
+def publish_outbox_metrics(published: dict):
+    """
+    Publishes the number of messages held in the outbox and how many have been coalesced and dropped if they have changed
+    published: the values last published, updated with those published
+    """
+    metrics = {"outbox_depth": len(outbox), "outbox_coalesced": outbox.coalesced, "outbox_dropped": outbox.dropped}
+    for key, value in metrics.items():
+        _OUTBOX.set(value, key.replace("outbox_", ""))
+    if not client.connected_flag:
+        return
+    for key, value in metrics.items():
+        if published.get(key) != value and publish_base(client, f"{args.mqtt_prefix}/{key}", value):
+            published[key] = value
+
+def has_climate(thermostat: HeatmiserThermostat) -> bool:
+    """Returns True if the thermostat controls heating (a home assistant climate), False if it is a timer (TM1)"""
+    return HeatmiserThermostat.LAYOUTS[thermostat.model].field("Room Target Temp") is not None
+
+def config_topics(thermostat: HeatmiserThermostat) -> list:
+    """Returns the topics of a thermostat's home assistant discovery configurations"""
+    name = thermostat.name
+    if args.ha_device_discovery:
+        return [f"{DEVICEDISCOVERYBASE}/{name}/config"]
+    if not has_climate(thermostat):
+        return [f"{SWITCHDISCOVERYBASE}/{name}/config"]
+    return [f"{CLIMATEDISCOVERYBASE}/{name}/config", f"{SENSORDISCOVERYBASE}/{name}_Current_Temp/config"]
+
+def availability_topics(thermostat: HeatmiserThermostat) -> list:
+    """Returns the topics of the availability of a thermostat's home assistant entities"""
+    name = thermostat.name
+    if not has_climate(thermostat):
+        return [f"{SWITCHDISCOVERYBASE}/{name}/available"]
+    return [f"{CLIMATEDISCOVERYBASE}/{name}/available", f"{SENSORDISCOVERYBASE}/{name}_Current_Temp/available"]
+
 def publish_config(thermostat: HeatmiserThermostat):
     """
     Publish the home assistant configuration data to homeassistant/config for discovery
     This is needed for home assistant to configure climate controls for each thermostat
-    Needed at startup and every time home assistant publishes homeassistant/status as "online"
+    The configurations are built once and only published again if they change
+    or home assistant publishes homeassistant/status as "online"
     """
-    _LOGGER.info("Publishing home assistant discovery config")
     name = thermostat.name
     read_props = thermostat.read_properties
-    topic = f"{CLIMATEDISCOVERYBASE}/{name}"
-    payload = ha_climate_config(name, thermostat.address, read_props["Units"], read_props['Vendor'], 
-        read_props["Type"], read_props["Version"])
-    publish_base(client, topic + "/config", payload)
-    
-    topic = f"{SENSORDISCOVERYBASE}/{name}_Current_Temp"
-    payload = ha_sensor_config(name, "Current Temp", thermostat.address, read_props["Units"], read_props['Vendor'], 
-        read_props["Type"], read_props["Version"])
-    publish_base(client, topic + "/config", payload)
+    state_topic = publishers[name].state_topic if args.json_state else None
+    if not has_climate(thermostat):
+        # a timer, whose state is switched
+        details = (publishers[name].topic("Timer State"), read_props['Vendor'], read_props["Type"], read_props["Version"])
+
+        def build():
+            _LOGGER.info(f"Building home assistant discovery config for {name}")
+            config = ha_timer_device_config if args.ha_device_discovery else ha_timer_config
+            return [(config_topics(thermostat)[0], config(name, thermostat.address, *details, state_topic))]
+    else:
+        details = (read_props["Units"], read_props['Vendor'], read_props["Type"], read_props["Version"])
+
+        def build():
+            _LOGGER.info(f"Building home assistant discovery config for {name}")
+            topics = config_topics(thermostat)
+            if args.ha_device_discovery:
+                return [(topics[0], ha_device_config(name, "Current Temp", thermostat.address, *details, state_topic))]
+            return [(topics[0], ha_climate_config(name, thermostat.address, *details, state_topic)),
+                (topics[1], ha_sensor_config(name, "Current Temp", thermostat.address, *details, state_topic))]
+
+    for topic, payload in discovery_configs.configs(name, details, build):
+        discovery_configs.publish(topic, payload)
 # end mqtt publishing-------------
 
+# networks-------------
+def command_topics(thermostat: HeatmiserThermostat) -> list:
+    """Returns the topics to which a thermostat's commands are published"""
+    name = thermostat.name
+    # Use a single level wildcard (+) to subscribe to all "set" topics for this thermostat
+    # (which includes a timer's home assistant switch commands)
+    topics = [f'{args.mqtt_prefix}/{name}/+/set']
+    if args.homeassistant and has_climate(thermostat):
+        # the special home assistant climate topics
+        topics += [f"{CLIMATEDISCOVERYBASE}/{name}/{cmd}" for cmd in ["thermostatModeCmd", "targetTempCmd", "presetCmd"]]
+    return topics
+
+def remember_thermostats(hub: HeatmiserHub):
+    """Saves the thermostats on the hub's network in the discovery cache"""
+    discovery_cache.update(hub.name(), {address: thermostat.model for address, thermostat in hub.thermostats.items()})
+
+def find_thermostats(hub: HeatmiserHub) -> list:
+    """
+    Creates the thermostats on the hub's network, those added later are found by background discovery
+    The thermostats in the discovery cache are used if there are any, otherwise the network is scanned
+    Returns a list of the thermostats
+    """
+    known = {address: model for address, model in discovery_cache.thermostats(hub.name()).items() if address <= args.max_address}
+    if len(known) > 0:
+        # read the thermostats found last time straight away and look for any others in the background
+        _LOGGER.info(f"Using the {len(known)} thermostats previously found on '{hub.name()}'")
+        found = {address: (model, None) for address, model in known.items()}
+    else:
+        _LOGGER.info(f"Scanning '{hub.name()}' for thermostats from address 0 to {args.max_address}")
+        found = scan(hub, range(0, args.max_address + 1))
+    new_thermostats = []
+    for address, (thermostat_type, frame) in found.items():
+        name = f"{hub.name()}_{address}"
+        new_thermostats.append(HeatmiserThermostat(address, thermostat_type, hub, name, args.full_read_interval, frame))
+    if len(new_thermostats) < 1:
+        _LOGGER.warning(f"Unable to find any thermostats on hub '{hub.name()}'")
+    remember_thermostats(hub)
+    return new_thermostats
+
+def add_thermostat(thermostat: HeatmiserThermostat):
+    """
+    Adds a thermostat to those read by the network's poller
+    Creates its publisher and subscribes to its writeable properties (in mqtt)
+    """
+    name = thermostat.name
+    # Each thermostat's data are published through a publisher which only sends changes
+    publishers[name] = ThermostatPublisher(lambda topic, payload: publish_base(client, topic, payload),
+        args.mqtt_prefix, thermostat, args.republish_interval, args.json_state)
+    for topic in command_topics(thermostat):
+        _LOGGER.debug(f"Subscribing to {topic}")
+        client.subscribe(topic)
+    thermostats[name] = thermostat
+
+def retire_thermostat(thermostat: HeatmiserThermostat, hub: HeatmiserHub, background_discovery: BackgroundDiscovery):
+    """
+    Removes a thermostat which has stopped replying, undoing add_thermostat
+    Its home assistant discovery configurations are removed and its address is probed again by background discovery
+    """
+    name = thermostat.name
+    _LOGGER.info(f"Removing thermostat '{name}', no reply for {int(thermostat.offline_time())}s")
+    del thermostats[name]
+    del publishers[name]
+    for topic in command_topics(thermostat):
+        client.unsubscribe(topic)
+    if args.homeassistant:
+        discovery_configs.remove(name, config_topics(thermostat))
+    hub.unregisterThermostat(thermostat)
+    background_discovery.forget(thermostat.address)
+    _CLOCK_DRIFT.remove(hub.name(), name)
+    remember_thermostats(hub)
+
+def publish_thermostat(thermostat: HeatmiserThermostat):
+    """Publishes what has changed in the thermostat's data after it has been read, including the home assistant topics"""
+    name = thermostat.name
+    publisher = publishers[name]
+    climate_topic_base = f"{CLIMATEDISCOVERYBASE}/{name}"
+    # publish the readable properties that have changed on mqtt
+    publisher.publish_properties()
+    if args.homeassistant:
+        # publish the home assistant discovery topics (if they have changed)
+        publish_config(thermostat)
+        for topic in availability_topics(thermostat):
+            publisher.publish(topic, "online")
+        if args.json_state or not has_climate(thermostat):
+            # home assistant reads the climate and sensor states from the json state document
+            # and a timer's switch state from its timer_state topic
+            return
+        # publish the home assistant special topics for climate
+        mode = "heat" if thermostat.read_properties["Run Mode"] == "heating" else "off"
+        try:
+            current_temp = str(int(float(thermostat.read_properties["Built-in Sensor Temp"])))
+        except ValueError:
+            # "not connected", unknown to home assistant as with the json state's template
+            current_temp = "None"
+        target_temp = str(int(float(thermostat.read_properties["Room Target Temp"])))
+        publisher.publish(climate_topic_base + "/mode", mode)
+        publisher.publish(climate_topic_base + "/target_temp", target_temp)
+        publisher.publish(climate_topic_base + "/current_temp", current_temp)
+        thm = thermostat.read_properties["Temp Hold Minutes"]
+        hh = thermostat.read_properties["Holiday Hours"]
+        if thm == 0 and hh == 0:
+            preset = "none"
+        elif hh > 0:
+            preset = "holiday 1d"
+        elif thm > 0:
+            preset = "hold 1h"
+        publisher.publish(climate_topic_base + "/presetState", preset)
+
+def sync_clock(thermostat: HeatmiserThermostat, hub: HeatmiserHub, clock_sync: ClockSync):
+    """Sets the thermostat's clock if it has drifted too far and publishes its drift"""
+    drift = clock_sync.check(thermostat)
+    if drift is None:
+        # it has no clock
+        return
+    _CLOCK_DRIFT.set(drift, hub.name(), thermostat.name)
+    publisher = publishers[thermostat.name]
+    publisher.publish(publisher.topic("Clock Drift"), drift)
+
+def poll_thermostat(thermostat: HeatmiserThermostat, hub: HeatmiserHub, background_discovery: BackgroundDiscovery,
+        clock_sync: ClockSync = None):
+    """
+    Reads the thermostat, unless it is offline and backing off, and publishes its data
+    Its clock is then checked against the host's time by clock_sync, if given
+    Returns the time in seconds taken by the read or None if it was not read
+    """
+    if not thermostat.read_due():
+        # offline and backing off
+        return None
+    name = thermostat.name
+    publisher = publishers[name]
+    publisher.refresh()
+    was_online = thermostat.online()
+    # read the physical thermostat
+    start = time.monotonic()
+    read_ok = thermostat.read_thermostat()
+    duration = time.monotonic() - start
+    if read_ok:
+        publish_thermostat(thermostat)
+        if clock_sync is not None:
+            sync_clock(thermostat, hub, clock_sync)
+    elif was_online and not thermostat.online():
+        # the thermostat has just gone offline, everything is published again when it comes back
+        publisher.invalidate()
+        if args.homeassistant:
+            # indicate it's offline
+            for topic in availability_topics(thermostat):
+                publish_base(client, topic, "offline")
+    elif thermostat.offline_time() > RETIRE_TIME:
+        retire_thermostat(thermostat, hub, background_discovery)
+        if clock_sync is not None:
+            clock_sync.forget(thermostat)
+    return duration
+
+def poll_network(hub: HeatmiserHub, background_discovery: BackgroundDiscovery):
+    """
+    Thread which reads the thermostats on one network as they fall due, until stopping is set
+    Each network has its own poller so the networks are read in parallel
+    The thermostats found by background discovery are added as they are found
+    """
+    scheduler = PollScheduler(args.scan_interval)
+    clock_sync = ClockSync(args.clock_sync_threshold)
+    next_report_time = datetime.now() + timedelta(seconds=args.scan_interval)
+    # when each thermostat was last polled (time.monotonic), for the poll cycle time
+    poll_times = {}
+    while not stopping.is_set():
+        wait = 1
+        try:
+            for address, thermostat_type, frame in background_discovery.found():
+                thermostat = HeatmiserThermostat(address, thermostat_type, hub, f"{hub.name()}_{address}", args.full_read_interval, frame)
+                add_thermostat(thermostat)
+                remember_thermostats(hub)
+                if thermostat.connected():
+                    # publish what was read by the probe, the rest is published by the next scan
+                    publishers[thermostat.name].publish_properties()
+                    if args.homeassistant:
+                        publish_config(thermostat)
+            scheduler.sync(hub.thermostats.values())
+            thermostat, wait = scheduler.next()
+            if thermostat is not None and wait <= 0:
+                now = time.monotonic()
+                if thermostat.name in poll_times:
+                    _POLL_CYCLE.observe(now - poll_times[thermostat.name], hub.name())
+                poll_times[thermostat.name] = now
+                try:
+                    duration = poll_thermostat(thermostat, hub, background_discovery, clock_sync)
+                except Exception:
+                    # read it again after the slow interval rather than straight away
+                    scheduler.failed(thermostat)
+                    raise
+                scheduler.record(thermostat, duration)
+                wait = 0
+            if datetime.now() > next_report_time:
+                next_report_time = datetime.now() + timedelta(seconds=args.scan_interval)
+                utilisation = scheduler.utilisation()
+                _LOGGER.debug(f"Bus utilisation of '{hub.name()}' {utilisation:.1%}")
+                _BUS_UTILISATION.set(utilisation, hub.name())
+                publish_base(client, f"{args.mqtt_prefix}/{hub.name()}/bus_utilisation", round(utilisation, 3))
+        except Exception as ex:
+            _LOGGER.error(f"Unexpected exception polling '{hub.name()}': {ex}")
+            wait = 1
+        # wake at least every second to add any thermostats found
+        stopping.wait(min(wait, 1))
+    _LOGGER.debug(f"Poller for '{hub.name()}' stopped")
+# end networks-------------
+
+# Metrics, see metrics.py (the bus transaction metrics are in heatmiserHub.py)
+_BUS_UTILISATION = METRICS.gauge("heatmiser_bus_utilisation", "Fraction of the bus time used by polling over the last minute", ("network",))
+_CLOCK_DRIFT = METRICS.gauge("heatmiser_clock_drift_seconds", "Seconds a thermostat's clock is ahead of the host's time", ("network", "thermostat"))
+_POLL_CYCLE = METRICS.histogram("heatmiser_poll_cycle_seconds", "Time between polls of a thermostat", ("network",), CYCLE_BUCKETS)
+_PUBLISH_FAILURES = METRICS.counter("heatmiser_mqtt_publish_failures_total", "Messages which couldn't be published straight away")
+# messages held in the outbox (depth) and held messages replaced by a later one (coalesced) or dropped since startup
+_OUTBOX = METRICS.gauge("heatmiser_mqtt_outbox", "Messages held while the mqtt broker is disconnected", ("count",))
+
 
 # Executable code starts here
 if __name__ == '__main__':
@@ -201,29 +634,54 @@ if __name__ == '__main__':
 
     def check_min(value):
         ivalue = int(value)
-        if ivalue < 60:
-            raise argparse.ArgumentTypeError(f"{value} needs to be >= 60")
+        if ivalue < 1:
+            raise argparse.ArgumentTypeError(f"{value} needs to be >= 1")
+        return ivalue
+    def check_zero_or_more(value):
+        ivalue = int(value)
+        if ivalue < 0:
+            raise argparse.ArgumentTypeError(f"{value} needs to be >= 0")
         return ivalue
     def check_byte(value):
         ivalue = int(value)
         if ivalue < 0 or ivalue > 255:
             raise argparse.ArgumentTypeError(f"{value} needs to be between 0 and 255")
         return ivalue
+    def check_bool(value):
+        if value.lower() not in ["true", "false"]:
+            raise argparse.ArgumentTypeError(f"{value} needs to be true or false")
+        return value.lower() == "true"
 
     # define command line arguments
     parser = argparse.ArgumentParser(description='Heatmiser Thermostat with mqtt Communications')
-    parser.add_argument('--device', '-d', type=str, help='The physical device controlling the network (e.g. /dev/ttyUSB0)')
-    parser.add_argument('--network_name', '-n', type=str, default="heatmiser_network", help='The name of the network (default heatmiser_network)')
+    parser.add_argument('--device', '-d', type=str, nargs='+', required=True, help='The physical device controlling the network (e.g. /dev/ttyUSB0), or a list of devices one per network')
+    parser.add_argument('--network_name', '-n', type=str, nargs='+', help='The name of the network, or a list of names one per device (default heatmiser_network, or heatmiser_network_1, heatmiser_network_2... for several devices)')
     parser.add_argument('--mqtt_host', '-mh', type=str, help='The url or IP address of the mqtt broker')
     parser.add_argument('--mqtt_port', '-mt', type=int, default=1883, help='The port of the mqtt broker (default 1883)')
     parser.add_argument('--mqtt_prefix', '-mx', type=str, default=HEATMISER, help=f"The mqtt topic prefix (default {HEATMISER})")
     parser.add_argument('--mqtt_username', '-mu', required=True, type=str, help='The mqtt broker username')
     parser.add_argument('--mqtt_password', '-mp', required=True, type=str, help='The mqtt broker password')
-    parser.add_argument('--scan_interval', '-s', type=check_min, default=60, metavar='[>=60]', help='The interval in seconds between network scans (default 60)')
+    parser.add_argument('--scan_interval', '-s', type=check_min, default=60, metavar='[>=1]', help=f"The normal interval in seconds between reads of each thermostat, {FAST_FACTOR} times shorter while heating or the temperature is changing and {SLOW_FACTOR} times longer (up to {MAX_SLOW_INTERVAL}s) while the temperature is stable, reads are spread out to use at most {int(BUS_BUDGET * 100)}%% of the bus (default 60)")
     parser.add_argument('--max_address', '-m', type=check_byte, default=10, metavar='[0-255]', help='The maximum address to try when looking for thermostats (default 10)')
+    parser.add_argument('--full_read_interval', '-f', type=check_zero_or_more, default=FULL_READ_INTERVAL, metavar='[>=0]', help=f"The number of reads of only the fast changing thermostat data between reads of all the data (default {FULL_READ_INTERVAL}, 0 always reads all)")
+    parser.add_argument('--republish_interval', '-r', type=check_zero_or_more, default=REPUBLISH_INTERVAL, metavar='[>=0]', help=f"The interval in seconds at which all thermostat data are republished, in between only changes are published (default {REPUBLISH_INTERVAL}, 0 publishes everything on every scan)")
+    parser.add_argument('--discovery_cache', '-c', type=str, default=DISCOVERY_CACHE, help=f"The file in which the thermostats found are remembered, so a restart reads them straight away and scans the other addresses in the background (default {DISCOVERY_CACHE}, '' to always scan at startup)")
+    parser.add_argument('--outbox_size', '-o', type=check_min, default=OUTBOX_SIZE // 1024, metavar='[>=1]', help=f"The maximum size in kB of the messages held while the mqtt broker is disconnected, only the latest message on each topic is held and published on reconnection (default {OUTBOX_SIZE // 1024})")
+    parser.add_argument('--clock_sync_threshold', type=check_zero_or_more, default=CLOCK_SYNC_THRESHOLD, metavar='[>=0]', help=f"The drift in seconds of a thermostat's clock from the host's local time above which it is set to the host's time, the drift is published on <mqtt_prefix>/<thermostat>/clock_drift (default {CLOCK_SYNC_THRESHOLD}, 0 never sets the clocks)")
+    parser.add_argument('--metrics_port', type=check_zero_or_more, default=METRICS_PORT, metavar='[>=0]', help=f"The port of the http endpoint serving metrics in the Prometheus text format on /metrics (default {METRICS_PORT}, 0 disables it)")
+    parser.add_argument('--diagnostics_interval', type=check_zero_or_more, default=0, metavar='[>=0]', help="The interval in seconds at which a json summary of the metrics is published to <mqtt_prefix>/diagnostics (default 0, disabled)")
+    parser.add_argument('--json_state', '-j', type=check_bool, default=False, metavar='[true|false]', help=f"Publish each thermostat's data as one json document on <mqtt_prefix>/<thermostat>/{STATE_TOPIC}, which the Home Assistant discovery configs read with value templates, instead of a topic per property (default false)")
+    parser.add_argument('--ha_device_discovery', '-hd', type=check_bool, default=False, metavar='[true|false]', help="Use Home Assistant's device based discovery, one retained configuration per thermostat for all its entities (default false)")
     parser.add_argument('--homeassistant', '-ha', type=bool, default=True, help='Integrate with Home Assistant discovery (default True')
     parser.add_argument('--loglevel', '-l', type=str, default='info', choices=['debug','info','notice','warning','error'], metavar='[debug|info|notice|warning|error]', help='The log level logging will report (default info)')
     args = parser.parse_args()
+    network_names = args.network_name
+    if network_names is None:
+        network_names = ["heatmiser_network"] if len(args.device) == 1 else [f"heatmiser_network_{n + 1}" for n in range(len(args.device))]
+    if len(network_names) != len(args.device):
+        parser.error(f"{len(args.device)} devices need {len(args.device)} network names, {len(network_names)} supplied")
+    if len(set(network_names)) != len(network_names):
+        parser.error("network names must be unique")
 
     # set the logging level of all modules
     log_level = args.loglevel.upper()
@@ -231,35 +689,47 @@ if __name__ == '__main__':
     logging.getLogger(HEATMISER).setLevel(log_level)
     logging.getLogger('heatmiserHub').setLevel(log_level)
     logging.getLogger('heatmiserThermostat').setLevel(log_level)
+    logging.getLogger('discovery').setLevel(log_level)
+    logging.getLogger('clockSync').setLevel(log_level)
 
     _LOGGER.info('Startup')
 
     # generate client ID randomly
     client_id = f'{args.mqtt_prefix}-mqtt-{random.randint(0, 100)}'
 
-    # Create a communications hub on the serial device
-    _LOGGER.info(f"Using '{args.device}', scan interval {args.scan_interval}s")
-    hub = HeatmiserHub(args.device, args.network_name)
-    _LOGGER.info(f"Scanning '{hub.name()}' for thermostats from address 0 to {args.max_address}")
-    # Create all the thermostats on this network/device
-    # TODO this could be performed routinely to pick up network changes (move to main loop?)...
-    thermostats = {}
-    for address in range(0, args.max_address + 1):
-        _LOGGER.info(f"Scanning {hub.name()} address {address}")
-        thermostat_type = HeatmiserThermostat.getThermostatType(hub, address)
-        if thermostat_type != False:
-            _LOGGER.info(f"Found {thermostat_type} at address {address}")
-            name = f"{hub.name()}_{address}"
-            thermostats[name] = HeatmiserThermostat(address, thermostat_type, hub,  name)
-    if len(thermostats) < 1:
-        _LOGGER.error(f"Unable to find any thermostats on hub '{hub.name()}'")
+    metrics_server = None
+    if args.metrics_port > 0:
+        try:
+            metrics_server = MetricsServer(args.metrics_port)
+            metrics_server.start()
+        except OSError as ex:
+            _LOGGER.error(f"Unable to serve metrics on port {args.metrics_port}: {ex}")
+            metrics_server = None
+
+    # Create a communications hub on each serial device
+    _LOGGER.info(f"Using {', '.join(args.device)}, scan interval {args.scan_interval}s")
+    hubs = [HeatmiserHub(device, network_name) for device, network_name in zip(args.device, network_names)]
+    # Create all the thermostats on the networks, each network is scanned in parallel
+    discovery_cache = DiscoveryCache(args.discovery_cache)
+    with ThreadPoolExecutor(max_workers=len(hubs)) as executor:
+        new_thermostats = list(executor.map(find_thermostats, hubs))
+    if sum(len(network_thermostats) for network_thermostats in new_thermostats) < 1:
+        _LOGGER.error("Unable to find any thermostats")
         sys.exit(1)
 
-    # Create an mqtt client
+    # mqtt commands are applied to the thermostats away from the mqtt network thread
+    command_queue = queue.Queue()
+    command_thread = threading.Thread(target=command_worker, name="mqtt-commands", daemon=True)
+    command_thread.start()
+
+    # Create an mqtt client, shared by all the networks
     client = mqtt_client.Client(client_id)
     client.username_pw_set(args.mqtt_username, args.mqtt_password)
     client.on_connect = mqtt_on_connect
     client.on_message = mqtt_on_message
+    client.on_disconnect = mqtt_on_disconnect
+    # messages which can't be published while the broker is disconnected
+    outbox = Outbox(args.outbox_size * 1024)
     # Connect and wait for connection (or failure/timeout)
     timeout_time = datetime.now() + timedelta(seconds=10)
     con_code = client.connect(args.mqtt_host, args.mqtt_port)
@@ -274,93 +744,68 @@ if __name__ == '__main__':
             _LOGGER.error("Failed to connect to mqtt broker, timeout")
             sys.exit()   
 
-    # Subscribe to the writeable properties of every thermostat (in mqtt)
-    for name in thermostats:
-        thermostat = thermostats[name]
-        # Use a single level wildcard (+) to subscribe to all "set" topics for this thermostat
-        topic = f'{args.mqtt_prefix}/{name}/+/set'
-        _LOGGER.debug(f"Subscribing to {topic}")
-        client.subscribe(topic)
+    # all the thermostats by name, their names include the network name so are unique
+    thermostats = {}
+    publishers = {}
+    # the home assistant discovery configurations published, device based configurations are retained
+    discovery_configs = DiscoveryConfigs(lambda topic, payload: publish_base(client, topic, payload, args.ha_device_discovery))
+    for network_thermostats in new_thermostats:
+        for thermostat in network_thermostats:
+            add_thermostat(thermostat)
+    if args.homeassistant:
+        # home assistant publishes online when it starts, it then needs the discovery configurations
+        client.subscribe(f"{HOMEASSISTANT}/status")
 
-        if args.homeassistant:
-            # subscribe to the special home assistant climate topics
-            client.subscribe(f"{CLIMATEDISCOVERYBASE}/{name}/thermostatModeCmd")
-            client.subscribe(f"{CLIMATEDISCOVERYBASE}/{name}/targetTempCmd")
-            client.subscribe(f"{CLIMATEDISCOVERYBASE}/{name}/presetCmd")
+    stopping = threading.Event()
+    pollers = []
+    for hub, network_thermostats in zip(hubs, new_thermostats):
+        # look for thermostats added to the network (or not found at startup) while the bus is idle
+        background_discovery = BackgroundDiscovery(hub, range(0, args.max_address + 1), [thermostat.address for thermostat in network_thermostats])
+        background_discovery.start()
+        poller = threading.Thread(target=poll_network, args=(hub, background_discovery), name=f"poll-{hub.name()}", daemon=True)
+        poller.start()
+        pollers.append((poller, background_discovery))
 
-    published_config = False
-    
     # main loop
     try:
         # enable capture of SIGINT and SIGTERM so we can shut down gracefully if run interactively (via ctrl-C) or via daemon (SIGINT/SIGTERM)
         killer = GracefulKiller(sigint=True, sigterm=True)
-        # loop every second
-        last_read_time = datetime.min
-        next_scan_time = datetime.now()
+        # the networks are read by their pollers, loop every second
+        outbox_metrics = {}
+        next_diagnostics_time = time.monotonic() + args.diagnostics_interval
         while not killer.kill_now:
-            if datetime.now() > next_scan_time:
-                next_scan_time = datetime.now() + timedelta(seconds=args.scan_interval)
-                for name in thermostats:
-                    thermostat = thermostats[name]
-                    # read the physical thermostat
-                    climate_topic_base = f"{CLIMATEDISCOVERYBASE}/{name}"
-                    sensor_topic_base = f"{SENSORDISCOVERYBASE}/{name}_Current_Temp"
-                    if thermostat.read_thermostat():
-                        read_props = thermostat.read_properties
-                        # publish the readable properties on mqtt
-                        for key in read_props:
-                            publish(client, args.mqtt_prefix, thermostat.name, str(key).lower().replace(" ", "_"), read_props[key])
-                        if args.homeassistant:
-                            if not published_config:
-                                # publish a home assistant dicsovery topic for a climate device
-                                publish_config(thermostat)
-                                client.subscribe(f"{HOMEASSISTANT}/status")
-                                published_config = True
-                            # publish the home assistant special topics for climate
-                            mode = "heat" if thermostat.read_properties["Run Mode"] == "heating" else "off"
-                            current_temp = str(int(float(thermostat.read_properties["Built-in Sensor Temp"])))
-                            target_temp = str(int(float(thermostat.read_properties["Room Target Temp"])))
-                            publish_base(client, climate_topic_base + "/available", "online")
-                            publish_base(client, climate_topic_base + "/mode", mode)
-                            publish_base(client, climate_topic_base + "/target_temp", target_temp)
-                            publish_base(client, climate_topic_base + "/current_temp", current_temp)
-                            thm = thermostat.read_properties["Temp Hold Minutes"]
-                            hh = thermostat.read_properties["Holiday Hours"]
-                            if thm == 0 and hh == 0:
-                                preset = "none"
-                            elif hh > 0:
-                                preset = "holiday 1d"
-                            elif thm > 0:
-                                preset = "hold 1h"
-                            publish_base(client, climate_topic_base + "/presetState", preset)
-
-                            # publish the home assistant special topics for sensor (current temperature)
-                            publish_base(client, sensor_topic_base + "/available", "online")
-
-                    elif args.homeassistant:
-                        # unable to read thermostat so indicate it's offline
-                        publish_base(client, climate_topic_base + "/available", "offline")
-                        publish_base(client, sensor_topic_base + "/available", "offline")
-                        published_config = False
-
-                _LOGGER.debug("Waiting for next scan...")
             time.sleep(1)
+            publish_outbox_metrics(outbox_metrics)
+            if args.diagnostics_interval > 0 and time.monotonic() >= next_diagnostics_time:
+                next_diagnostics_time += args.diagnostics_interval
+                publish_base(client, f"{args.mqtt_prefix}/diagnostics", json.dumps(METRICS.snapshot()))
 
         _LOGGER.info('Shut down request')
 
     except Exception as ex:
         _LOGGER.error(f'Unexpected exception {ex}')
 
+    stopping.set()
+    for poller, background_discovery in pollers:
+        background_discovery.stop()
+        poller.join()
+    _LOGGER.info("Stopped network pollers")
+    command_queue.put(None)
+    command_thread.join()
+    _LOGGER.info("Stopped mqtt command worker")
     for name in thermostats:
         thermostat = thermostats[name]
         if args.homeassistant:
             # publish the home assistant discovery topics to indicate offline
-            climate_topic_base = f"{CLIMATEDISCOVERYBASE}/" + name
-            publish_base(client, climate_topic_base + "/available", "offline")
-            sensor_topic_base = f"{SENSORDISCOVERYBASE}/{name}_Current_Temp"
-            publish_base(client, sensor_topic_base + "/available", "offline")
+            for topic in availability_topics(thermostat):
+                publish_base(client, topic, "offline")
+    for hub in hubs:
+        hub.stop()
+    _LOGGER.info("Stopped bus workers")
     client.disconnect()
     _LOGGER.info("Disconected from mqtt broker")
     client.loop_stop()
     _LOGGER.info("Stopped background mqtt loop")
+    if metrics_server is not None:
+        metrics_server.stop()
     
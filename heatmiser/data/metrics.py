@@ -0,0 +1,198 @@
+"""Module of counters, gauges and histograms exposed in the Prometheus text format over http"""
+import http.server
+import logging
+import math
+import threading
+
+# Round trip times of bus transactions, a short write takes tens of ms and the longest read about 0.7s at 4800 baud
+TRANSACTION_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# Times between reads of a thermostat
+CYCLE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800)
+# Default port of the http endpoint, 0 disables it
+METRICS_PORT = 0
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    """Returns the labels of a sample, e.g. {network="house",function="read"}"""
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    """A metric with a value for each combination of its label values"""
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple, lock: threading.Lock):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = lock
+
+    def _key(self, label_values: tuple) -> tuple:
+        if len(label_values) != len(self.labels):
+            raise ValueError(f"Metric {self.name} needs labels {self.labels}, {label_values} supplied")
+        return tuple(str(value) for value in label_values)
+
+    def remove(self, *label_values):
+        """Removes the value for label_values (e.g. of a retired thermostat)"""
+        with self._lock:
+            self._values.pop(self._key(label_values), None)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_label_text(self.labels, label_values)} {_number(value)}")
+        return lines
+
+    def snapshot(self) -> dict:
+        return {"/".join(label_values) or self.name: value for label_values, value in self._values.items()}
+
+
+class Counter(_Metric):
+    """A count which only increases"""
+    type = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value which can go up and down"""
+    type = "gauge"
+
+    def set(self, value: float, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Counts of observations no greater than each bucket's upper bound, with their count and sum"""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple, lock: threading.Lock, buckets: tuple):
+        super().__init__(name, help, labels, lock)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # a count per bucket and the sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[n] += 1
+            counts[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for label_values, counts in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, label_values, le)} {count}")
+            labels = _label_text(self.labels, label_values)
+            lines.append(f"{self.name}_count{labels} {counts[-2]}")
+            lines.append(f"{self.name}_sum{labels} {_number(counts[-1])}")
+        return lines
+
+    def snapshot(self) -> dict:
+        # the number of observations and their mean
+        return {"/".join(label_values) or self.name: {"count": counts[-2], "mean": counts[-1] / counts[-2] if counts[-2] else 0}
+            for label_values, counts in self._values.items()}
+
+
+class Metrics(object):
+    """
+    The metrics of the process, created by the modules which update them
+    Updated from the bus workers, pollers and mqtt threads and read by the http server
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, help, labels, self._lock))
+
+    def gauge(self, name: str, help: str, labels: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels, self._lock))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = TRANSACTION_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, self._lock, buckets))
+
+    def render(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            lines = []
+            for metric in self._metrics.values():
+                lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Returns the metrics as a dict of name to {labels: value}, histograms as their count and mean"""
+        with self._lock:
+            return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+
+# The metrics shared by the modules of the process
+METRICS = Metrics()
+
+
+class MetricsServer(object):
+    """Serves the metrics on http://<host>:port/metrics from a thread"""
+
+    def __init__(self, port: int, metrics: Metrics = METRICS):
+        self._metrics = metrics
+        metrics_server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics_server._metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                _LOGGER.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+        self._server = http.server.ThreadingHTTPServer(("", port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+
+    def start(self):
+        """Starts serving"""
+        self._thread.start()
+        _LOGGER.info(f"Serving metrics on port {self._server.server_address[1]}")
+
+    def stop(self):
+        """Stops serving"""
+        self._server.shutdown()
+        self._server.server_close()
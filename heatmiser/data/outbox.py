@@ -0,0 +1,101 @@
+"""Module to hold mqtt messages which couldn't be published until the broker is connected again"""
+import collections
+import threading
+
+# Maximum size in bytes (of the topics and payloads) of the messages held
+OUTBOX_SIZE = 256 * 1024
+
+
+class Outbox(object):
+    """
+    The latest message on each topic which couldn't be published, oldest first
+    A message replaces (coalesces) any message held on the same topic, so after an outage only the latest
+    state is published, when the outbox is full the oldest messages are dropped
+    While it is being flushed messages published meanwhile are held behind those taken (see hold()),
+    so an older message is never published after a newer one on the same (retained) topic
+    Shared by the pollers, the mqtt command worker and the mqtt network thread which flushes it
+    """
+
+    def __init__(self, max_size: int = OUTBOX_SIZE):
+        self.max_size = max_size
+        # topic -> (payload, retain)
+        self._messages = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flushing = False
+        # messages replaced by a later one on the same topic and dropped because the outbox was full
+        self.coalesced = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _message_size(topic: str, payload) -> int:
+        return len(topic) + len(str(payload))
+
+    def put(self, topic: str, payload, retain: bool = False):
+        """Holds payload until it can be published"""
+        with self._lock:
+            self._put(topic, payload, retain)
+
+    def _put(self, topic: str, payload, retain: bool):
+        size = self._message_size(topic, payload)
+        if topic in self._messages:
+            self.coalesced += 1
+            self._size -= self._message_size(topic, self._messages.pop(topic)[0])
+        if size > self.max_size:
+            self.dropped += 1
+            return
+        while self._size + size > self.max_size:
+            old_topic, (old_payload, _) = self._messages.popitem(last=False)
+            self._size -= self._message_size(old_topic, old_payload)
+            self.dropped += 1
+        self._messages[topic] = (payload, retain)
+        self._size += size
+
+    def hold(self, topic: str, payload, retain: bool = False) -> bool:
+        """Holds payload if the outbox is being flushed, so it is published after the messages taken, returns True if held"""
+        with self._lock:
+            if self._flushing:
+                self._put(topic, payload, retain)
+            return self._flushing
+
+    def start_flush(self):
+        """Starts flushing, until take_flush() finds no messages left or stop_flush()"""
+        with self._lock:
+            self._flushing = True
+
+    def take_flush(self) -> list:
+        """Removes and returns the messages held like take(), when there are none the flush is complete"""
+        with self._lock:
+            if len(self._messages) == 0:
+                self._flushing = False
+            return self._take()
+
+    def stop_flush(self, messages: list):
+        """
+        Stops flushing as publishing has failed, messages (taken but not published, oldest first) are held again
+        ahead of those held since, unless they have been replaced by a later message on the same topic
+        """
+        with self._lock:
+            self._flushing = False
+            for topic, payload, retain in reversed(messages):
+                if topic in self._messages:
+                    self.coalesced += 1
+                    continue
+                self._put(topic, payload, retain)
+                if topic in self._messages:
+                    self._messages.move_to_end(topic, last=False)
+
+    def take(self) -> list:
+        """Removes and returns the messages held as a list of (topic, payload, retain), oldest first"""
+        with self._lock:
+            return self._take()
+
+    def _take(self) -> list:
+        messages = [(topic, payload, retain) for topic, (payload, retain) in self._messages.items()]
+        self._messages.clear()
+        self._size = 0
+        return messages
+
+    def __len__(self):
+        with self._lock:
+            return len(self._messages)
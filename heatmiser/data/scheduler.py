@@ -0,0 +1,134 @@
+"""Module to decide when each thermostat on a network is next read"""
+import collections
+import time
+
+# A thermostat which is heating (or whose temperature is changing) is read this many times as often as normal
+FAST_FACTOR = 4
+# A thermostat whose temperatures have not changed for STABLE_READS reads is read this many times less often
+SLOW_FACTOR = 4
+STABLE_READS = 5
+# Longest interval in seconds between reads of a stable thermostat (unless scan_interval is longer), so its state
+# is published well within the 600s Home Assistant expire_after used in the discovery configs
+MAX_SLOW_INTERVAL = 480
+# Shortest interval in seconds between reads of a thermostat
+MIN_INTERVAL = 1
+# Maximum fraction of the time the bus is used for polling, leaving the rest for writes and discovery
+BUS_BUDGET = 0.5
+# Period in seconds over which the bus utilisation is measured
+UTILISATION_WINDOW = 60
+
+# Read properties which change while a thermostat is active and those which follow the temperature
+_ACTIVE_STATES = {"Heating State": "heat", "Hot Water State": "on"}
+_TEMPERATURES = ("Built-in Sensor Temp", "Remote Sensor Temp", "Floor Sensor Temp")
+
+
+class _Entry(object):
+    """A thermostat's schedule"""
+
+    def __init__(self, thermostat, due: float, interval: float):
+        self.thermostat = thermostat
+        self.due = due
+        self.interval = interval
+        self.temperatures = None
+        self.stable_reads = 0
+
+
+class PollScheduler(object):
+    """
+    Gives each thermostat on a network its own time at which it is next due to be read
+    A thermostat which is heating or whose temperature is changing is read every scan_interval / FAST_FACTOR seconds,
+    one whose temperatures are stable every scan_interval * SLOW_FACTOR seconds (up to MAX_SLOW_INTERVAL)
+    and the others every scan_interval
+    Reads are spread out so polling never uses more than BUS_BUDGET of the bus time, when more reads are due
+    than fit the budget the most overdue thermostat is read first
+    """
+
+    def __init__(self, scan_interval: float, bus_budget: float = BUS_BUDGET):
+        self.scan_interval = scan_interval
+        self.bus_budget = bus_budget
+        self._entries = {}
+        # earliest time the next read may start while keeping within the budget
+        self._next_slot = 0
+        # (end time, duration) of the recent reads
+        self._reads = collections.deque()
+        self._start_time = time.monotonic()
+
+    def sync(self, thermostats):
+        """
+        Makes the schedule match thermostats, those added are due straight away,
+        spread over the first scan_interval so they are not all read together
+        """
+        thermostats = list(thermostats)
+        current = {id(thermostat) for thermostat in thermostats}
+        for key in [key for key in self._entries if key not in current]:
+            del self._entries[key]
+        new = [thermostat for thermostat in thermostats if id(thermostat) not in self._entries]
+        now = time.monotonic()
+        for n, thermostat in enumerate(new):
+            self._entries[id(thermostat)] = _Entry(thermostat, now + n * self.scan_interval / len(new), self.scan_interval)
+
+    def next(self) -> tuple:
+        """
+        Returns the thermostat which is next to be read and the time in seconds until its read should start
+        or (None, scan_interval) if there are no thermostats
+        """
+        if len(self._entries) == 0:
+            return None, self.scan_interval
+        entry = min(self._entries.values(), key=lambda entry: entry.due)
+        return entry.thermostat, max(entry.due, self._next_slot) - time.monotonic()
+
+    def record(self, thermostat, duration: float = None):
+        """
+        Schedules the next read of thermostat, which has just been read taking duration seconds of bus time
+        duration is None if the thermostat was not read (it is offline and backing off)
+        """
+        entry = self._entries.get(id(thermostat))
+        if entry is None:
+            return
+        now = time.monotonic()
+        if duration is not None:
+            self._reads.append((now, duration))
+            # a read of duration seconds is followed by enough idle time to keep within the budget
+            self._next_slot = now + duration * (1 / self.bus_budget - 1)
+            if thermostat.online():
+                entry.interval = self._interval(entry)
+        entry.due = now + entry.interval
+
+    def failed(self, thermostat):
+        """Schedules the next read of thermostat, whose read has failed unexpectedly, after the slow interval"""
+        entry = self._entries.get(id(thermostat))
+        if entry is None:
+            return
+        entry.interval = self._slow_interval()
+        entry.due = time.monotonic() + entry.interval
+
+    def _interval(self, entry: _Entry) -> float:
+        """Returns the interval until the next read of a thermostat based on what it has just reported"""
+        read_properties = entry.thermostat.read_properties
+        temperatures = tuple(read_properties.get(name) for name in _TEMPERATURES)
+        if temperatures == entry.temperatures:
+            entry.stable_reads += 1
+        else:
+            entry.stable_reads = 0
+        moving = entry.temperatures is not None and temperatures != entry.temperatures
+        entry.temperatures = temperatures
+        active = any(read_properties.get(name) == state for name, state in _ACTIVE_STATES.items())
+        if active or moving:
+            return max(MIN_INTERVAL, self.scan_interval / FAST_FACTOR)
+        if entry.stable_reads >= STABLE_READS:
+            return self._slow_interval()
+        return self.scan_interval
+
+    def _slow_interval(self) -> float:
+        """Returns the interval between reads of a stable thermostat"""
+        return max(self.scan_interval, min(self.scan_interval * SLOW_FACTOR, MAX_SLOW_INTERVAL))
+
+    def utilisation(self) -> float:
+        """Returns the fraction of the bus time used by reads over the last UTILISATION_WINDOW seconds"""
+        now = time.monotonic()
+        while self._reads and self._reads[0][0] < now - UTILISATION_WINDOW:
+            self._reads.popleft()
+        window = min(UTILISATION_WINDOW, now - self._start_time)
+        if window <= 0:
+            return 0
+        return min(1, sum(duration for _, duration in self._reads) / window)
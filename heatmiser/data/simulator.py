@@ -0,0 +1,416 @@
+"""
+Simulator of Heatmiser V3 thermostats on an RS485 bus, a stand-in for the hardware on a pseudo-terminal or a tcp port
+(like the nc -lk bridge in DOCS.md) so the hub and thermostats can be exercised without any
+e.g. python3 simulator.py --count 4 --tcp 1024 and python3 main.py --device 127.0.0.1:1024 ...
+"""
+import argparse
+import logging
+import os
+import random
+import select
+import socket
+import sys
+import time
+import tty
+from crc16 import crc16
+from dcbLayout import FIELD_TIME, FIELD_CLOCK, FIELD_DAY, NOT_CONNECTED
+from heatmiserThermostat import HeatmiserThermostat, FUNC_READ, FUNC_WRITE, RW_LENGTH_ALL, RW_MASTER_ADDRESS
+
+# 1 start bit, 8 data bits and 1 stop bit per byte at 4800 baud (as heatmiserHub, which needs pyserial)
+BYTE_TIME = 10 / 4800
+# Time a thermostat takes to start replying once a request has been received
+REPLY_DELAY = 0.05
+# Bytes sent in each write so a reply arrives at the bus speed rather than all at once
+CHUNK_SIZE = 8
+# Time after a reply at which any late bytes are sent
+LATE_DELAY = 0.01
+# Time a thermostat stays off after a power loss
+POWER_LOSS_TIME = 30
+# Address, length, master address, function, start (2 bytes), length (2 bytes), CRC (2 bytes)
+MIN_REQUEST_LENGTH = 10
+
+# Initial raw values of the fields, by name or by the end of the name for the program fields, others are 0
+_DEFAULTS = {
+    "Version": 19, "Differential": 1, "Frost Protection": 1, "Rate of Change": 20, "Frost Protect Temp": 12,
+    "Room Target Temp": 20, "Floor Max Temp": 28, "Display State": 1, "Built-in Sensor Temp": 195,
+    "Remote Sensor Temp": NOT_CONNECTED, "Floor Sensor Temp": NOT_CONNECTED, "Humidity": 50, "Dew Point Temp": 10,
+    "Cooling Target Temp": 24, "Floor Max limit": 1,
+    " Wake Time": (7, 0), " Wake Temp": 21, " Leave Time": (9, 0), " Leave Temp": 16,
+    " Return Time": (16, 0), " Return Temp": 21, " Sleep Time": (22, 0), " Sleep Temp": 16,
+    " Time1 On": (7, 0), " Time1 Off": (9, 0), " Time2 On": (16, 0), " Time2 Off": (22, 0),
+    # 24:00 is an unused timer slot
+    " Time3 On": (24, 0), " Time3 Off": (24, 0), " Time4 On": (24, 0), " Time4 Off": (24, 0),
+}
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _default(name: str):
+    if name in _DEFAULTS:
+        return _DEFAULTS[name]
+    for suffix, value in _DEFAULTS.items():
+        if suffix.startswith(" ") and name.endswith(suffix):
+            return value
+    return 0
+
+
+class SimulatedThermostat(object):
+    """
+    A thermostat's DCB, read and written by unique address like the real thing
+    The clock follows the host's clock (plus any offset written) and the heating state follows
+    the target and room temperatures
+    """
+
+    def __init__(self, address: int, model: str, seven_day: bool = False):
+        self.address = address
+        self.model = model
+        self.powered_time = 0
+        layout = HeatmiserThermostat.LAYOUTS[model]
+        mode = None
+        if layout.mode_index is not None:
+            mode = 1 if seven_day and 1 in layout.modes else 0
+        self.fields = layout.fields + layout.modes.get(mode, [])
+        size = max(field.index + field.width for field in self.fields)
+        self.dcb = bytearray(size)
+        self.dcb[0:2] = size.to_bytes(2, "big")
+        # unique address -> (index in the DCB, field)
+        self._addresses = {}
+        for field in self.fields:
+            for n in range(field.width):
+                self._addresses[field.address + n] = (field.index + n, field)
+            self._set(field, _default(field.name))
+        code = {name: code for code, name in HeatmiserThermostat.MODELS.items()}[model]
+        self._set_named("Type", code)
+        self._set_named("Bus Address", address)
+        if mode is not None:
+            self.dcb[layout.mode_index] = mode
+        self.clock_offset = 0
+        self._update()
+
+    def _set(self, field, value):
+        """Stores the raw value of field"""
+        if field.mask is not None:
+            self.dcb[field.index] = (self.dcb[field.index] & ~field.mask) | (value & field.mask)
+        elif isinstance(value, tuple):
+            self.dcb[field.index:field.index + len(value)] = bytes(value)
+        else:
+            self.dcb[field.index:field.index + field.width] = value.to_bytes(field.width, "big")
+
+    def _set_named(self, name: str, value):
+        for field in self.fields:
+            if field.name == name:
+                self._set(field, value)
+
+    def _get_named(self, name: str):
+        for field in self.fields:
+            if field.name == name:
+                value = int.from_bytes(self.dcb[field.index:field.index + field.width], "big")
+                return value if field.mask is None else value & field.mask
+        return None
+
+    def _update(self):
+        """Brings the clock and heating state up to date"""
+        now = time.localtime(time.time() + self.clock_offset)
+        for field in self.fields:
+            if field.kind == FIELD_DAY:
+                self._set(field, now.tm_wday + 1)
+            elif field.kind == FIELD_CLOCK:
+                self._set(field, (now.tm_hour, now.tm_min, now.tm_sec))
+        target = self._get_named("Room Target Temp")
+        temperature = self._get_named("Built-in Sensor Temp")
+        if target is not None and temperature is not None:
+            heating = self._get_named("Run Mode") == 0 and target * 10 > temperature
+            self._set_named("Heating State", 1 if heating else 0)
+
+    def powered(self) -> bool:
+        return time.monotonic() >= self.powered_time
+
+    def power_loss(self, duration: float = POWER_LOSS_TIME):
+        """Turns the thermostat off for duration seconds"""
+        self.powered_time = time.monotonic() + duration
+
+    def read(self, start: int, length: int):
+        """Returns the bytes of the DCB read from unique address start or None if the addresses don't exist"""
+        self._update()
+        if length == RW_LENGTH_ALL:
+            return bytes(self.dcb)
+        indexes = [self._addresses.get(address, (None,))[0] for address in range(start, start + length)]
+        if None in indexes or indexes != list(range(indexes[0], indexes[0] + length)):
+            return None
+        return bytes(self.dcb[indexes[0]:indexes[0] + length])
+
+    def write(self, start: int, data: bytes) -> bool:
+        """
+        Writes data to the fields at unique address start, 2 byte values are written low byte first
+        Returns False if the addresses are not whole fields
+        """
+        address = start
+        writes = []
+        while address < start + len(data):
+            index, field = self._addresses.get(address, (None, None))
+            if field is None or field.address != address or address + field.width > start + len(data):
+                return False
+            value = data[address - start:address - start + field.width]
+            if field.kind not in (FIELD_TIME, FIELD_CLOCK) and field.width == 2:
+                value = value[::-1]
+            writes.append((field, value))
+            address += field.width
+        clock = False
+        for field, value in writes:
+            if field.write_options is not None and not field.readback and field.mask is None:
+                # e.g. hot water state, written as program 0, on 1 or off 2 but read as off 0 or on 1
+                value = bytes([1 if value[0] == 1 else 0])
+            self.dcb[field.index:field.index + field.width] = value
+            clock = clock or field.kind in (FIELD_DAY, FIELD_CLOCK)
+        if clock:
+            self._set_clock()
+        self._update()
+        return True
+
+    def _set_clock(self):
+        """Sets the clock offset from the day and time written"""
+        day = hour = minute = second = 0
+        for field in self.fields:
+            if field.kind == FIELD_DAY:
+                day = self.dcb[field.index] - 1
+            elif field.kind == FIELD_CLOCK:
+                hour, minute, second = self.dcb[field.index:field.index + 3]
+        now = time.localtime()
+        week = 7 * 24 * 60 * 60
+        written = ((day * 24 + hour) * 60 + minute) * 60 + second
+        host = ((now.tm_wday * 24 + now.tm_hour) * 60 + now.tm_min) * 60 + now.tm_sec
+        self.clock_offset = (written - host) % week
+
+
+class Faults(object):
+    """
+    Probabilities of the faults injected into each transaction
+    drop: no reply
+    corrupt: a reply with a bad CRC
+    late: a reply followed by late bytes, which corrupt the next reply unless they are discarded
+    power_loss: the thermostat loses power part way through its reply and stays off for POWER_LOSS_TIME
+    """
+
+    def __init__(self, drop: float = 0, corrupt: float = 0, late: float = 0, power_loss: float = 0):
+        self.drop = drop
+        self.corrupt = corrupt
+        self.late = late
+        self.power_loss = power_loss
+
+
+class BusSimulator(object):
+    """
+    The thermostats on a bus, which reply to the requests addressed to them
+    Requests are taken from the bytes received, anything which isn't a valid request is ignored like the thermostats do
+    """
+
+    def __init__(self, thermostats: list, faults: Faults = None, seed: int = None):
+        self.thermostats = {thermostat.address: thermostat for thermostat in thermostats}
+        self.faults = faults if faults is not None else Faults()
+        self._random = random.Random(seed)
+        self._received = bytearray()
+
+    def receive(self, data: bytes) -> list:
+        """Returns the requests completed by data as a list of bytes"""
+        self._received += data
+        requests = []
+        while len(self._received) >= 2:
+            length = self._received[1]
+            if length < MIN_REQUEST_LENGTH:
+                # not the start of a request, look for the next one
+                del self._received[0]
+                continue
+            if len(self._received) < length:
+                break
+            request = bytes(self._received[:length])
+            del self._received[:length]
+            if crc16(request[:-2]) != request[-2] | (request[-1] << 8):
+                _LOGGER.debug(f"Ignoring request with a bad CRC {list(request)}")
+                continue
+            requests.append(request)
+        return requests
+
+    def reply(self, request: bytes) -> tuple:
+        """
+        Returns the reply to a request and any late bytes to send after it, which are empty if there is no reply
+        """
+        thermostat = self.thermostats.get(request[0])
+        if thermostat is None or not thermostat.powered() or request[2] != RW_MASTER_ADDRESS:
+            return b"", b""
+        function = request[3]
+        start = request[4] | (request[5] << 8)
+        length = request[6] | (request[7] << 8)
+        if function == FUNC_READ:
+            data = thermostat.read(start, length)
+            if data is None:
+                return b"", b""
+            if length == RW_LENGTH_ALL:
+                length = len(data)
+        elif function == FUNC_WRITE:
+            if len(request) != MIN_REQUEST_LENGTH + length or not thermostat.write(start, request[8:8 + length]):
+                return b"", b""
+            data = b""
+            start = length = 0
+        else:
+            return b"", b""
+        frame = [RW_MASTER_ADDRESS, 0, 0, thermostat.address, function]
+        if function == FUNC_READ:
+            frame += [start & 0xff, start >> 8, length & 0xff, length >> 8]
+        frame += list(data)
+        frame[1] = (len(frame) + 2) & 0xff
+        frame[2] = (len(frame) + 2) >> 8
+        crc = crc16(frame)
+        reply = bytes(frame + [crc & 0xff, crc >> 8])
+        return self._inject(thermostat, reply)
+
+    def _inject(self, thermostat: SimulatedThermostat, reply: bytes) -> tuple:
+        """Applies the faults to a reply"""
+        faults = self.faults
+        chance = self._random.random
+        if chance() < faults.drop:
+            _LOGGER.info(f"Dropping reply from {thermostat.address}")
+            return b"", b""
+        if chance() < faults.power_loss:
+            _LOGGER.info(f"Power loss of {thermostat.address}")
+            thermostat.power_loss()
+            return reply[:self._random.randrange(1, len(reply))], b""
+        if chance() < faults.corrupt:
+            _LOGGER.info(f"Corrupting reply from {thermostat.address}")
+            position = self._random.randrange(len(reply))
+            reply = reply[:position] + bytes([reply[position] ^ 0xff]) + reply[position + 1:]
+        late = b""
+        if chance() < faults.late:
+            _LOGGER.info(f"Late bytes after reply from {thermostat.address}")
+            late = bytes(self._random.randrange(256) for _ in range(self._random.randrange(1, 4)))
+        return reply, late
+
+
+class _PtyTransport(object):
+    """The master side of a pseudo-terminal, the hub opens the slave device"""
+
+    def __init__(self):
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self.device = os.ttyname(slave)
+        # keep the slave open so the master doesn't see a hangup between connections
+        self._slave = slave
+
+    def read(self, timeout: float) -> bytes:
+        ready, _, _ = select.select([self._master], [], [], timeout)
+        return os.read(self._master, 1024) if ready else b""
+
+    def write(self, data: bytes):
+        os.write(self._master, data)
+
+    def close(self):
+        os.close(self._master)
+        os.close(self._slave)
+
+
+class _TcpTransport(object):
+    """A tcp port accepting one connection at a time, like nc -lk"""
+
+    def __init__(self, port: int):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("", port))
+        self._server.listen(1)
+        self.device = f"127.0.0.1:{self._server.getsockname()[1]}"
+        self._connection = None
+
+    def read(self, timeout: float) -> bytes:
+        if self._connection is None:
+            ready, _, _ = select.select([self._server], [], [], timeout)
+            if ready:
+                self._connection, peer = self._server.accept()
+                self._connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                _LOGGER.info(f"Connection from {peer}")
+            return b""
+        ready, _, _ = select.select([self._connection], [], [], timeout)
+        if not ready:
+            return b""
+        data = self._connection.recv(1024)
+        if len(data) == 0:
+            _LOGGER.info("Connection closed")
+            self._connection.close()
+            self._connection = None
+        return data
+
+    def write(self, data: bytes):
+        if self._connection is not None:
+            try:
+                self._connection.sendall(data)
+            except OSError as ex:
+                _LOGGER.info(f"Unable to send, {ex}")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+        self._server.close()
+
+
+def serve(bus: BusSimulator, transport, timing: bool = True, reply_delay: float = REPLY_DELAY):
+    """
+    Replies to the requests received on transport until interrupted
+    With timing the requests and replies take as long as they would at 4800 baud
+    """
+    while True:
+        for request in bus.receive(transport.read(1)):
+            received = time.monotonic()
+            reply, late = bus.reply(request)
+            if len(reply) == 0:
+                continue
+            if not timing:
+                transport.write(reply + late)
+                continue
+            # the request has been on the wire for its length, the reply starts after the thermostat's delay
+            start = received + reply_delay
+            for position in range(0, len(reply), CHUNK_SIZE):
+                time.sleep(max(0, start + position * BYTE_TIME - time.monotonic()))
+                transport.write(reply[position:position + CHUNK_SIZE])
+            if len(late) > 0:
+                time.sleep(len(reply) * BYTE_TIME + LATE_DELAY)
+                transport.write(late)
+
+
+def main():
+    models = list(HeatmiserThermostat.LAYOUTS)
+    parser = argparse.ArgumentParser(description='Simulator of Heatmiser V3 thermostats on an RS485 bus')
+    parser.add_argument('--count', '-n', type=int, default=1, help='The number of thermostats of each model (default 1)')
+    parser.add_argument('--models', '-m', type=str, nargs='+', default=models, choices=models, metavar='MODEL', help=f"The models simulated (default {' '.join(models)})")
+    parser.add_argument('--seven_day', action='store_true', help='Use the 7 day program instead of weekday/weekend')
+    parser.add_argument('--tcp', '-t', type=int, metavar='PORT', help='Listen on a tcp port instead of a pseudo-terminal')
+    parser.add_argument('--no_timing', action='store_true', help='Reply as quickly as possible instead of at 4800 baud')
+    parser.add_argument('--reply_delay', type=float, default=REPLY_DELAY, help=f"Time in seconds each thermostat takes to start replying (default {REPLY_DELAY})")
+    parser.add_argument('--drop', type=float, default=0, help='Probability of a reply being dropped')
+    parser.add_argument('--corrupt', type=float, default=0, help='Probability of a reply having a bad CRC')
+    parser.add_argument('--late', type=float, default=0, help='Probability of late bytes following a reply')
+    parser.add_argument('--power_loss', type=float, default=0, help=f"Probability of a thermostat losing power part way through a reply, for {POWER_LOSS_TIME}s")
+    parser.add_argument('--seed', type=int, help='Seed of the fault injection')
+    parser.add_argument('--loglevel', '-l', type=str, default='info', choices=['debug', 'info', 'warning', 'error'], help='The log level (default info)')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)-5s %(message)s', level=args.loglevel.upper(), force=True)
+
+    # addresses from 1 in the order of the models
+    thermostats = []
+    for model in args.models:
+        for _ in range(args.count):
+            thermostats.append(SimulatedThermostat(len(thermostats) + 1, model, args.seven_day))
+    if len(thermostats) > 255:
+        parser.error(f"{len(thermostats)} thermostats is more than the 255 addresses available")
+    bus = BusSimulator(thermostats, Faults(args.drop, args.corrupt, args.late, args.power_loss), args.seed)
+    transport = _TcpTransport(args.tcp) if args.tcp is not None else _PtyTransport()
+    for thermostat in thermostats:
+        _LOGGER.info(f"{thermostat.model} at address {thermostat.address}")
+    # the device for main.py --device, flushed so a script can read it
+    print(transport.device, flush=True)
+    try:
+        serve(bus, transport, not args.no_timing, args.reply_delay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
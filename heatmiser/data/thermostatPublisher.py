@@ -0,0 +1,116 @@
+"""Module to publish a thermostat's data to mqtt, sending only what has changed"""
+import json
+import threading
+import time
+
+# Interval in seconds at which everything is republished even if it has not changed
+# Less than the 600s Home Assistant expire_after used in the discovery configs
+REPUBLISH_INTERVAL = 300
+# Sub topic of the json state document
+STATE_TOPIC = "state"
+# Sub topic of the json schedule (program) document
+SCHEDULE_TOPIC = "schedule"
+
+
+class ThermostatPublisher(object):
+    """
+    Publishes the data of one thermostat
+    Remembers the last payload published on each topic so only changed values are sent
+    Everything is republished every republish_interval seconds (or on every scan if it is 0)
+    The read properties are published either on a topic each or together as one json document on the state topic
+    whose keys are the properties' sub topics, they are only decoded when their raw bytes (fingerprint) have changed
+    The schedule (program) is published as one json document on the schedule topic, only when it has changed
+    """
+
+    def __init__(self, publish, prefix: str, thermostat, republish_interval: int = REPUBLISH_INTERVAL,
+            json_state: bool = False):
+        """
+        publish: function(topic, payload) which returns True if the payload was published
+        prefix: the mqtt topic prefix of the thermostat's read properties
+        json_state: publish the read properties as one json document
+        """
+        self._publish = publish
+        self._thermostat = thermostat
+        self._topic_base = f"{prefix}/{thermostat.name}/"
+        self._republish_interval = republish_interval
+        self._json_state = json_state
+        self.state_topic = self._topic_base + STATE_TOPIC
+        self.schedule_topic = self._topic_base + SCHEDULE_TOPIC
+        # the raw bytes of the read properties (other than the schedule) and of the schedule last published
+        self._fingerprint = None
+        self._schedule_fingerprint = None
+        self._next_republish = 0
+        # read property name -> topic
+        self._topics = {}
+        # topic -> last payload published
+        self._published = {}
+        # the scan loop and the mqtt command worker both publish
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sub_topic(key: str) -> str:
+        """Returns the sub topic (and json state key) of read property key"""
+        return str(key).lower().replace(" ", "_")
+
+    def topic(self, key: str) -> str:
+        """Returns the topic of read property key"""
+        topic = self._topics.get(key)
+        if topic is None:
+            topic = self._topic_base + self.sub_topic(key)
+            self._topics[key] = topic
+        return topic
+
+    def refresh(self):
+        """
+        Starts a scan, forgets everything that has been published if the republish interval has elapsed
+        so the scan publishes everything
+        """
+        now = time.monotonic()
+        if now >= self._next_republish:
+            self._next_republish = now + self._republish_interval
+            self.invalidate()
+
+    def invalidate(self):
+        """Forgets everything that has been published so it is all published again"""
+        with self._lock:
+            self._published.clear()
+            self._fingerprint = None
+            self._schedule_fingerprint = None
+
+    def publish(self, topic: str, payload) -> bool:
+        """
+        Publishes payload on topic if it differs from what was last published
+        Returns False if publishing failed
+        """
+        with self._lock:
+            if topic in self._published and self._published[topic] == payload:
+                return True
+            if not self._publish(topic, payload):
+                return False
+            self._published[topic] = payload
+            return True
+
+    def publish_properties(self):
+        """Publishes the thermostat's changed read properties and schedule"""
+        read_properties = self._thermostat.read_properties
+        fingerprint = read_properties.other_fingerprint()
+        if fingerprint != self._fingerprint:
+            if self._json_state:
+                state = {self.sub_topic(key): value for key, value in read_properties.other_items()}
+                published = self.publish(self.state_topic, json.dumps(state, default=str))
+            else:
+                published = all([self.publish(self.topic(key), value) for key, value in read_properties.other_items()])
+            if published:
+                self._fingerprint = fingerprint
+        self._publish_schedule(read_properties)
+
+    def _publish_schedule(self, read_properties):
+        """
+        Publishes the schedule as a json document of each day's periods, e.g. {"Mon": [["07:00", 21], ...], ...}
+        It is only decoded if its raw bytes (fingerprint) have changed since it was last published
+        """
+        fingerprint = read_properties.schedule_fingerprint()
+        if len(fingerprint) == 0 or fingerprint == self._schedule_fingerprint:
+            return
+        if self.publish(self.schedule_topic, json.dumps(read_properties.schedule())):
+            self._schedule_fingerprint = fingerprint
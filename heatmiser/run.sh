@@ -2,19 +2,22 @@
 
 # opts is an array which is built into the command line options
 declare -a opts
+# devices and network_names hold one entry per network
+declare -a devices
+declare -a network_names
 
 # --device can be either a physical device like /dev/ttyUSB0 or an ip address like 127.0.0.1:1024
 # The config has two values, device for physical and tcp_address for tcp communication
 if $(bashio::config 'use_serial'); then
     if bashio::config.has_value "device"; then
-        opts+=("--device $(bashio::config device)")
+        devices+=("$(bashio::config device)")
     else
         bashio::log.fatal "Use Serial Device is selected but no serial device has been chosen"
         bashio::addon.stop
     fi
 else
     if bashio::config.has_value "tcp_address"; then
-        opts+=("--device $(bashio::config tcp_address)")
+        devices+=("$(bashio::config tcp_address)")
     else
         bashio::log.fatal "Use Serial Device is not selected but no tcp network address has been defined"
         bashio::addon.stop
@@ -22,12 +25,27 @@ else
 fi
 #bashio::config <key> <default>
 #bashio::services <service> <option>
-opts+=("--network_name $(bashio::config network_name heatmiser_network)")
+network_names+=("$(bashio::config network_name heatmiser_network)")
+# any further networks, each with its own serial device or tcp address
+for network in $(bashio::config 'additional_networks|keys'); do
+    devices+=("$(bashio::config "additional_networks[${network}].device")")
+    network_names+=("$(bashio::config "additional_networks[${network}].network_name")")
+done
+opts+=("--device ${devices[*]}")
+opts+=("--network_name ${network_names[*]}")
 opts+=("--scan_interval $(bashio::config scan_interval 60)")
 opts+=("--homeassistant $(bashio::config homeassistant true)")
+opts+=("--json_state $(bashio::config json_state false)")
+opts+=("--outbox_size $(bashio::config outbox_size 256)")
+opts+=("--clock_sync_threshold $(bashio::config clock_sync_threshold 0)")
+opts+=("--metrics_port $(bashio::config metrics_port 0)")
+opts+=("--diagnostics_interval $(bashio::config diagnostics_interval 0)")
+opts+=("--ha_device_discovery $(bashio::config ha_device_discovery false)")
 opts+=("--loglevel $(bashio::config loglevel info)")
 opts+=("--mqtt_host $(bashio::config mqtt_host $(bashio::services mqtt host))")
 opts+=("--max_address $(bashio::config max_address 10)")
+opts+=("--full_read_interval $(bashio::config full_read_interval 10)")
+opts+=("--republish_interval $(bashio::config republish_interval 300)")
 #MQTT
 opts+=("--mqtt_port $(bashio::config mqtt_port $(bashio::services mqtt port))")
 opts+=("--mqtt_username $(bashio::config mqtt_username $(bashio::services mqtt username))")
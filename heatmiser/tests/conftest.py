@@ -0,0 +1,5 @@
+"""The add-on's modules are in data/, which is copied into the image as the working directory"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data"))
@@ -0,0 +1,111 @@
+"""Tests of the hub's framing against the simulator on a pseudo-terminal"""
+import threading
+import time
+import pytest
+
+pytest.importorskip("serial")
+
+from crc16 import crc16_verify
+from heatmiserHub import HeatmiserHub, PROBE_TIMEOUT, RESPONSE_TIMEOUT
+from heatmiserThermostat import HeatmiserThermostat, FUNC_READ, FUNC_WRITE, RW_LENGTH_ALL
+from simulator import BusSimulator, SimulatedThermostat, _PtyTransport, serve
+
+
+class _TruncatingBus(BusSimulator):
+    """Cuts its first reply short after cut bytes, as a thermostat losing power does, then replies normally"""
+
+    def __init__(self, thermostats: list, cut: int):
+        super().__init__(thermostats)
+        self._cut = cut
+
+    def reply(self, request: bytes) -> tuple:
+        reply, late = super().reply(request)
+        if self._cut is not None and len(reply) > 0:
+            reply, self._cut = reply[:self._cut], None
+        return reply, late
+
+
+def _serve(bus: BusSimulator, transport: _PtyTransport):
+    try:
+        serve(bus, transport)
+    except OSError:
+        # the transport has been closed
+        pass
+
+
+@pytest.mark.parametrize("cut", [1, 2, 20])
+def test_truncated_reply_is_given_up_on_straight_away(cut):
+    transport = _PtyTransport()
+    bus = _TruncatingBus([SimulatedThermostat(1, "PRT")], cut)
+    threading.Thread(target=_serve, args=(bus, transport), daemon=True).start()
+    hub = HeatmiserHub(transport.device, "test")
+    try:
+        start = time.monotonic()
+        reply = hub.send_msg(HeatmiserThermostat.assemble_message(1, FUNC_READ, 0, [0]))
+        duration = time.monotonic() - start
+    finally:
+        hub.stop()
+        transport.close()
+    # the truncated reply is resent rather than waited on for the 3s response timeout
+    assert len(reply) > 0 and crc16_verify(reply)
+    assert duration < 1
+
+
+
+class _StaleBus(BusSimulator):
+    """
+    Sends stale ahead of its first reply, as when a reply to an earlier message arrives late, then replies normally
+    Messages to empty addresses are only answered with stale
+    """
+
+    def __init__(self, thermostats: list, stale: bytes):
+        super().__init__(thermostats)
+        self._stale = stale
+
+    def reply(self, request: bytes) -> tuple:
+        reply, late = super().reply(request)
+        if self._stale is not None:
+            reply, self._stale = self._stale + reply, None
+        return reply, late
+
+
+def _late_reply(address: int, function: int, start: int = 0, payload: list = [0], read_length: int = RW_LENGTH_ALL) -> bytes:
+    """Returns the reply of a PRT at address to an earlier message"""
+    reply, _ = BusSimulator([SimulatedThermostat(address, "PRT")]).reply(
+        bytes(HeatmiserThermostat.assemble_message(address, function, start, payload, read_length)))
+    assert len(reply) > 0
+    return reply
+
+
+def _send(stale: bytes, address: int, response_timeout: float = RESPONSE_TIMEOUT) -> tuple:
+    """Returns the reply to a read of the thermostat at address which is preceded by stale and how long it took"""
+    transport = _PtyTransport()
+    bus = _StaleBus([SimulatedThermostat(1, "PRT")], stale)
+    threading.Thread(target=_serve, args=(bus, transport), daemon=True).start()
+    hub = HeatmiserHub(transport.device, "test")
+    try:
+        start = time.monotonic()
+        reply = hub.send_msg(HeatmiserThermostat.assemble_message(address, FUNC_READ, 0, [0]), response_timeout=response_timeout)
+        return reply, time.monotonic() - start
+    finally:
+        hub.stop()
+        transport.close()
+
+
+@pytest.mark.parametrize("stale", [
+    b"\x00\x12\x34",
+    _late_reply(2, FUNC_READ),
+    _late_reply(1, FUNC_WRITE, 18, [20]),
+    _late_reply(1, FUNC_READ, 38, read_length=2),
+], ids=["late bytes", "other thermostat", "write", "partial read"])
+def test_stale_frames_are_not_taken_as_the_reply(stale):
+    reply, duration = _send(stale, 1)
+    assert crc16_verify(reply)
+    assert reply[3] == 1 and reply[4] == FUNC_READ and reply[5:7] == [0, 0]
+    # the reply following the stale frame is read rather than the message resent
+    assert duration < 1
+
+
+def test_probe_of_an_empty_address_ignores_other_replies():
+    reply, _ = _send(_late_reply(1, FUNC_READ), 2, PROBE_TIMEOUT)
+    assert reply == []
@@ -0,0 +1,55 @@
+"""Tests of the writes to a thermostat against the simulator"""
+from heatmiserThermostat import HeatmiserThermostat, FUNC_WRITE
+from simulator import BusSimulator, SimulatedThermostat
+
+
+class _Hub(object):
+    """Passes every message to the simulated thermostats and remembers the writes"""
+
+    def __init__(self, simulated: SimulatedThermostat):
+        self._bus = BusSimulator([simulated])
+        self.writes = []
+
+    def registerThermostat(self, thermostat):
+        pass
+
+    def send_msg(self, message: list, priority: int = None, response_timeout: float = None):
+        if message[3] == FUNC_WRITE:
+            self.writes.append(message)
+        return list(self._bus.reply(bytes(message))[0])
+
+
+def test_value_just_written_is_not_written_again():
+    hub = _Hub(SimulatedThermostat(1, "PRT"))
+    thermostat = HeatmiserThermostat(1, "PRT", hub, "network_1")
+    # the full read is too old to be trusted
+    thermostat._hot_read_time = thermostat._full_read_time = 0
+    frost_protect_temp = thermostat.write_properties["frost_protect_temp"]
+    assert thermostat.update_thermostat_properties([(frost_protect_temp, 10)])
+    assert thermostat.update_thermostat_properties([(frost_protect_temp, 10)])
+    assert len(hub.writes) == 1
+
+
+def test_value_read_back_is_not_written_again():
+    hub = _Hub(SimulatedThermostat(1, "PRT"))
+    thermostat = HeatmiserThermostat(1, "PRT", hub, "network_1")
+    frost_protect_temp = thermostat.write_properties["frost_protect_temp"]
+    assert thermostat.update_thermostat_properties([(frost_protect_temp, 10)])
+    thermostat._hot_read_time = thermostat._full_read_time = 0
+    thermostat._confirmed_times.clear()
+    assert thermostat.confirm_writes()
+    assert thermostat.update_thermostat_properties([(frost_protect_temp, 10)])
+    assert len(hub.writes) == 1
+
+
+def test_only_writes_sent_are_pending():
+    hub = _Hub(SimulatedThermostat(1, "PRT"))
+    thermostat = HeatmiserThermostat(1, "PRT", hub, "network_1")
+    frost_protect_temp = thermostat.write_properties["frost_protect_temp"]
+    assert thermostat.update_thermostat_properties([(frost_protect_temp, 10)])
+    assert thermostat.writes_pending()
+    assert thermostat.confirm_writes()
+    assert not thermostat.writes_pending()
+    # already has it so nothing is sent
+    assert thermostat.update_thermostat_properties([(frost_protect_temp, 10)])
+    assert not thermostat.writes_pending()
@@ -0,0 +1,24 @@
+"""Tests of the Home Assistant discovery configurations"""
+import json
+
+from homeassistant import ha_climate_config, ha_sensor_config, ha_device_config
+
+
+def _identifiers(config: str) -> list:
+    return json.loads(config)['device']['identifiers']
+
+
+def test_thermostats_sharing_an_address_on_two_networks_are_different_devices():
+    details = ("C", "Heatmiser", "PRT", "19")
+    for state_topic in (None, "heatmiser/state"):
+        a = ha_climate_config("network_a_1", 1, *details, state_topic)
+        b = ha_climate_config("network_b_1", 1, *details, state_topic)
+        assert _identifiers(a) != _identifiers(b)
+        assert json.loads(a)['uniq_id'] != json.loads(b)['uniq_id']
+        # a thermostat's climate and sensor belong to the same device
+        assert _identifiers(ha_sensor_config("network_a_1", "Current Temp", 1, *details, state_topic)) == _identifiers(a)
+        device_a = ha_device_config("network_a_1", "Current Temp", 1, *details, state_topic)
+        device_b = ha_device_config("network_b_1", "Current Temp", 1, *details, state_topic)
+        assert _identifiers(device_a) == _identifiers(a)
+        assert _identifiers(device_a) != _identifiers(device_b)
+        assert not set(json.loads(device_a)['components']) & set(json.loads(device_b)['components'])
@@ -0,0 +1,149 @@
+"""Tests of the mqtt publishing of thermostats' data in main.py"""
+import argparse
+import json
+import logging
+import threading
+import time
+import pytest
+
+pytest.importorskip("paho")
+
+import main
+from dcbLayout import NOT_CONNECTED
+from heatmiserThermostat import HeatmiserThermostat, FUNC_READ, HEATMISER
+from homeassistant import DiscoveryConfigs
+from outbox import Outbox
+from simulator import BusSimulator, SimulatedThermostat
+from thermostatPublisher import ThermostatPublisher
+
+
+class _Result(object):
+    rc = main.mqtt_client.MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout: float = None):
+        pass
+
+
+class _Client(object):
+    """An mqtt client which remembers the last payload published on each topic"""
+
+    def __init__(self):
+        self.connected_flag = True
+        self.published = {}
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.published[topic] = payload
+        return _Result()
+
+
+class _Hub(object):
+    """Replies to every message with a read of the whole DCB of a simulated thermostat"""
+
+    def __init__(self, simulated: SimulatedThermostat):
+        self._bus = BusSimulator([simulated])
+
+    def registerThermostat(self, thermostat):
+        pass
+
+    def send_msg(self, message: list, priority: int = None, response_timeout: float = None):
+        return list(self._bus.reply(bytes(HeatmiserThermostat.assemble_message(message[0], FUNC_READ, 0, [0])))[0])
+
+
+def _setup(json_state: bool, ha_device_discovery: bool) -> _Client:
+    """Sets the globals of main.py which publishing uses, as main.py does at startup"""
+    main.args = argparse.Namespace(mqtt_prefix=HEATMISER, homeassistant=True, json_state=json_state,
+        ha_device_discovery=ha_device_discovery, republish_interval=0)
+    main._LOGGER = logging.getLogger("main")
+    main.client = _Client()
+    main.outbox = Outbox()
+    main.publishers = {}
+    main.discovery_configs = DiscoveryConfigs(lambda topic, payload: main.publish_base(main.client, topic, payload))
+    return main.client
+
+
+def _thermostat(model: str, simulated: SimulatedThermostat = None) -> HeatmiserThermostat:
+    simulated = simulated if simulated is not None else SimulatedThermostat(1, model)
+    thermostat = HeatmiserThermostat(1, model, _Hub(simulated), "network_1")
+    main.publishers[thermostat.name] = ThermostatPublisher(lambda topic, payload: main.publish_base(main.client, topic, payload),
+        HEATMISER, thermostat, 0, main.args.json_state)
+    return thermostat
+
+
+@pytest.mark.parametrize("json_state", [False, True])
+@pytest.mark.parametrize("ha_device_discovery", [False, True])
+def test_timer_is_published_as_a_switch(json_state, ha_device_discovery):
+    client = _setup(json_state, ha_device_discovery)
+    thermostat = _thermostat("TM1")
+    assert thermostat.connected()
+    main.publish_config(thermostat)
+    main.publish_thermostat(thermostat)
+    [config_topic] = main.config_topics(thermostat)
+    config = json.loads(client.published[config_topic])
+    if ha_device_discovery:
+        [config] = config['components'].values()
+        assert config['platform'] == "switch"
+    assert config['cmd_t'] == f"{HEATMISER}/network_1/timer_state/set"
+    assert client.published["homeassistant/switch/network_1/available"] == "online"
+    if json_state:
+        assert json.loads(client.published[config['stat_t']])["timer_state"] in ("on", "off")
+    else:
+        assert client.published[config['stat_t']] in ("on", "off")
+    assert not any(topic.startswith("homeassistant/climate") for topic in client.published)
+
+
+@pytest.mark.parametrize("json_state", [False, True])
+def test_thermostat_is_published_as_a_climate(json_state):
+    client = _setup(json_state, False)
+    thermostat = _thermostat("PRT")
+    main.publish_config(thermostat)
+    main.publish_thermostat(thermostat)
+    for topic in main.config_topics(thermostat) + main.availability_topics(thermostat):
+        assert topic in client.published
+    if not json_state:
+        assert client.published["homeassistant/climate/network_1/current_temp"] == "19"
+
+
+def test_sensor_not_connected_is_published_as_unknown():
+    client = _setup(False, False)
+    simulated = SimulatedThermostat(1, "PRT")
+    simulated._set_named("Built-in Sensor Temp", NOT_CONNECTED)
+    thermostat = _thermostat("PRT", simulated)
+    assert thermostat.read_properties["Built-in Sensor Temp"] == "not connected"
+    main.publish_thermostat(thermostat)
+    assert client.published["homeassistant/climate/network_1/current_temp"] == "None"
+    assert "homeassistant/climate/network_1/target_temp" in client.published
+
+
+class _Network(object):
+    """A network with one thermostat and nothing more to discover"""
+
+    def __init__(self, thermostat: HeatmiserThermostat):
+        self.thermostats = {thermostat.address: thermostat}
+
+    def name(self) -> str:
+        return "network"
+
+    def found(self) -> list:
+        return []
+
+
+def test_failed_poll_is_not_retried_straight_away(monkeypatch):
+    _setup(False, False)
+    main.args.scan_interval = 10
+    main.args.clock_sync_threshold = 0
+    main.stopping = threading.Event()
+    thermostat = _thermostat("PRT")
+    polls = []
+
+    def poll_thermostat(*args):
+        polls.append(time.monotonic())
+        raise ValueError("unexpected")
+
+    monkeypatch.setattr(main, "poll_thermostat", poll_thermostat)
+    network = _Network(thermostat)
+    poller = threading.Thread(target=main.poll_network, args=(network, network))
+    poller.start()
+    time.sleep(1.5)
+    main.stopping.set()
+    poller.join()
+    assert len(polls) == 1